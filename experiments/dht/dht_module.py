@@ -15,14 +15,11 @@ class DHTModule(IPv8OverlayExperimentModule):
 
     def __init__(self, experiment):
         super(DHTModule, self).__init__(experiment, DHTDiscoveryCommunity)
-        self.start_time = 0
 
     def on_id_received(self):
         super(DHTModule, self).on_id_received()
         self.tribler_config.set_dht_enabled(True)
 
-        self.start_time = time.time()
-
     def on_ipv8_available(self, _):
         # Disable threadpool messages
         self.overlay._use_main_thread = True
@@ -35,11 +32,11 @@ class DHTModule(IPv8OverlayExperimentModule):
 
     @experiment_callback
     def store(self, key, value):
-        self.log_timing(self.overlay.store_value(key.decode('hex'), value), 'store')
+        return self.log_timing(self.overlay.store_value(key.decode('hex'), value), 'store')
 
     @experiment_callback
     def find(self, key):
-        self.log_timing(self.overlay.find_values(key.decode('hex')), 'find')
+        return self.log_timing(self.overlay.find_values(key.decode('hex')), 'find')
 
     @experiment_callback
     def do_dht_announce(self):
@@ -53,12 +50,7 @@ class DHTModule(IPv8OverlayExperimentModule):
         self.overlay.store_peer().addCallbacks(on_peer_stored, on_peer_store_error)
 
     def log_timing(self, deferred, op):
-        ts = time.time() - self.start_time
-        cb = lambda _, t=ts: self.write_to_log('dht.log', '%d %s %.3f\n', ts, op, time.time() - self.start_time - t)
-        eb = lambda _: self.write_to_log('dht.log', '%d %s -1', ts, op)
-        deferred.addCallbacks(cb, eb)
-
-    def write_to_log(self, fn, string, *values):
-        with open(fn, 'a') as fp:
-            fp.write(string % values)
-
+        ts = time.time()
+        cb = lambda _: self.record_metric('dht_response_time/%s' % op, time.time() - ts, ts)
+        eb = lambda _: self.record_metric('dht_response_time/%s' % op, -1, ts)
+        return deferred.addCallbacks(cb, eb)
@@ -13,13 +13,15 @@ class DHTStatisticsParser(StatisticsParser):
     """
 
     def aggregate_dht_response_times(self):
+        start_times = dict((peer_nr, timestamp) for peer_nr, timestamp, _ in self.yield_metric('experiment_start'))
         with open('dht_response_times.csv', 'w') as csv_fp:
             csv_fp.write('peer time operation response_time\n')
-            for peer_nr, filename, dir in self.yield_files('dht.log'):
-                with open(filename) as log_fp:
-                    for line in log_fp.readlines():
-                        ts, method, t = line.split()
-                        csv_fp.write('%s %s %s %s\n' % (peer_nr, ts, method, t))
+            for operation in ('store', 'find'):
+                for peer_nr, ts, t in self.yield_metric('dht_response_time/%s' % operation):
+                    # Failed operations are written as -1, which dht.r reads as NA
+                    response_time = '%.3f' % t if t >= 0 else '-1'
+                    csv_fp.write('%s %d %s %s\n' % (peer_nr, ts - start_times.get(peer_nr, ts), operation,
+                                                     response_time))
 
     def run(self):
         self.aggregate_dht_response_times()
@@ -42,7 +42,7 @@ from os import environ
 from sys import exit, stderr, stdout
 
 from gumby.log import setupLogging
-from gumby.sync import ExperimentClientFactory
+from gumby.sync import ExperimentClientFactory, connect_to_experiment_server
 from gumby.experiment import ExperimentClient
 from twisted.internet import reactor
 from twisted.python.log import err, msg, startLogging
@@ -61,7 +61,7 @@ class DummyExperimentClient(ExperimentClient):
 def main():
     factory = ExperimentClientFactory({"random_key": "random value"}, DummyExperimentClient)
     logger.info("Connecting to: %s:%s", environ['SYNC_HOST'], int(environ['SYNC_PORT']))
-    reactor.connectTCP(environ['SYNC_HOST'], int(environ['SYNC_PORT']), factory)
+    connect_to_experiment_server(factory, environ['SYNC_HOST'], int(environ['SYNC_PORT']), environ.get('SYNC_SOCKET'))
 
     reactor.exitCode = 0
     reactor.run()
@@ -64,7 +64,7 @@ class TrustchainModule(IPv8OverlayExperimentModule):
 
     def get_peer_public_key(self, peer_id):
         # override the default implementation since we use the trustchain key here.
-        return self.all_vars[peer_id]['trustchain_public_key']
+        return self.get_peer_vars(peer_id)['trustchain_public_key']
 
     @experiment_callback
     def turn_off_broadcast(self):
@@ -0,0 +1,62 @@
+"""
+Estimation of the clock offset between a sync client and the experiment server.
+
+The client sends a number of "ping:<sequence number>:<local send time>" lines, one after the other, to which the server
+replies with "pong:<sequence number>:<local send time>:<server time>". The sample with the smallest round trip time
+is the one least affected by queueing, so it is used to calculate the offset (as in NTP, assuming a symmetric path):
+
+    offset = (send time + receive time) / 2 - server time
+    error  = round trip time / 2
+
+The result is reported to the server with "offset:<offset>:<error>".
+"""
+from time import time
+
+from twisted.internet.defer import Deferred
+
+CLOCK_SYNC_SAMPLES = 8
+
+
+class ClockOffsetEstimator(object):
+
+    def __init__(self, send_line, samples=CLOCK_SYNC_SAMPLES):
+        """
+        :param send_line: the function used to send a line to the server
+        :param samples: the number of ping/pong exchanges to perform
+        """
+        self.send_line = send_line
+        self.num_samples = samples
+        self.samples = []
+        self.offset = None
+        self.error = None
+        self.done = Deferred()
+
+    def start(self):
+        self.samples = []
+        self._send_ping()
+
+    def _send_ping(self):
+        self.send_line(b"ping:%d:%f" % (len(self.samples), time()))
+
+    def on_pong(self, line):
+        """
+        Process a pong line received from the server.
+
+        :param line: the line, including the "pong:" prefix
+        """
+        receive_time = time()
+        _, sequence_number, send_time, server_time = line.strip().split(b":")
+        if int(sequence_number) != len(self.samples):
+            return
+
+        send_time = float(send_time)
+        self.samples.append((receive_time - send_time, (send_time + receive_time) / 2 - float(server_time)))
+        if len(self.samples) < self.num_samples:
+            self._send_ping()
+            return
+
+        round_trip_time, self.offset = min(self.samples)
+        self.error = round_trip_time / 2
+        self.send_line(b"offset:%f:%f" % (self.offset, self.error))
+        if not self.done.called:
+            self.done.callback(self.offset)
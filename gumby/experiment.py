@@ -5,15 +5,26 @@ import os
 from os import chdir, environ, makedirs, path
 import sys
 from collections import Iterable
+from copy import deepcopy
 from functools import reduce  # pylint: disable=redefined-builtin
 from time import time
 
 import six
+from gumby.clock import ClockOffsetEstimator
+from gumby.framing import FRAMING_ZLIB, DocumentDecoder
 from gumby.scenario import ScenarioRunner
+from gumby.metrics_store import METRICS_FILENAME, MetricsWriter
+from gumby.scenario_trace import TRACE_FILENAME, ScenarioTraceWriter
+from gumby.stats_writer import STATS_FILENAME, StatsWriter
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred, gatherResults, succeed
+from twisted.internet.protocol import connectionDone
 from twisted.internet.threads import deferToThread
 from twisted.protocols.basic import LineReceiver
 
+# Time during which the updates of the key-value store are collected before sending them on as a single batch
+KV_BATCH_DELAY = 0.05
+
 
 def experiment_callback(name=None):
     """
@@ -44,6 +55,28 @@ def experiment_callback(name=None):
         return experiment_callback_wrapper
 
 
+# The experiment callbacks of every class that was registered, as (name, attribute name) tuples
+_experiment_callbacks = {}
+
+
+def get_experiment_callbacks(cls):
+    """
+    Returns the experiment callbacks of a class, as (name, attribute name) tuples. The members of a class are only
+    scanned the first time, after which registering an instance of it is a matter of looking up its callbacks.
+
+    :param cls: the class to scan for experiment callback decorated members
+    """
+    if cls not in _experiment_callbacks:
+        callbacks = []
+        for attribute_name in dir(cls):
+            # We have to be careful not to use the properties, as they are no callbacks anyways
+            member = getattr(cls, attribute_name, None)
+            if type(member).__name__ != "property" and callable(member) and hasattr(member, "register_as_callback"):
+                callbacks.append((member.register_as_callback, attribute_name))
+        _experiment_callbacks[cls] = callbacks
+    return _experiment_callbacks[cls]
+
+
 class ExperimentClient(LineReceiver):
     # Allow for 4MB long lines (for the json stuff)
     MAX_LENGTH = 2 ** 22
@@ -53,14 +86,38 @@ class ExperimentClient(LineReceiver):
 
         self.state = "id"
         self.my_id = None
+        self.session_token = None
+        self._ready_sent = False
+        self._vars_received_sent = False
         self.vars = my_vars
         self.all_vars = {}
+        self._peer_addresses = {}
+        self._peer_ids_by_address = {}
         self.server_vars = {}
         self.time_offset = None
+        self.time_offset_error = None
+        self.clock_estimator = ClockOffsetEstimator(self.sendLine)
+        self.peer_directory = False
+        self._all_vars_decoder = None
+        self._requests = {}
+        self._request_counter = 0
+        self._peer_vars_cache = {}
+        self._pending_lookups = {}
+        self._lookup_flush_call = None
+        self._waiting_barrier = None
+        self.kv_store = {}
+        self._kv_subscriptions = {}
+        self._kv_pending_updates = {}
+        self._kv_flush_call = None
+        self.event_handlers = {
+            b"barrier": self.on_barrier_released,
+            b"kv": self.on_kv_updates
+        }
         self.scenario_runner = ScenarioRunner()
         self.scenario_runner.preprocessor_callbacks["module"] = self._preproc_module
         self.loaded_experiment_module_classes = []
-        self._stats_file = None
+        self.stats_writer = None
+        self.metrics = None
         self.scenario_file = environ.get("SCENARIO_FILE", None)
 
         # Beware! The ordering of modules is important, specifically on calling the event handlers.
@@ -82,12 +139,42 @@ class ExperimentClient(LineReceiver):
                 self._logger.error("Scenario file %s not found", self.scenario_file)
 
     def connectionMade(self):
+        self.factory.resetDelay()
+        if self.session_token:
+            self._logger.info("Reconnected to the experiment server, resuming the session")
+            # Whatever was partially received over the previous connection will be sent again
+            self.clearLineBuffer()
+            self._all_vars_decoder = None
+            self.setLineMode()
+            self.sendLine(b"resume:%s:%s" % (self.session_token, self.state))
+            return
+
         self._logger.debug("Connected to the experiment server")
         self.sendLine(b"time:%f" % time())
+        self.sendLine(b"framing:%s" % FRAMING_ZLIB)
+        self.clock_estimator.start()
 
         self.state = "id"
 
     def lineReceived(self, line):
+        if line.startswith(b"pong:"):
+            self.clock_estimator.on_pong(line)
+            return
+        if line.startswith(b"res:"):
+            _, request_id, payload = line.strip().split(b':', 2)
+            self._requests.pop(int(request_id)).callback(json.loads(payload))
+            return
+        if line.startswith(b"evt:"):
+            _, name, payload = line.strip().split(b':', 2)
+            if name in self.event_handlers:
+                self.event_handlers[name](json.loads(payload))
+            else:
+                self._logger.error("Unknown event %s received", name)
+            return
+        if line.startswith(b"resumed:"):
+            self.on_session_resumed(line.strip().split(b':', 1)[1])
+            return
+
         try:
             pto = 'proto_' + self.state
             state_handler = getattr(self, pto)
@@ -97,10 +184,34 @@ class ExperimentClient(LineReceiver):
         else:
             self.state = state_handler(line)
             if self.state == 'done':
+                self.factory.stopTrying()
                 self.transport.loseConnection()
 
-    def on_id_received(self):
-        self.scenario_runner.set_peernumber(self.my_id)
+    def connectionLost(self, reason=connectionDone):
+        if self._waiting_barrier is not None:
+            self._logger.error("Lost the connection with the experiment server while waiting for barrier %s, "
+                               "continuing the scenario", self._waiting_barrier)
+            self._waiting_barrier = None
+            self.scenario_runner.resume()
+        LineReceiver.connectionLost(self, reason)
+
+    def rawDataReceived(self, data):
+        rest = self._all_vars_decoder.feed(data)
+        if self._all_vars_decoder.done:
+            self._logger.debug("Got compressed experiment variables")
+            document = self._all_vars_decoder.get_document()
+            self._all_vars_decoder = None
+            self.state = self.on_all_vars_document(document)
+            self.setLineMode(rest)
+
+    def open_output_dir(self):
+        """
+        Create the output directory of this peer and open the files we write to. As this registers shutdown triggers,
+        it should be called from the reactor thread, before on_id_received.
+        """
+        if 'OUTPUT_DIR' not in environ:
+            self._logger.warning("OUTPUT_DIR is not set, not writing any output")
+            return
 
         my_dir = path.join(environ['OUTPUT_DIR'], str(self.my_id))
         if path.exists(my_dir):
@@ -108,46 +219,229 @@ class ExperimentClient(LineReceiver):
         else:
             makedirs(my_dir)
         chdir(my_dir)
-        self._stats_file = open("statistics.log", 'w')
+        self.stats_writer = StatsWriter(path.join(my_dir, STATS_FILENAME), self.my_id)
+        reactor.addSystemEventTrigger("before", "shutdown", self.stats_writer.close)
+        self.metrics = MetricsWriter(path.join(my_dir, METRICS_FILENAME))
+        reactor.addSystemEventTrigger("before", "shutdown", self.metrics.close)
+        if environ.get("SCENARIO_TRACE", "True").lower() == "true":
+            self.scenario_runner.trace = ScenarioTraceWriter(path.join(my_dir, TRACE_FILENAME))
+
+    def on_id_received(self):
+        self.scenario_runner.set_peernumber(self.my_id)
 
         for module in self.experiment_modules:
             if module is not self:
                 module.on_id_received()
 
+        self.send_vars()
+
+    def send_vars(self):
         for key, val in self.vars.items():
             self.sendLine(b"set:%s:%s" % (key.encode('utf-8'), val.encode('utf-8')))
 
+    def send_ready(self):
+        self._ready_sent = True
+        self.sendLine(b"ready")
+
+    def send_vars_received(self):
+        self._vars_received_sent = True
+        self.sendLine(b"vars_received")
+
+    def on_session_resumed(self, server_state):
+        """
+        Repeat whatever the experiment server didn't receive before the connection dropped.
+
+        :param server_state: the state of the server for this subscriber, or unknown if the session couldn't be resumed
+        """
+        if server_state == b"unknown":
+            self._logger.error("The experiment server could not resume our session, giving up")
+            self.factory.stopTrying()
+            self.transport.loseConnection()
+            return
+
+        self._logger.info("Resumed the session with the experiment server")
+        if server_state == b"init":
+            if not self.clock_estimator.done.called:
+                self.clock_estimator.start()
+            self.send_vars()
+            if self._ready_sent:
+                self.send_ready()
+        elif server_state == b"vars_received" and self._vars_received_sent:
+            self.send_vars_received()
+
     def on_all_vars_received(self):
         for module in self.experiment_modules:
             if module is not self:
                 module.on_all_vars_received()
 
     def start_experiment(self):
+        # The metrics file is opened once we got our id, which the experiment server sends before the go signal
+        if self.metrics is not None:
+            self.metrics.record("experiment_start", time())
         self.scenario_runner.run()
 
-    def get_peer_id(self, ip, port):
-        port = int(port)
+    def _index_peers(self):
+        """
+        Index the addresses of the peers in all_vars in both directions, as they are looked up for every message.
+        """
+        self._peer_addresses = {}
+        self._peer_ids_by_address = {}
         for peer_id, peer_dict in self.all_vars.items():
-            if peer_dict['host'] == ip and int(peer_dict['port']) == port:
-                return peer_id
+            host = str(peer_dict['host'])
+            self._peer_addresses[peer_id] = host, peer_dict['port']
+            self._peer_ids_by_address[host, int(peer_dict['port'])] = peer_id
 
-        self._logger.error("Could not get_peer_id for %s:%s", ip, port)
+    def get_peer_id(self, ip, port):
+        peer_id = self._peer_ids_by_address.get((ip, int(port)))
+        if peer_id is None:
+            self._logger.error("Could not get_peer_id for %s:%s", ip, port)
+        return peer_id
 
     def get_peer_ip_port_by_id(self, peer_id):
-        if str(peer_id) in self.all_vars:
-            return str(self.all_vars[str(peer_id)]['host']), self.all_vars[str(peer_id)]['port']
+        return self._peer_addresses.get(str(peer_id))
 
     def get_peers(self):
         return self.all_vars.keys()
 
+    def send_event(self, name, payload):
+        """
+        Send a one-way event to the experiment server.
+
+        :param name: the kind of event
+        :param payload: the JSON serializable event arguments
+        """
+        self.sendLine(b"evt:%s:%s" % (name, json.dumps(payload)))
+
+    def on_barrier_released(self, release):
+        if release['name'] != self._waiting_barrier:
+            return
+
+        self._waiting_barrier = None
+        # The release time is expressed in the clock of the experiment server
+        self.scenario_runner.resume(release['time'] + self.time_offset)
+
+    def send_request(self, verb, payload):
+        """
+        Send a request to the experiment server.
+
+        :param verb: the kind of request
+        :param payload: the JSON serializable request arguments
+        :return: a Deferred that fires with the response of the server
+        """
+        self._request_counter += 1
+        self._requests[self._request_counter] = Deferred()
+        self.sendLine(b"req:%d:%s:%s" % (self._request_counter, verb, json.dumps(payload)))
+        return self._requests[self._request_counter]
+
+    def lookup_peer_vars(self, peer_id):
+        """
+        Get all the vars of a peer. When the experiment server runs with a peer directory, all_vars only contains the
+        host, port and time offset of the peers and the other vars are looked up in batches and cached.
+
+        :param peer_id: the id of the peer
+        :return: a Deferred that fires with the vars dictionary of the peer, or None if the peer is unknown
+        """
+        peer_id = str(peer_id)
+        if not self.peer_directory:
+            return succeed(self.all_vars.get(peer_id))
+        if peer_id in self._peer_vars_cache:
+            return succeed(self._peer_vars_cache[peer_id])
+
+        d = Deferred()
+        self._pending_lookups.setdefault(peer_id, []).append(d)
+        if not self._lookup_flush_call:
+            self._lookup_flush_call = reactor.callLater(0, self._flush_lookups)
+        return d
+
+    def get_known_peer_vars(self, peer_id):
+        """
+        Get all the vars of a peer without waiting for the experiment server. When the experiment server runs with a
+        peer directory, the vars of the peer should have been looked up with lookup_peer_vars before.
+
+        :param peer_id: the id of the peer
+        :return: the vars dictionary of the peer
+        :raises KeyError: if the vars of the peer are not known
+        """
+        peer_id = str(peer_id)
+        if not self.peer_directory:
+            return self.all_vars[peer_id]
+        if self._peer_vars_cache.get(peer_id) is None:
+            raise KeyError("The vars of peer %s are not known, as the experiment server runs with a peer directory. "
+                           "Look them up with lookup_peer_vars first." % peer_id)
+        return self._peer_vars_cache[peer_id]
+
+    def _flush_lookups(self):
+        self._lookup_flush_call = None
+        pending_lookups, self._pending_lookups = self._pending_lookups, {}
+
+        def on_response(peers_vars):
+            for peer_id, deferreds in pending_lookups.items():
+                self._peer_vars_cache[peer_id] = peers_vars.get(peer_id)
+                for d in deferreds:
+                    d.callback(self._peer_vars_cache[peer_id])
+
+        self.send_request(b"lookup", list(pending_lookups.keys())).addCallback(on_response)
+
+    def kv_publish(self, key, value):
+        """
+        Publish a value in the experiment wide key-value store. The updates are sent to the experiment server in
+        batches.
+
+        :param key: the key
+        :param value: the JSON serializable value
+        """
+        self._kv_pending_updates[key] = value
+        if not self._kv_flush_call:
+            self._kv_flush_call = reactor.callLater(KV_BATCH_DELAY, self._flush_kv_updates)
+
+    def _flush_kv_updates(self):
+        self._kv_flush_call = None
+        updates, self._kv_pending_updates = self._kv_pending_updates, {}
+        self.send_event(b"kv", {"updates": updates})
+
+    def kv_subscribe(self, prefix, callback=None):
+        """
+        Subscribe to the keys of the experiment wide key-value store starting with a prefix. The values of these keys
+        are kept up to date in kv_store.
+
+        :param prefix: the key prefix
+        :param callback: (optional) a function called with the key and value of every update under the prefix
+        :return: a Deferred that fires with a dictionary of the current values under the prefix
+        """
+        self._kv_subscriptions.setdefault(prefix, [])
+        if callback:
+            self._kv_subscriptions[prefix].append(callback)
+
+        def on_snapshot(values):
+            self.kv_store.update(values)
+            return values
+        return self.send_request(b"kv_subscribe", {"prefix": prefix}).addCallback(on_snapshot)
+
+    def kv_get(self, key, default=None):
+        """
+        Get the latest known value of a key we are subscribed to.
+        """
+        return self.kv_store.get(key, default)
+
+    def on_kv_updates(self, publication):
+        # The updates relayed to us can include keys that other peers subscribed to
+        for key, value in publication['updates'].items():
+            prefixes = [prefix for prefix in self._kv_subscriptions if key.startswith(prefix)]
+            if not prefixes:
+                continue
+            self.kv_store[key] = value
+            for prefix in prefixes:
+                for callback in self._kv_subscriptions[prefix]:
+                    callback(key, value)
+
     #
     # Protocol state handlers
     #
 
     def proto_id(self, line):
         # We should get a line such as:
-        # id:SOMETHING
-        maybe_id, id = line.strip().split(b':', 1)
+        # id:SOMETHING:SESSION_TOKEN
+        maybe_id, id, self.session_token = (line.strip().split(b':', 2) + [None])[:3]
         if maybe_id == b"id":
             if "PEER_ID" in os.environ:
                 self.my_id = int(os.environ["PEER_ID"])
@@ -155,31 +449,50 @@ class ExperimentClient(LineReceiver):
                 self.my_id = int(id)
 
             self._logger.debug('Got assigned id: %s', self.my_id)
-            d = deferToThread(self.on_id_received)
-            d.addCallback(lambda _: self.sendLine(b"ready"))
+            self.open_output_dir()
+            # Our clock offset has to be reported before we're ready
+            d = gatherResults([deferToThread(self.on_id_received), self.clock_estimator.done])
+            d.addCallback(lambda _: self.send_ready())
             return "all_vars"
         else:
             self._logger.error("Received an unexpected string from the server, closing connection")
             return "done"
 
     def proto_all_vars(self, line):
+        if line.startswith(b"blob:"):
+            # The document follows as compressed raw data
+            self._all_vars_decoder = DocumentDecoder(int(line.strip().split(b":")[1]))
+            self.setRawMode()
+            return "all_vars"
+
         self._logger.debug("Got experiment variables")
+        return self.on_all_vars_document(line)
 
+    def on_all_vars_document(self, document):
         with open("all_vars.txt", "wb") as output_file:
-            output_file.write(line)
+            output_file.write(document)
 
-        all_vars = json.loads(line)
+        all_vars = json.loads(document)
         self.all_vars = all_vars["clients"]
         self.server_vars = all_vars["server"]
+        self.peer_directory = self.server_vars.get("directory", False)
+        if self.peer_directory:
+            self._logger.warning("The experiment server runs with a peer directory, all_vars only holds the host, port "
+                                 "and time offset of the peers. The other vars should be looked up with "
+                                 "lookup_peer_vars.")
         if "PEER_ID" in os.environ:
             # this is a self service run, i.e. debugging a specific gumby experiment (hopefully in an IDE)
             # and since the my_id var was explicitly set it won't match what the server sent... so let's fix that
             self.all_vars[str(self.my_id)] = self.all_vars["0"]
 
+        self._index_peers()
         self.time_offset = self.all_vars[str(self.my_id)]["time_offset"]
+        self.time_offset_error = self.all_vars[str(self.my_id)].get("time_offset_error")
+        self.scenario_runner.peer_count = len(self.all_vars)
+        self.scenario_runner.random_seed = self.server_vars.get("global_random")
         self.on_all_vars_received()
 
-        self.sendLine(b"vars_received")
+        self.send_vars_received()
         return "go"
 
     def proto_go(self, line):
@@ -189,29 +502,28 @@ class ExperimentClient(LineReceiver):
             self._logger.info("Starting the experiment in %f secs.", start_delay)
             reactor.callLater(start_delay, self.start_experiment)
             self.factory.stopTrying()
+            if self.server_vars.get("persistent", False):
+                # Keep the connection open for requests to the experiment server
+                return "running"
             self.transport.loseConnection()
 
+    def proto_running(self, line):
+        self._logger.error("Received an unexpected string from the server: %s", line)
+        return "running"
+
     def register(self, target):
         """
-        Takes an object (usually an instance of ExperimentModule) and scans it for members that have the
-        experiment_callback decorator applied. Any such members will be registered with the scenario runner.
+        Takes an object (usually an instance of ExperimentModule) and registers the members of its class that have the
+        experiment_callback decorator applied with the scenario runner.
 
-        :param target: The object to scan for experiment callback decorated members.
+        :param target: The object of which to register the experiment callback decorated members.
         """
         if target in self.experiment_modules:
             return
         self.experiment_modules.append(target)
 
-        # We have to be careful not to getattr on members that are @property decorated. Besides them not being
-        # callbacks anyways, they trigger the python descriptors that invoke the @property magic. We would invoke the
-        # getter. So we filter the contents of our target.
-        member_names = [name for name in dir(target) if type(getattr(target.__class__, name, None)).__name__ !=
-                        "property"]
-        for member in [getattr(target, key) for key in member_names]:
-            if not (callable(member) and hasattr(member, "register_as_callback")):
-                continue
-            else:
-                self.scenario_runner.register(member, name=member.register_as_callback)
+        for name, attribute_name in get_experiment_callbacks(target.__class__):
+            self.scenario_runner.register(getattr(target, attribute_name), name=name)
 
     @experiment_callback
     def echo(self, *argv):
@@ -219,11 +531,39 @@ class ExperimentClient(LineReceiver):
 
     @experiment_callback
     def annotate(self, message):
-        self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, "annotate", message))
+        self.stats_writer.record("annotate", message)
 
     @experiment_callback
     def peertype(self, peer_type):
-        self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, "peertype", peer_type))
+        self.stats_writer.record("peertype", peer_type)
+
+    @experiment_callback
+    def barrier(self, name, timeout=None, quorum=None):
+        """
+        Hold the remaining scenario events until all peers (or a quorum of them) have arrived at the barrier with the
+        same name, after which all of them continue at the same time.
+
+        :param name: the name of the barrier.
+        :param timeout: (optional) the number of seconds after the first peer arrived to release the barrier anyway.
+        :param quorum: (optional) the number of peers that should arrive, or the fraction of peers if smaller than 1.
+        """
+        if not self.server_vars.get("persistent", False):
+            self._logger.error("Barrier %s requires a persistent connection with the experiment server", name)
+            return
+
+        self._logger.info("Arrived at barrier %s", name)
+        self._waiting_barrier = name
+        self.scenario_runner.pause()
+        self.send_event(b"barrier", {"name": name, "id": self.my_id,
+                                     "timeout": float(timeout) if timeout else None,
+                                     "quorum": float(quorum) if quorum else None})
+
+    @experiment_callback
+    def publish(self, key, value):
+        """
+        Publish a value in the experiment wide key-value store.
+        """
+        self.kv_publish(key, value)
 
     @experiment_callback
     def stop(self):
@@ -275,14 +615,14 @@ class ExperimentClient(LineReceiver):
 
                         new_values[key] = value
                         if prev_dict.get(key, None) != value:
-                            changed_values[key] = value
+                            # The changes are written by another thread, so they should not change in the meantime
+                            changed_values[key] = value if isinstance(value, six.string_types) else deepcopy(value)
 
             return new_values, changed_values
 
         new_values, changed_values = get_changed_values(prev_dict, cur_dict)
         if changed_values:
-            self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, name, json.dumps(changed_values)))
-            self._stats_file.flush()
+            self.stats_writer.record(name, changed_values)
             return new_values
         return prev_dict
 
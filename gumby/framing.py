@@ -0,0 +1,62 @@
+"""
+Framing of the experiment variables document sent by the experiment server.
+
+Subscribers that announce "framing:zlib" receive the document as a "blob:<length>" line followed by <length> bytes of
+zlib compressed data, instead of a single (length limited) JSON line. The document is compressed once and the same
+chunks are written to every subscriber.
+"""
+import zlib
+
+FRAMING_ZLIB = b"zlib"
+BLOB_CHUNK_SIZE = 2 ** 16
+
+
+def compress_document(document, chunk_size=BLOB_CHUNK_SIZE):
+    """
+    Compress a document and split it into chunks that can be written to the transports one by one.
+
+    :param document: the serialized document
+    :param chunk_size: the maximum size of a chunk
+    :return: a list with the compressed chunks
+    """
+    compressed = zlib.compress(document)
+    return [compressed[offset:offset + chunk_size] for offset in range(0, len(compressed), chunk_size)]
+
+
+class DocumentDecoder(object):
+    """
+    Decodes a compressed document as it is being received.
+    """
+
+    def __init__(self, length, keep_compressed=False):
+        """
+        :param length: the length of the compressed document
+        :param keep_compressed: whether to keep the compressed chunks around, to forward them
+        """
+        self.remaining = length
+        self.compressed_chunks = [] if keep_compressed else None
+        self._decompressor = zlib.decompressobj()
+        self._parts = []
+
+    @property
+    def done(self):
+        return self.remaining <= 0
+
+    def feed(self, data):
+        """
+        Feed received data into the decoder.
+
+        :param data: the received data
+        :return: the data following the end of the document, if any
+        """
+        chunk, rest = data[:self.remaining], data[self.remaining:]
+        self.remaining -= len(chunk)
+        if self.compressed_chunks is not None:
+            self.compressed_chunks.append(chunk)
+        self._parts.append(self._decompressor.decompress(chunk))
+        if self.done:
+            self._parts.append(self._decompressor.flush())
+        return rest
+
+    def get_document(self):
+        return b"".join(self._parts)
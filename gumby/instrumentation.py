@@ -68,15 +68,13 @@ MANHOLE_PORT = int(environ.get("MANHOLE_PORT", 2323))
 manhole = None
 manhole_namespace = {}
 
-PID = getpid()
-
 logger = logging.getLogger()
 
 def init_instrumentation():
     """
     Instrumentation initializer, starts the components enabled trough config options
     """
-    if PROFILE_MEMORY and PROFILE_MEMORY_PID_MODULO and (PID % PROFILE_MEMORY_PID_MODULO == 0):
+    if PROFILE_MEMORY and PROFILE_MEMORY_PID_MODULO and (getpid() % PROFILE_MEMORY_PID_MODULO == 0):
         start_memory_dumper()
 
     if MANHOLE_ENABLE:
@@ -91,7 +89,7 @@ def start_memory_dumper():
     from meliae import scanner
     # Setup the whole thing
     start = time()
-    memdump_dir = path.join(environ["OUTPUT_DIR"], "memprof", str(PID))
+    memdump_dir = path.join(environ["OUTPUT_DIR"], "memprof", str(getpid()))
     makedirs(memdump_dir)
     meliae_out_file = path.join(memdump_dir, "memory-%06.2f.out")
     objgraph_out_file = path.join(memdump_dir, "objgraph-%s-%06.2f-%d.png")
@@ -7,14 +7,23 @@ from logging import debug, warning
 from os import environ, path
 from sys import argv, path as python_path
 
+from gumby.zygote import fork_instances, get_zygote_instances, install_zygote_reactor, preload_scenario
+
+if get_zygote_instances():
+    install_zygote_reactor()
+
 from twisted.internet import reactor
 
 from gumby.instrumentation import init_instrumentation
 from gumby.log import setupLogging
-from gumby.sync import ExperimentClientFactory, ExperimentServiceFactory
+from gumby.sync import (ExperimentClientFactory, ExperimentServiceFactory, connect_to_experiment_server,
+                        listen_for_subscribers)
 
 
 # @CONF_OPTION SCENARIO_FILE: The scenario to run for this experiment (default: None)
+# @CONF_OPTION SCENARIO_CACHE_DIR: Directory where the scenario is compiled once for all the instances on a host, empty to disable. (default: the temp dir)
+# @CONF_OPTION SCENARIO_TRACE: Record the timing of every scenario event in scenario_trace.bin in the output directory of each instance. (default: True)
+# @CONF_OPTION SYNC_SOCKET: Connect to the experiment server through this unix domain socket if it exists. (default: None)
 
 def main(self_service=False):
     """
@@ -73,6 +82,13 @@ def main(self_service=False):
     if environ["IPV8_DIR"] not in python_path:
         python_path.append(environ["IPV8_DIR"])
 
+    instances = get_zygote_instances()
+    if instances:
+        preload_scenario(environ["SCENARIO_FILE"])
+        exit_code = fork_instances(instances)
+        if exit_code is not None:
+            exit(exit_code)
+
     init_instrumentation()
     setupLogging()
     if not path.exists(environ["SCENARIO_FILE"]):
@@ -94,11 +110,11 @@ def main(self_service=False):
         fact = ExperimentServiceFactory(1, 0)
         # need to monkey patch this one or it will kill the reactor.
         fact.onExperimentStarted = exp_started
-        reactor.listenTCP(int(environ['SYNC_PORT']), fact)
+        listen_for_subscribers(fact, int(environ['SYNC_PORT']), environ.get('SYNC_SOCKET'))
 
     debug("Connecting to: %s:%s", environ['SYNC_HOST'], int(environ['SYNC_PORT']))
-    reactor.callLater(random.randint(1, 5), reactor.connectTCP,
-                      environ['SYNC_HOST'], int(environ['SYNC_PORT']), ExperimentClientFactory())
+    reactor.callLater(random.randint(1, 5), connect_to_experiment_server, ExperimentClientFactory(),
+                      environ['SYNC_HOST'], int(environ['SYNC_PORT']), environ.get('SYNC_SOCKET'))
     reactor.run()
     exit(reactor.exitCode)
 
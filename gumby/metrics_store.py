@@ -0,0 +1,266 @@
+"""
+A compact, indexed store for the metrics of a peer.
+
+Every peer appends the metrics recorded by the experiment modules to a single binary file, rather than to a text file
+per module. The records of a metric are buffered and written as blocks of a single metric, so that a parser can read
+one metric, or one period of it, without reading the records of all the others.
+
+The file starts with a header, MAGIC (4s) and version (B), followed by blocks that start with their kind (B):
+
+    name block:  kind 0, metric id (H), length of the name (H), the name (utf-8)
+    data block:  kind 1 (numeric values) or 2 (JSON values), metric id (H), number of records (I),
+                 length of the payload (I), first timestamp (d), last timestamp (d), payload
+    index block: kind 3, length of the payload (I), payload
+
+The payload of a data block holds the timestamps (d) of its records, followed by their values: doubles (d) for numeric
+values or length prefixed (I) JSON documents otherwise. Every name block precedes the data blocks of its metric.
+
+When the writer is closed, the index block and a trailer, the offset of the index block (Q) and MAGIC (4s), are appended.
+The index is a JSON document with the names of the metrics and, per metric, the offset, first and last timestamp and
+number of records of its data blocks. Without a trailer, as the experiment was killed before, the reader builds the index
+by skipping from block header to block header.
+"""
+import json
+from struct import Struct
+from time import time
+
+import six
+
+METRICS_FILENAME = "metrics.bin"
+METRICS_MAGIC = b"GMET"
+METRICS_VERSION = 1
+
+FILE_HEADER = Struct("!4sB")
+BLOCK_KIND = Struct("!B")
+NAME_BLOCK = Struct("!HH")
+DATA_BLOCK = Struct("!HIIdd")
+INDEX_BLOCK = Struct("!I")
+TRAILER = Struct("!Q4s")
+JSON_LENGTH = Struct("!I")
+
+NAME_KIND = 0
+NUMERIC_KIND = 1
+JSON_KIND = 2
+INDEX_KIND = 3
+
+# Write the records of a metric once it has this many of them...
+METRICS_BLOCK_RECORDS = 512
+# ... or once the metrics were last written this many seconds ago
+METRICS_FLUSH_INTERVAL = 5.0
+
+
+def is_numeric(value):
+    return isinstance(value, six.integer_types + (float,)) and not isinstance(value, bool)
+
+
+class MetricsWriter(object):
+    """
+    Appends the metrics of a peer to its metrics file.
+    """
+
+    def __init__(self, filename, block_records=METRICS_BLOCK_RECORDS, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.filename = filename
+        self.block_records = block_records
+        self.flush_interval = flush_interval
+        self._metrics_file = open(filename, "wb")
+        self._metrics_file.write(FILE_HEADER.pack(METRICS_MAGIC, METRICS_VERSION))
+        self._metric_ids = {}
+        self._names = []
+        self._pending_records = {}
+        self._blocks = {}
+        self._last_flush = time()
+
+    def record(self, name, value, timestamp=None):
+        """
+        Record a value of a metric.
+
+        :param name: the name of the metric
+        :param value: a number, or any other JSON serializable value
+        :param timestamp: the time of the value, defaults to now
+        """
+        if self._metrics_file is None:
+            return
+
+        now = time()
+        if name not in self._metric_ids:
+            self._metric_ids[name] = metric_id = len(self._names)
+            self._names.append(name)
+            self._pending_records[metric_id] = []
+            self._blocks[metric_id] = []
+            encoded_name = name.encode("utf-8")
+            self._metrics_file.write(BLOCK_KIND.pack(NAME_KIND) + NAME_BLOCK.pack(metric_id, len(encoded_name)) +
+                                     encoded_name)
+
+        metric_id = self._metric_ids[name]
+        records = self._pending_records[metric_id]
+        records.append((now if timestamp is None else timestamp, value))
+        if len(records) >= self.block_records:
+            self._write_records(metric_id)
+        if now - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _write_records(self, metric_id):
+        records = self._pending_records[metric_id]
+        self._pending_records[metric_id] = []
+
+        # A block holds either numeric or JSON values, so a metric that has both is split in several blocks
+        start = 0
+        while start < len(records):
+            numeric = is_numeric(records[start][1])
+            end = start + 1
+            while end < len(records) and is_numeric(records[end][1]) == numeric:
+                end += 1
+            self._write_block(metric_id, records[start:end], numeric)
+            start = end
+
+    def _write_block(self, metric_id, records, numeric):
+        timestamps = [timestamp for timestamp, _ in records]
+        payload = Struct("!%dd" % len(records)).pack(*timestamps)
+        if numeric:
+            payload += Struct("!%dd" % len(records)).pack(*[value for _, value in records])
+        else:
+            for _, value in records:
+                document = json.dumps(value).encode("utf-8")
+                payload += JSON_LENGTH.pack(len(document)) + document
+
+        first, last = min(timestamps), max(timestamps)
+        self._blocks[metric_id].append((self._metrics_file.tell(), first, last, len(records)))
+        self._metrics_file.write(BLOCK_KIND.pack(NUMERIC_KIND if numeric else JSON_KIND) +
+                                 DATA_BLOCK.pack(metric_id, len(records), len(payload), first, last) + payload)
+
+    def flush(self):
+        """
+        Write the buffered records of all metrics to the metrics file.
+        """
+        if self._metrics_file is None:
+            return
+        for metric_id, records in self._pending_records.items():
+            if records:
+                self._write_records(metric_id)
+        self._metrics_file.flush()
+        self._last_flush = time()
+
+    def close(self):
+        """
+        Write the buffered records and the index, and close the metrics file.
+        """
+        if self._metrics_file is None:
+            return
+        self.flush()
+
+        index_offset = self._metrics_file.tell()
+        index = json.dumps({"names": self._names,
+                            "blocks": dict((str(metric_id), blocks) for metric_id, blocks in self._blocks.items())})
+        index = index.encode("utf-8")
+        self._metrics_file.write(BLOCK_KIND.pack(INDEX_KIND) + INDEX_BLOCK.pack(len(index)) + index +
+                                 TRAILER.pack(index_offset, METRICS_MAGIC))
+        self._metrics_file.close()
+        self._metrics_file = None
+
+
+class MetricsReader(object):
+    """
+    Reads the metrics of a peer from its metrics file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._metrics_file = open(filename, "rb")
+        magic, version = FILE_HEADER.unpack(self._metrics_file.read(FILE_HEADER.size))
+        if magic != METRICS_MAGIC or version != METRICS_VERSION:
+            self._metrics_file.close()
+            raise ValueError("%s is not a metrics file of version %d" % (filename, METRICS_VERSION))
+
+        self.names = []
+        self._blocks = {}
+        if not self._read_index():
+            self._scan_blocks()
+
+    def _read_index(self):
+        self._metrics_file.seek(0, 2)
+        file_size = self._metrics_file.tell()
+        if file_size < FILE_HEADER.size + TRAILER.size:
+            return False
+        self._metrics_file.seek(file_size - TRAILER.size)
+        index_offset, magic = TRAILER.unpack(self._metrics_file.read(TRAILER.size))
+        if magic != METRICS_MAGIC:
+            return False
+
+        self._metrics_file.seek(index_offset + BLOCK_KIND.size)
+        length, = INDEX_BLOCK.unpack(self._metrics_file.read(INDEX_BLOCK.size))
+        index = json.loads(self._metrics_file.read(length).decode("utf-8"))
+        self.names = index["names"]
+        self._blocks = dict((self.names[int(metric_id)], blocks) for metric_id, blocks in index["blocks"].items())
+        return True
+
+    def _scan_blocks(self):
+        self._metrics_file.seek(FILE_HEADER.size)
+        while True:
+            offset = self._metrics_file.tell()
+            data = self._metrics_file.read(BLOCK_KIND.size)
+            if not data:
+                break
+            kind, = BLOCK_KIND.unpack(data)
+            if kind == NAME_KIND:
+                data = self._metrics_file.read(NAME_BLOCK.size)
+                if len(data) < NAME_BLOCK.size:
+                    break
+                _, length = NAME_BLOCK.unpack(data)
+                name = self._metrics_file.read(length)
+                if len(name) < length:
+                    break
+                self.names.append(name.decode("utf-8"))
+                self._blocks[self.names[-1]] = []
+            elif kind in (NUMERIC_KIND, JSON_KIND):
+                data = self._metrics_file.read(DATA_BLOCK.size)
+                if len(data) < DATA_BLOCK.size:
+                    break
+                metric_id, count, length, first, last = DATA_BLOCK.unpack(data)
+                # A block that was cut short when the experiment was killed is ignored
+                if len(self._metrics_file.read(length)) < length:
+                    break
+                self._blocks[self.names[metric_id]].append((offset, first, last, count))
+            else:
+                break
+
+    def read(self, name, start=None, end=None):
+        """
+        Read the records of a metric, optionally only those between start and end.
+
+        :param name: the name of the metric
+        :param start: (optional) the earliest timestamp to read
+        :param end: (optional) the latest timestamp to read
+        :return: a generator of (timestamp, value) tuples, in the order in which they were recorded
+        """
+        for offset, first, last, count in self._blocks.get(name, []):
+            if (start is not None and last < start) or (end is not None and first > end):
+                continue
+
+            self._metrics_file.seek(offset)
+            kind, = BLOCK_KIND.unpack(self._metrics_file.read(BLOCK_KIND.size))
+            _, _, length, _, _ = DATA_BLOCK.unpack(self._metrics_file.read(DATA_BLOCK.size))
+            payload = self._metrics_file.read(length)
+            timestamps = Struct("!%dd" % count).unpack_from(payload)
+            if kind == NUMERIC_KIND:
+                values = Struct("!%dd" % count).unpack_from(payload, 8 * count)
+            else:
+                values = []
+                position = 8 * count
+                for _ in range(count):
+                    document_length, = JSON_LENGTH.unpack_from(payload, position)
+                    position += JSON_LENGTH.size
+                    values.append(json.loads(payload[position:position + document_length].decode("utf-8")))
+                    position += document_length
+
+            for timestamp, value in zip(timestamps, values):
+                if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+                    yield timestamp, value
+
+    def close(self):
+        self._metrics_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -1,6 +1,8 @@
 from base64 import b64encode, b64decode
 from random import sample
 
+from twisted.internet.defer import gatherResults
+
 from gumby.experiment import experiment_callback
 from gumby.modules.experiment_module import ExperimentModule
 from gumby.util import generate_keypair_trustchain, save_keypair_trustchain, save_pub_key_trustchain
@@ -27,6 +29,7 @@ class IPv8OverlayExperimentModule(ExperimentModule):
             'EdgeWalk': EdgeWalk,
             'RandomChurn': RandomChurn
         }
+        self._peer_keys = {}
 
     @property
     def ipv8_provider(self):
@@ -92,6 +95,7 @@ class IPv8OverlayExperimentModule(ExperimentModule):
     @experiment_callback
     def introduce_one_peer(self, peer_id):
         self.overlay.walk_to(self.experiment.get_peer_ip_port_by_id(peer_id))
+        return self.prefetch_peers([peer_id])
 
     @experiment_callback
     def introduce_peers(self, max_peers=None, excluded_peers=None):
@@ -110,16 +114,28 @@ class IPv8OverlayExperimentModule(ExperimentModule):
 
         if not max_peers:
             # bootstrap the peer introduction, ensuring everybody knows everybody to start off with.
-            for peer_id in self.all_vars.keys():
-                if int(peer_id) != self.my_id and int(peer_id) not in excluded_peers_list:
-                    self.overlay.walk_to(self.experiment.get_peer_ip_port_by_id(peer_id))
+            peer_ids = [peer_id for peer_id in self.all_vars.keys()
+                        if int(peer_id) != self.my_id and int(peer_id) not in excluded_peers_list]
         else:
             # Walk to a number of peers
             eligible_peers = [peer_id for peer_id in self.all_vars.keys()
                               if int(peer_id) not in excluded_peers_list and int(peer_id) != self.my_id]
-            rand_peer_ids = sample(eligible_peers, int(max_peers))
-            for rand_peer_id in rand_peer_ids:
-                self.overlay.walk_to(self.experiment.get_peer_ip_port_by_id(rand_peer_id))
+            peer_ids = sample(eligible_peers, int(max_peers))
+        for peer_id in peer_ids:
+            self.overlay.walk_to(self.experiment.get_peer_ip_port_by_id(peer_id))
+        return self.prefetch_peers(peer_ids)
+
+    def prefetch_peers(self, peer_ids):
+        """
+        Make sure that get_peer can be used for the given peers. When the experiment server runs with a peer directory,
+        their public keys are looked up in a single request.
+
+        :param peer_ids: the ids of the peers
+        :return: a Deferred that fires once the peers are known, or None if they are known already
+        """
+        if not self.experiment.peer_directory:
+            return None
+        return gatherResults([self.experiment.lookup_peer_vars(peer_id) for peer_id in peer_ids])
 
     @experiment_callback
     def add_walking_strategy(self, name, max_peers, **kwargs):
@@ -132,12 +148,28 @@ class IPv8OverlayExperimentModule(ExperimentModule):
         self.session.lm.ipv8.strategies.append((strategy(self.overlay, **kwargs), max_peers))
 
     def get_peer(self, peer_id):
+        """
+        Returns a new Peer for the given peer id, which the caller is free to change. When the experiment server runs
+        with a peer directory, the peer should have been introduced or prefetched (see prefetch_peers) first.
+        """
         target = self.all_vars[peer_id]
         address = (str(target['host']), target['port'])
-        return Peer(b64decode(self.get_peer_public_key(peer_id)), address=address)
+        # Decoding the public key is expensive, so every key is only decoded once
+        if peer_id not in self._peer_keys:
+            self._peer_keys[peer_id] = Peer(b64decode(self.get_peer_public_key(peer_id))).key
+        return Peer(self._peer_keys[peer_id], address=address)
+
+    def get_peer_vars(self, peer_id):
+        """
+        Returns all the vars of a peer, like its public key, which are only known for the prefetched peers when the
+        experiment server runs with a peer directory.
+
+        :raises KeyError: if the vars of the peer are not known
+        """
+        return self.experiment.get_known_peer_vars(peer_id)
 
     def get_peer_public_key(self, peer_id):
-        return self.all_vars[peer_id][b'public_key']
+        return self.get_peer_vars(peer_id)[b'public_key']
 
     def on_id_received(self):
         # Since the IPv8 source module is loaded before any community module, the IPv8 on_id_received has
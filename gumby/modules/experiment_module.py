@@ -67,6 +67,20 @@ class ExperimentModule(object):
         with open('autoplot/%s.csv' % statistic_name, 'a') as output_file:
             output_file.write("%f,%d,%d\n" % (time.time(), self.my_id, value))
 
+    def record_metric(self, name, value, timestamp=None):
+        """
+        Record a value of a metric in the metrics file of this peer, which can be read with
+        `StatisticsParser.yield_metric`.
+
+        :param name: the name of the metric
+        :type name: str
+        :param value: the value of the metric, numbers are stored most compactly
+        :param timestamp: the time of the value (or None to use the current time)
+        :type timestamp: float or None
+        :returns: None
+        """
+        self.experiment.metrics.record(name, value, timestamp)
+
     def on_id_received(self):
         """
         The experiment node has been assigned it's ID. After all the handlers for this event are completed the Vars
@@ -46,12 +46,154 @@
 
 import logging
 import shlex
-from os import environ, path
+from bisect import bisect_right
+from collections import deque
+from fcntl import LOCK_EX, LOCK_SH, flock
+from hashlib import sha1
+from heapq import heappop, heappush, merge
+from itertools import count
+from os import environ, getpid, getuid, path, rename
+from random import Random
 from re import compile as re_compile
+from struct import Struct
+from tempfile import gettempdir
 from threading import RLock
 from time import time
 
+from six.moves import cPickle as pickle, xrange
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList
+
+# Bumped whenever the format of the compiled scenarios, or the way they are compiled, changes
+SCENARIO_CACHE_VERSION = 2
+INDEX_OFFSET_STRUCT = Struct("!Q")
+
+# Records the intended and actual times of the calls of the workloads in a scenario
+WORKLOAD_FILENAME = "workload.log"
+
+
+class ScenarioVariables(dict):
+    """
+    The user defined variables of a scenario. Every variable has a version that changes whenever it is set, so that
+    the lines using it are only expanded again after it changed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ScenarioVariables, self).__init__(*args, **kwargs)
+        self._version_counter = count(1)
+        self.versions = {}
+
+    def __setitem__(self, name, value):
+        super(ScenarioVariables, self).__setitem__(name, value)
+        self.versions[name] = next(self._version_counter)
+
+    def __delitem__(self, name):
+        super(ScenarioVariables, self).__delitem__(name)
+        self.versions[name] = next(self._version_counter)
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+
+class PeerRanges(object):
+    """
+    A set of peer numbers stored as sorted, non-overlapping ranges, so that membership can be checked with a binary
+    search regardless of the number of peers in the ranges.
+    """
+
+    def __init__(self, ranges=()):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(ranges):
+            if start > end:
+                continue
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __contains__(self, peernumber):
+        index = bisect_right(self.starts, peernumber) - 1
+        return index >= 0 and peernumber <= self.ends[index]
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in zip(self.starts, self.ends))
+
+    def count_within(self, low, high):
+        """
+        Returns the number of peers in these ranges between low and high (inclusive).
+        """
+        return sum(max(0, min(end, high) - max(start, low) + 1) for start, end in zip(self.starts, self.ends))
+
+    def __nonzero__(self):
+        return bool(self.starts)
+
+    __bool__ = __nonzero__
+
+    def __eq__(self, other):
+        return isinstance(other, PeerRanges) and self.starts == other.starts and self.ends == other.ends
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "PeerRanges(%r)" % list(zip(self.starts, self.ends))
+
+
+class ArrivalProcess(object):
+    """
+    Generates the intended times of the calls of an open-loop workload. The times between the calls are drawn from a
+    distribution with an average of 1 / rate, regardless of when the previous calls were actually made:
+     - poisson: exponentially distributed, as the arrivals of independent clients;
+     - uniform: uniformly distributed between 0 and 2 / rate;
+     - zipf: a multiple of a small base time, Zipf distributed, causing bursts of calls separated by long pauses.
+    """
+
+    DISTRIBUTIONS = ("poisson", "uniform", "zipf")
+    ZIPF_EXPONENT = 1.5
+    ZIPF_MAX_MULTIPLE = 1000
+    _zipf_cumulative_weights = None
+
+    def __init__(self, begin, end, rate, distribution, random):
+        self.time = begin
+        self.end = end
+        self.rate = rate
+        self.random = random
+        self._draw_gap = getattr(self, "_%s_gap" % distribution)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.time += self._draw_gap()
+        if self.end is not None and self.time > self.end:
+            raise StopIteration()
+        return self.time
+
+    next = __next__
+
+    def _poisson_gap(self):
+        return self.random.expovariate(self.rate)
+
+    def _uniform_gap(self):
+        return self.random.uniform(0, 2.0 / self.rate)
+
+    def _zipf_gap(self):
+        if ArrivalProcess._zipf_cumulative_weights is None:
+            cumulative_weights = []
+            total_weight = mean_multiple = 0.0
+            for multiple in xrange(1, self.ZIPF_MAX_MULTIPLE + 1):
+                total_weight += multiple ** -self.ZIPF_EXPONENT
+                mean_multiple += multiple ** (1 - self.ZIPF_EXPONENT)
+                cumulative_weights.append(total_weight)
+            ArrivalProcess._zipf_cumulative_weights = cumulative_weights
+            ArrivalProcess._zipf_mean_multiple = mean_multiple / total_weight
+
+        multiple = bisect_right(self._zipf_cumulative_weights,
+                                self.random.random() * self._zipf_cumulative_weights[-1]) + 1
+        return min(multiple, self.ZIPF_MAX_MULTIPLE) / (self._zipf_mean_multiple * self.rate)
 
 
 class ScenarioParser(object):
@@ -79,6 +221,44 @@ class ScenarioParser(object):
             Moreover, if the PEERSPEC starts with an !, the event will apply
             for all peers except those specified.
 
+    Recurring event format:
+        TIMESPEC every INTERVAL [jitter=JITTER] CALLABLE [ARGS] [PEERSPEC]
+
+            Calls CALLABLE every INTERVAL seconds, from the start of TIMESPEC
+            until its end if it is a range, or until the experiment ends.
+            Every call is delayed by a random number of seconds up to JITTER,
+            to keep peers from calling it at the same moment.
+
+            Example: "@0:10-5:00 every 0.5 jitter=0.1 ping {1-10}"
+
+    Workload format:
+        TIMESPEC rate RATE [distribution=DISTRIBUTION] [scope=SCOPE] CALLABLE [ARGS] [PEERSPEC]
+
+            Calls CALLABLE at an average of RATE calls per second, from the
+            start of TIMESPEC until its end if it is a range. The times between
+            the calls are drawn from DISTRIBUTION (poisson, uniform or zipf),
+            independently of how long the calls take. The RATE is per peer,
+            or shared by all the peers of the PEERSPEC if SCOPE is global.
+
+            Example: "@1:00-2:00 rate 1000 scope=global request_signature"
+
+    Dependent event format:
+        after:LABEL[+DELAY] CALLABLE [ARGS] [PEERSPEC]
+
+            Calls CALLABLE DELAY seconds after all the events of this peer
+            labeled LABEL completed. An event is labeled with the named
+            argument as=LABEL, and completes once the Deferreds returned by
+            its callables have fired.
+
+            Example: "@0:10 start_session as=session" followed by
+                     "after:session+5 introduce_peers"
+
+    Directives:
+        &max_in_flight CALLABLE LIMIT
+
+            Limits the number of calls of CALLABLE of which the Deferred has
+            not fired yet. Further calls are queued until one completes.
+
         Notes:
              - Have in mind that in case of having several lines with the same
                time stamp, they will be executed in order.
@@ -86,17 +266,23 @@ class ScenarioParser(object):
     _re_substitution = re_compile("(\$\w+)")
     _re_preprocessor_dir = re_compile("^&(\w+)\s+")
     _re_named_arg = re_compile("^\s*(\w+)\s*=\s*(.*)$")
+    _re_recurrence_option = re_compile("^(\w+)=(\S+)(\s+|$)")
+    _re_dependency = re_compile("^after:(\w+)(?:\+(\S+))?$")
 
     def __init__(self):
         super(ScenarioParser, self).__init__()
         self._logger = logging.getLogger(self.__class__.__name__)
         self.file_lock = RLock()
         self.line_buffer = []
-        self.user_defined_vars = {}
+        self.user_defined_vars = ScenarioVariables()
+        # The literal and variable segments of every line, and the lines as expanded with the current variables
+        self._line_templates = {}
+        self._expanded_lines = {}
         self.preprocessor_callbacks = {
             "include": self._preproc_include_file
         }
         self._peernumber = None
+        self._peerspecs = {}
 
     def add_scenario(self, filename):
         """
@@ -109,18 +295,21 @@ class ScenarioParser(object):
             line_number = 1
             for line in lines:
                 if line.startswith("&"):
-                    preproc_match = self._re_preprocessor_dir.match(line)
-                    if preproc_match and preproc_match.group(1) in self.preprocessor_callbacks:
-                        self.preprocessor_callbacks[preproc_match.group(1)](filename, line_number,
-                                                                            line[preproc_match.end():].strip())
-                    else:
-                        self._logger.error("Error reading scenario %s:%d, preprocessor callback %s is unknown.",
-                                           filename, line_number, line)
+                    self._run_preprocessor_directive(filename, line_number, line)
                 elif not line.startswith('#'):
                     line = line.strip()
                     self.line_buffer.append((filename, line_number, line))
                 line_number += 1
 
+    def _run_preprocessor_directive(self, filename, line_number, line):
+        preproc_match = self._re_preprocessor_dir.match(line)
+        if preproc_match and preproc_match.group(1) in self.preprocessor_callbacks:
+            self.preprocessor_callbacks[preproc_match.group(1)](filename, line_number,
+                                                                line[preproc_match.end():].strip())
+        else:
+            self._logger.error("Error reading scenario %s:%d, preprocessor callback %s is unknown.",
+                               filename, line_number, line)
+
     def _preproc_include_file(self, filename, line_number, line):
         exline = self._expand_line(line)
         if not path.isabs(line):
@@ -222,60 +411,43 @@ class ScenarioParser(object):
 
     def _parse_scenario_line(self, filename, line_number, line, peerspec):
         """
-        Parses one scenario line, and returns a command tuple. If a parsing
-        error is encountered or the line should not be executed by this peer,
-        returns None.
+        Parses one scenario line, and returns its command tuples. The commands
+        of a for loop are generated lazily, for the iterations that apply to
+        this peer only. If a parsing error is encountered or the line should
+        not be executed by this peer, returns None.
 
         The command tuple is described in _parse_scenario().
         """
         if self._parse_for_this_peer(peerspec):
             line = self._expand_line(line)
             try:
-                parts = line.split(' ', 2)
-                if len(parts) == 3:
-                    timespec, callable, args = parts
-                elif len(parts) == 1 and line.strip() == "":
+                parts = self._split_scenario_line(line)
+                if parts is None:
                     return None
-                else:
-                    timespec, callable = parts
-                    args = ''
-
-                if len(timespec) > 1 and timespec[0] == '@' and timespec[1] == '!':
-                    begin = -1
-                else:
-                    if timespec[0] == '@':
-                        timespec = timespec[1:]
-                    timespec = timespec.split(':')
-                    begin = float(timespec[-1])
-                    if len(timespec) > 1:
-                        begin += int(timespec[-2]) * 60
-                    if len(timespec) > 2:
-                        begin += int(timespec[-3]) * 3600
+                timespec, callable, args = parts
+                begin, callable, args, timing = self._parse_timing(timespec, callable, args, peerspec)
 
                 commands = []
 
-                if callable == 'for':
+                if callable == 'for' and (timing is None or timing[0] == 'after'):
                     # If our current command is a 'for' loop, then we further parse the line
                     callable, args, lo_bound, hi_bound, offset, control_var = self._parse_for_loop(args)
                     unnamed_args, named_args = self._parse_arguments(args)
 
-                    # get the indexes and keys of the control variable in the (un)named variables
-                    control_index_args = [idx for idx in range(len(unnamed_args)) if unnamed_args[idx] == control_var]
-                    control_index_named_args = [key for key in named_args if named_args[key] == control_var]
-
-                    for i in range(lo_bound, hi_bound, offset):
-                        if not peerspec or (peerspec == control_var and i == self._peernumber) or \
-                                (peerspec == str(self._peernumber)):
-
-                            # Replace any arguments represented by the loop's control variable with its current value
-                            str_i = str(i)
-                            for idx in control_index_args:
-                                unnamed_args[idx] = str_i
-                            for key in control_index_named_args:
-                                named_args[key] = str_i
+                    if not peerspec or peerspec == str(self._peernumber):
+                        iterations = xrange(lo_bound, hi_bound, offset)
+                    elif peerspec == control_var and (lo_bound <= self._peernumber < hi_bound if offset > 0
+                                                      else hi_bound < self._peernumber <= lo_bound):
+                        # Only the iteration for this peer applies, so there's no need to walk the whole range
+                        iterations = (self._peernumber,)
+                    else:
+                        # Any other peerspec, including a list or range of peers, selects no iteration at all
+                        iterations = ()
 
-                            # We need to copy the parameter list and dictionary since there's reference issues otherwise
-                            commands.append((begin, filename, line_number, callable, unnamed_args[:], dict(named_args)))
+                    commands = self._expand_for_loop(begin, filename, line_number, callable, unnamed_args, named_args,
+                                                     control_var, iterations)
+                    if timing is not None:
+                        commands = (self._make_command(*(command + (timing,))) for command in commands)
                 else:
                     # TODO: a regex should be added to swap in the value of a variable used in the peerspec;
                     #       one can check if the variable exists, and identifies this peer in _parse_for_this_peer
@@ -287,7 +459,8 @@ class ScenarioParser(object):
                         raise Exception()
 
                     unnamed_args, named_args = self._parse_arguments(args)
-                    commands = [(begin, filename, line_number, callable, unnamed_args, named_args)]
+                    commands = [self._make_command(begin, filename, line_number, callable, unnamed_args, named_args,
+                                                   timing)]
 
                 return commands
 
@@ -298,51 +471,227 @@ class ScenarioParser(object):
         # line not for this peer or a parse error occurred
         return None
 
+    @staticmethod
+    def _expand_for_loop(begin, filename, line_number, callable, unnamed_args, named_args, control_var, iterations):
+        """
+        Lazily yields the command of every given iteration of a for loop, with the arguments represented by the
+        loop's control variable replaced by its value.
+        """
+        # get the indexes and keys of the control variable in the (un)named variables
+        control_index_args = [idx for idx in range(len(unnamed_args)) if unnamed_args[idx] == control_var]
+        control_index_named_args = [key for key in named_args if named_args[key] == control_var]
+
+        for i in iterations:
+            str_i = str(i)
+            # We need to copy the parameter list and dictionary since there's reference issues otherwise
+            args = unnamed_args[:]
+            kwargs = dict(named_args)
+            for idx in control_index_args:
+                args[idx] = str_i
+            for key in control_index_named_args:
+                kwargs[key] = str_i
+            yield begin, filename, line_number, callable, args, kwargs
+
+    def _parse_timing(self, timespec, callable, args, peerspec):
+        """
+        Parse the timing of a scenario line, which is either a timespec, a recurrence or a dependency on the completion
+        of the events with a label: 'after:LABEL[+DELAY] CALLABLE [ARGS]'.
+
+        :return: a tuple containing the start of the event (the delay for a dependency), the callable, the callable's
+                 argument line (unparsed) and the timing: None, or the kind of timing followed by its parameters
+        """
+        dependency_match = self._re_dependency.match(timespec)
+        if dependency_match:
+            delay = self._parse_timespec(dependency_match.group(2)) if dependency_match.group(2) else 0.0
+            if delay < 0 or callable in ('every', 'rate'):
+                raise Exception()
+            return delay, callable, args, ('after', dependency_match.group(1))
+
+        if callable in ('every', 'rate'):
+            return self._parse_recurrence(timespec, callable, args, peerspec)
+        return self._parse_timespec(timespec), callable, args, None
+
+    def _parse_recurrence(self, timespec, kind, args, peerspec):
+        """
+        Parse the timespec and arguments of a recurring event, structured as either:
+        'TIMESPEC every INTERVAL [jitter=JITTER] CALLABLE [ARGS]' or
+        'TIMESPEC rate RATE [distribution=DISTRIBUTION] [scope=SCOPE] CALLABLE [ARGS]'.
+
+        :return: a tuple containing the start of the event, the callable, the callable's argument line (unparsed) and
+                 the recurrence: the kind of recurrence followed by its parameters
+        """
+        begin, _, end = timespec.partition('-')
+        begin = self._parse_timespec(begin)
+        end = self._parse_timespec(end) if end else None
+
+        value, _, args = args.partition(' ')
+        value = float(value)
+        options = {}
+        option_match = self._re_recurrence_option.match(args)
+        while option_match:
+            options[option_match.group(1)] = option_match.group(2)
+            args = args[option_match.end():]
+            option_match = self._re_recurrence_option.match(args)
+        callable, _, args = args.partition(' ')
+
+        if begin < 0 or value <= 0 or not callable:
+            raise Exception()
+
+        if kind == 'every':
+            jitter = float(options.pop('jitter', 0))
+            if jitter < 0:
+                raise Exception()
+            recurrence = (kind, value, end, jitter)
+        else:
+            distribution = options.pop('distribution', 'poisson')
+            scope = options.pop('scope', 'peer')
+            if distribution not in ArrivalProcess.DISTRIBUTIONS or scope not in ('peer', 'global'):
+                raise Exception()
+            # A global rate is shared by the peers of the peerspec, which are only known when running the scenario
+            recurrence = (kind, value, end, distribution, peerspec if scope == 'global' else None)
+
+        if options:
+            raise Exception()
+
+        return begin, callable, args, recurrence
+
+    @staticmethod
+    def _make_command(begin, filename, line_number, callable, unnamed_args, named_args, timing=None):
+        """
+        Returns the command tuple of a scenario line. The callable of a recurring or dependent event is the kind of
+        timing (every, rate or after), with its parameters and the actual callable preceding the arguments.
+        """
+        if timing is not None:
+            return (begin, filename, line_number, timing[0], list(timing[1:]) + [callable] + unnamed_args,
+                    named_args)
+        return begin, filename, line_number, callable, unnamed_args, named_args
+
+    @staticmethod
+    def _split_scenario_line(line):
+        """
+        Splits a scenario line into its timespec, callable and (unparsed) arguments, or returns None for an empty line.
+        """
+        parts = line.split(' ', 2)
+        if len(parts) == 3:
+            return parts
+        elif len(parts) == 1 and line.strip() == "":
+            return None
+        timespec, callable = parts
+        return timespec, callable, ''
+
+    @staticmethod
+    def _parse_timespec(timespec):
+        """
+        Returns the number of seconds since the start of the experiment at which a command should run, or -1 if it
+        should run immediately.
+        """
+        if len(timespec) > 1 and timespec[0] == '@' and timespec[1] == '!':
+            return -1
+
+        if timespec[0] == '@':
+            timespec = timespec[1:]
+        timespec = timespec.split(':')
+        begin = float(timespec[-1])
+        if len(timespec) > 1:
+            begin += int(timespec[-2]) * 60
+        if len(timespec) > 2:
+            begin += int(timespec[-3]) * 3600
+        return begin
+
     def _parse_peerspec(self, peerspec):
         """
-        Checks if current peernumber matches a peer specification.
+        Parses a peer specification into the PeerRanges of the included and the excluded peers. The result is cached,
+        as the same peer specification is usually used on many lines.
 
         A peer specification if formatted as:
             [{PEERNR1 [, PEERNR2, ...] [, PEERNR3-PEERNR6, ...]}]
 
         Note: An empty peer specification matches everything.
         """
-        # get individual peers, if any, for a peer spec
-        yes_peers = set()
-        no_peers = set()
+        if peerspec in self._peerspecs:
+            return self._peerspecs[peerspec]
+
+        # get the ranges of peers, if any, for a peer spec
+        yes_ranges = []
+        no_ranges = []
 
         if peerspec:
             if peerspec[0] == "!":
-                peers = no_peers
-                peerspec = peerspec[1:]
+                ranges = no_ranges
+                spec = peerspec[1:]
             else:
-                peers = yes_peers
+                ranges = yes_ranges
+                spec = peerspec
 
-            for peer in peerspec.split(","):
+            for peer in spec.split(","):
                 peer = peer.strip()
                 if peer:
                     # parse the peer number (or peer number pair)
                     if "-" in peer:
                         low, high = peer.split("-")
-                        peers.update(xrange(int(low), int(high) + 1))
+                        ranges.append((int(low), int(high)))
                     else:
-                        peers.add(int(peer))
+                        ranges.append((int(peer), int(peer)))
 
-        return yes_peers, no_peers
+        self._peerspecs[peerspec] = PeerRanges(yes_ranges), PeerRanges(no_ranges)
+        return self._peerspecs[peerspec]
 
     def _parse_for_this_peer(self, peerspec):
         raise NotImplementedError('override this method please')
 
+    def _get_line_template(self, line):
+        """
+        Splits a line into its literal segments and the names of the $VARIABLES between them. A line is only split
+        once, as the same lines are expanded again and again.
+
+        :return: a tuple with the literal segments and the variable names, or None if the line has no variables
+        """
+        if line not in self._line_templates:
+            segments = self._re_substitution.split(line)
+            self._line_templates[line] = (segments[::2], [segment[1:] for segment in segments[1::2]]) \
+                if len(segments) > 1 else None
+        return self._line_templates[line]
+
     def _expand_line(self, line):
-        # Look for $VARIABLES to replace with config options from the env (lower precedence)
-        # or from the user defined variables (higher precedence)
-        for substitution in self._re_substitution.findall(line):
-            if substitution[1:] in self.user_defined_vars:
-                line = line.replace(substitution, self.user_defined_vars[substitution[1:]])
-            elif substitution[1:] in environ:
-                line = line.replace(substitution, environ[substitution[1:]])
+        # Replace the $VARIABLES with config options from the env (lower precedence) or from the user defined
+        # variables (higher precedence). A line is only expanded again if one of its variables was set since, or if
+        # one of the config options it uses changed in the env.
+        template = self._get_line_template(line)
+        if template is None:
+            return line
+
+        literals, names = template
+        versions = [(self.user_defined_vars.versions.get(name),
+                     None if name in self.user_defined_vars else environ.get(name)) for name in names]
+        expanded = self._expanded_lines.get(line)
+        if expanded is not None and expanded[0] == versions:
+            return expanded[1]
+
+        values = [self.user_defined_vars[name] if name in self.user_defined_vars else environ.get(name, "$" + name)
+                  for name in names]
+        segments = [literals[0]]
+        for value, literal in zip(values, literals[1:]):
+            segments.append(value)
+            segments.append(literal)
+        expanded_line = "".join(segments)
+        self._expanded_lines[line] = (versions, expanded_line)
+        return expanded_line
+
+
+class ScenarioEvent(object):
+    """
+    A scenario event, as scheduled by the ScenarioRunner.
+    """
+    __slots__ = ("filename", "line_number", "callable", "args", "kwargs", "label", "occurrences")
 
-        return line
+    def __init__(self, filename, line_number, callable, args, kwargs, label=None, occurrences=None):
+        self.filename = filename
+        self.line_number = line_number
+        self.callable = callable
+        self.args = args
+        self.kwargs = kwargs
+        self.label = label
+        self.occurrences = occurrences
 
 
 class ScenarioRunner(ScenarioParser):
@@ -362,10 +711,58 @@ class ScenarioRunner(ScenarioParser):
         super(ScenarioRunner, self).__init__()
         self._callables = {}
         self.exp_start_time = expstartstamp
+        self._events = []
+        self._event_counter = count()
+        self._next_call = None
+        self._paused_at = None
+        # The time at which the event that is being called was scheduled
+        self._running_scheduled = None
+        self.random = Random()
+        # Set by the experiment client, to scale global workload rates and to seed the workloads
+        self.peer_count = 1
+        self.random_seed = None
+        self._workload_file = None
+        # A ScenarioTraceWriter recording the timing of every scheduled event, if set
+        self.trace = None
+        self._pending_labels = {}
+        self._dependent_events = {}
+        self._max_in_flight = {}
+        self._in_flight = {}
+        self._queued_events = {}
+        self.preprocessor_callbacks["max_in_flight"] = self._preproc_max_in_flight
+        # Scenarios are compiled once per host into a schedule shared by all instances, unless no cache dir is set
+        self.cache_dir = environ.get("SCENARIO_CACHE_DIR", gettempdir())
+        self._compiled_scenario = None
 
     def set_peernumber(self, peernumber):
         self._peernumber = peernumber
 
+    def add_scenario(self, filename):
+        """
+        Read the scenario into this scenario runner, from the compiled scenario cache if possible. The cache is only
+        used for the first scenario added, as the lines of later scenarios depend on the variables set by it.
+        """
+        if self.cache_dir and not self.line_buffer and self._compiled_scenario is None:
+            try:
+                self._compiled_scenario = load_compiled_scenario(filename, self.cache_dir, self.user_defined_vars)
+            except (IOError, OSError) as e:
+                self._logger.warning("Could not use the compiled scenario cache in %s: %s", self.cache_dir, e)
+
+            if self._compiled_scenario is not None:
+                self._logger.info("Loaded compiled scenario %s", filename)
+                for directive in self._compiled_scenario.directives:
+                    self._run_preprocessor_directive(*directive)
+                return
+
+        super(ScenarioRunner, self).add_scenario(filename)
+
+    def _parse_scenario(self):
+        if self._compiled_scenario is not None:
+            for command in self._compiled_scenario.commands_for(self._peernumber):
+                yield command
+        for command in super(ScenarioRunner, self)._parse_scenario():
+            yield command
+
     def register(self, clb, name=None):
         """
         Registers callable to be used from a scenario file. An optional
@@ -381,34 +778,240 @@ class ScenarioRunner(ScenarioParser):
 
     def run(self):
         """
-        Schedules calls for each scenario line.
+        Calls the immediate scenario events, and schedules the others. The scheduled events are kept in a heap ordered
+        by their time, only the first of which is armed on the reactor. Events that depend on the completion of
+        labeled events are held until those have completed.
         """
         self._logger.info("Running scenario")
 
         if self.exp_start_time is None:
             self.exp_start_time = time()
 
+        immediate_events = []
         for tstmp, filename, line_number, clb, args, kwargs in self._parse_scenario():
+            occurrences = dependency = None
+            if clb == 'after':
+                dependency, clb, args = args[0], args[1], args[2:]
+            elif clb == 'every':
+                (interval, end, jitter), clb, args = args[:3], args[3], args[4:]
+                occurrences = self._recurring_times(tstmp, interval, end, jitter)
+            elif clb == 'rate':
+                (rate, end, distribution, peerspec), clb, args = args[:4], args[4], args[5:]
+                if peerspec is not None:
+                    rate /= max(1, self._count_peers(peerspec))
+                occurrences = ArrivalProcess(tstmp, end, rate, distribution, self._get_workload_random(filename,
+                                                                                                       line_number))
             if clb not in self._callables:
                 self._logger.error("Error running scenario %s:%d, undefined callback %s.", filename, line_number, clb)
                 continue
-            if tstmp >= 0:
-                tstmp = tstmp + self.exp_start_time
-                delay = tstmp - time()
-                self._logger.info("Register call %s %s:%d %s %s %s", tstmp, filename, line_number, clb,
-                                  repr(args), repr(kwargs))
-                for target in self._callables[clb]:
-                    reactor.callLater(
-                        delay if delay > 0.0 else 0,
-                        target,
-                        *args,
-                        **kwargs
-                    )
+
+            label = kwargs.pop('as', None)
+            if label is not None and occurrences is not None:
+                self._logger.error("Error running scenario %s:%d, a recurring event can't be labeled.", filename,
+                                   line_number)
+                label = None
+            elif label is not None:
+                self._pending_labels[label] = self._pending_labels.get(label, 0) + 1
+            event = ScenarioEvent(filename, line_number, clb, args, kwargs, label, occurrences)
+
+            if dependency is not None:
+                self._logger.debug("Register call %s seconds after %s %s:%d %s %s %s", tstmp, dependency, filename,
+                                   line_number, clb, repr(args), repr(kwargs))
+                self._dependent_events.setdefault(dependency, []).append((tstmp, event))
+            elif occurrences is not None:
+                self._logger.debug("Register recurring call %s %s:%d %s %s %s", tstmp + self.exp_start_time,
+                                   filename, line_number, clb, repr(args), repr(kwargs))
+                self._schedule_next_occurrence(event)
+            elif tstmp >= 0:
+                self._logger.debug("Register call %s %s:%d %s %s %s", tstmp + self.exp_start_time, filename,
+                                   line_number, clb, repr(args), repr(kwargs))
+                self._push_event(tstmp, event)
             else:
                 self._logger.info("Calling immediately %s:%d %s %s %s", filename, line_number, clb,
                                   repr(args), repr(kwargs))
-                for target in self._callables[clb]:
-                    target(*args, **kwargs)
+                # Labels are only known once the whole scenario is parsed
+                if label is None:
+                    self._run_event(event)
+                else:
+                    immediate_events.append(event)
+
+        for label in set(self._dependent_events) - set(self._pending_labels):
+            self._logger.error("Error running scenario, no event is labeled %s, so the events after it never run.",
+                               label)
+        for event in immediate_events:
+            self._run_event(event)
+
+        self._logger.info("Scheduled %d scenario events", len(self._events))
+        self._schedule_next_event()
+
+    def _push_event(self, tstmp, event):
+        # The sequence number keeps the original ordering of events that are scheduled at the same time
+        heappush(self._events, (tstmp, next(self._event_counter), event))
+
+    def _recurring_times(self, begin, interval, end, jitter):
+        """
+        Generates the times of a recurring event. Like a LoopingCall, the occurrences that were missed because the
+        runner fell behind are skipped.
+        """
+        occurrence = 0
+        while end is None or begin + occurrence * interval <= end:
+            yield begin + occurrence * interval + (self.random.uniform(0, jitter) if jitter else 0)
+            elapsed = time() - self.exp_start_time
+            occurrence = max(occurrence + 1, int((elapsed - jitter - begin) // interval) + 1)
+
+    def _count_peers(self, peerspec):
+        yes_peers, no_peers = self._parse_peerspec(peerspec)
+        count = yes_peers.count_within(1, self.peer_count) if yes_peers else self.peer_count
+        return count - no_peers.count_within(1, self.peer_count)
+
+    def _get_workload_random(self, filename, line_number):
+        """
+        Returns the random generator of a workload. Its seed is derived from the experiment wide random seed, so that
+        repeated runs of an experiment generate the same workload.
+        """
+        if self.random_seed is None:
+            return Random()
+        return Random("%s:%s:%s:%d" % (self.random_seed, self._peernumber, path.basename(filename), line_number))
+
+    def _schedule_next_occurrence(self, event):
+        tstmp = next(event.occurrences, None)
+        if tstmp is not None:
+            self._push_event(tstmp, event)
+
+    def _record_dispatch(self, tstmp, clb):
+        """
+        Write the intended and the actual time of a workload call, as the difference between the two shows when the
+        experiment could not keep up with the workload.
+        """
+        if self._workload_file is None:
+            self._workload_file = open(WORKLOAD_FILENAME, "w")
+            reactor.addSystemEventTrigger("before", "shutdown", self._workload_file.close)
+        self._workload_file.write("%f %f %s\n" % (self.exp_start_time + tstmp, time(), clb))
+
+    def _schedule_next_event(self):
+        if self._next_call is not None and self._next_call.active():
+            self._next_call.cancel()
+        self._next_call = None
+
+        if self._events and not self.paused:
+            delay = self.exp_start_time + self._events[0][0] - time()
+            self._next_call = reactor.callLater(delay if delay > 0.0 else 0, self._run_due_events)
+
+    def _run_due_events(self):
+        """
+        Calls the events that are due, until the scenario is paused by one of them.
+        """
+        elapsed = time() - self.exp_start_time
+        while self._events and self._events[0][0] <= elapsed and not self.paused:
+            tstmp, _, event = heappop(self._events)
+            if event.occurrences is not None:
+                self._schedule_next_occurrence(event)
+                if isinstance(event.occurrences, ArrivalProcess):
+                    self._record_dispatch(tstmp, event.callable)
+            self._run_event(event, self.exp_start_time + tstmp)
+        self._schedule_next_event()
+
+    def _run_event(self, event, scheduled=None):
+        """
+        Calls the targets of an event, or queues the event if its callable has the maximum number of calls in flight.
+        A call is in flight until the Deferred it returned has fired.
+
+        :param event: the ScenarioEvent
+        :param scheduled: the time at which the event was scheduled, or None if it is an immediate event
+        """
+        clb = event.callable
+        if clb in self._max_in_flight and self._in_flight.get(clb, 0) >= self._max_in_flight[clb]:
+            self._queued_events.setdefault(clb, deque()).append((event, scheduled))
+            return
+
+        deferreds = []
+        self._running_scheduled = scheduled
+        for target in self._callables[clb]:
+            start = time()
+            try:
+                result = target(*event.args, **event.kwargs)
+            except Exception:
+                self._logger.exception("Error running scenario %s:%d, callback %s failed.", event.filename,
+                                       event.line_number, clb)
+                result = None
+            if self.trace is not None and scheduled is not None:
+                self.trace.record(clb, scheduled, start, time(), result)
+            if isinstance(result, Deferred):
+                deferreds.append(result.addErrback(self._on_event_failed, event))
+        self._running_scheduled = None
+
+        if not deferreds:
+            self._on_event_completed(event)
+            return
+
+        self._in_flight[clb] = self._in_flight.get(clb, 0) + 1
+        DeferredList(deferreds).addCallback(lambda _: self._on_event_completed(event, in_flight=True))
+
+    def _on_event_failed(self, failure, event):
+        self._logger.error("Error running scenario %s:%d, callback %s failed: %s", event.filename, event.line_number,
+                           event.callable, failure.getErrorMessage())
+
+    def _on_event_completed(self, event, in_flight=False):
+        clb = event.callable
+        if in_flight:
+            self._in_flight[clb] -= 1
+            queued_events = self._queued_events.get(clb)
+            if queued_events:
+                self._run_event(*queued_events.popleft())
+
+        label = event.label
+        if label is None:
+            return
+        self._pending_labels[label] -= 1
+        if self._pending_labels[label] == 0:
+            del self._pending_labels[label]
+            self._logger.info("Completed the events labeled %s", label)
+            elapsed = time() - self.exp_start_time
+            for delay, dependent_event in self._dependent_events.pop(label, []):
+                self._push_event(elapsed + delay, dependent_event)
+            self._schedule_next_event()
+
+    def _preproc_max_in_flight(self, filename, line_number, line):
+        try:
+            clb, limit = line.split()
+            self._max_in_flight[clb] = int(limit)
+        except ValueError:
+            self._logger.error("Error reading scenario %s:%d, max_in_flight %s should be a callable and a number.",
+                               filename, line_number, line)
+
+    @property
+    def paused(self):
+        return self._paused_at is not None
+
+    def pause(self):
+        """
+        Hold all the scenario events that have not been executed yet, until resume() is called. When called by a
+        scenario event, the scenario is paused at the time the event was scheduled rather than at the time it was
+        called.
+        """
+        if self.paused:
+            return
+
+        self._paused_at = self._running_scheduled if self._running_scheduled is not None else time()
+        self._schedule_next_event()
+        self._logger.info("Paused scenario, holding %d events", len(self._events))
+
+    def resume(self, resume_time=None):
+        """
+        Continue with the events held by pause(). The held events keep their timing relative to each other and to the
+        moment the scenario was paused, so peers that were paused by the same scenario event continue in step, no
+        matter how late each of them called it.
+
+        :param resume_time: the (local) time at which the scenario should continue, defaults to now.
+        """
+        if not self.paused:
+            return
+
+        resume_time = max(resume_time or time(), self._paused_at)
+        self.exp_start_time += resume_time - self._paused_at
+        self._paused_at = None
+        self._logger.info("Resuming scenario in %f seconds", resume_time - time())
+        self._schedule_next_event()
 
     def _parse_for_this_peer(self, peerspec):
         # TODO: an extra check should be applied here to see if the peerspec contains variables, and if it does, they
@@ -423,3 +1026,308 @@ class ScenarioRunner(ScenarioParser):
                 (no_peers and not self._peernumber in no_peers)
             )
         return True
+
+
+class ScenarioNotCompilable(Exception):
+    """
+    Raised when the peers of a scenario can't share a compiled schedule, as they would expand its lines differently.
+    """
+    pass
+
+
+class ScenarioCompiler(ScenarioParser):
+    """
+    Parses a scenario once for all the peers. The resulting schedule consists of the commands for (a subset of) all
+    peers, and the commands for a single peer indexed by peer number. The commands are numbered in the order in which
+    a ScenarioRunner would schedule them.
+
+    Immediate set commands (@! set <name> <value>) are evaluated while compiling, as they affect the expansion of the
+    following lines. If such a command only applies to some of the peers, the scenario can't be compiled.
+    """
+
+    def __init__(self, user_defined_vars=None):
+        super(ScenarioCompiler, self).__init__()
+        self.initial_vars = dict(user_defined_vars or {})
+        self.user_defined_vars = ScenarioVariables(self.initial_vars)
+        self.file_hashes = {}
+        self.environment_dependencies = {}
+        self.directives = []
+        self.common_commands = []
+        self.peer_commands = {}
+        self._sequence_number = 0
+
+    def add_scenario(self, filename):
+        with open(filename, "rb") as scenario_file:
+            self.file_hashes[path.abspath(filename)] = sha1(scenario_file.read()).hexdigest()
+        super(ScenarioCompiler, self).add_scenario(filename)
+
+    def _run_preprocessor_directive(self, filename, line_number, line):
+        preproc_match = self._re_preprocessor_dir.match(line)
+        if preproc_match and preproc_match.group(1) == "include":
+            super(ScenarioCompiler, self)._run_preprocessor_directive(filename, line_number, line)
+        else:
+            # Executed by every ScenarioRunner that loads the compiled scenario
+            self.directives.append((filename, line_number, line))
+
+    def _preproc_include_file(self, filename, line_number, line):
+        for name in ("PROJECT_DIR", "EXPERIMENT_DIR"):
+            self.environment_dependencies[name] = environ.get(name)
+        super(ScenarioCompiler, self)._preproc_include_file(filename, line_number, line)
+
+    def _expand_line(self, line):
+        template = self._get_line_template(line)
+        if template is not None:
+            for name in template[1]:
+                if name not in self.user_defined_vars:
+                    self.environment_dependencies[name] = environ.get(name)
+        return super(ScenarioCompiler, self)._expand_line(line)
+
+    def get_dependencies(self):
+        """
+        Returns everything the compiled schedule depends on: the scenario files, the environment variables used in
+        them and the variables defined before compiling.
+        """
+        return {
+            "files": self.file_hashes,
+            "environment": self.environment_dependencies,
+            "variables": self.initial_vars
+        }
+
+    def compile(self):
+        for filename, line_number, line in self.line_buffer:
+            if line.endswith('}'):
+                start = line.rfind('{') + 1
+                peerspec = line[start:-1]
+                line = line[:start - 1]
+            else:
+                peerspec = ''
+
+            self._compile_scenario_line(filename, line_number, line, peerspec)
+
+    def _add_command(self, command, yes_peers=None, no_peers=None, peer=None):
+        begin, _, _, callable, args, kwargs = command
+        if begin < 0 and callable == 'set':
+            if peer is not None or yes_peers or no_peers:
+                raise ScenarioNotCompilable()
+            variables = dict(zip(("variable_name", "variable_value"), args))
+            variables.update(kwargs)
+            self.user_defined_vars[variables["variable_name"]] = variables["variable_value"]
+
+        self._sequence_number += 1
+        if peer is None:
+            self.common_commands.append((self._sequence_number, yes_peers, no_peers, command))
+        else:
+            self.peer_commands.setdefault(peer, []).append((self._sequence_number, command))
+
+    def _compile_scenario_line(self, filename, line_number, line, peerspec):
+        """
+        Parses one scenario line for all the peers at once, selecting the peers in the same way as
+        ScenarioRunner._parse_for_this_peer and _parse_scenario_line do for a single peer.
+        """
+        try:
+            yes_peers = no_peers = None
+            if peerspec and '$' not in peerspec:
+                yes_peers, no_peers = self._parse_peerspec(peerspec)
+                yes_peers, no_peers = yes_peers or None, no_peers or None
+
+            line = self._expand_line(line)
+            parts = self._split_scenario_line(line)
+            if parts is None:
+                return
+            timespec, callable, args = parts
+            begin, callable, args, timing = self._parse_timing(timespec, callable, args, peerspec)
+
+            if callable == 'for' and (timing is None or timing[0] == 'after'):
+                callable, args, lo_bound, hi_bound, offset, control_var = self._parse_for_loop(args)
+                unnamed_args, named_args = self._parse_arguments(args)
+
+                if peerspec and peerspec != control_var and not (peerspec.isdigit() and
+                                                                 peerspec == str(int(peerspec))):
+                    # Not executed by any peer
+                    return
+
+                commands = self._expand_for_loop(begin, filename, line_number, callable, unnamed_args, named_args,
+                                                 control_var, xrange(lo_bound, hi_bound, offset))
+                for i, command in enumerate(commands):
+                    if timing is not None:
+                        command = self._make_command(*(command + (timing,)))
+                    if not peerspec:
+                        self._add_command(command)
+                    elif peerspec == control_var:
+                        self._add_command(command, peer=lo_bound + i * offset)
+                    else:
+                        self._add_command(command, peer=int(peerspec))
+            else:
+                if self._re_substitution.match(peerspec):
+                    # We have a substitution variable in the peerspec, which should be illegal in this branch
+                    raise Exception()
+
+                unnamed_args, named_args = self._parse_arguments(args)
+                self._add_command(self._make_command(begin, filename, line_number, callable, unnamed_args, named_args,
+                                                     timing), yes_peers, no_peers)
+
+        except ScenarioNotCompilable:
+            raise
+        except Exception:
+            self._logger.error("Error reading scenario %s:%d, invalid line %s.", filename, line_number, line,
+                               exc_info=True)
+
+
+class CompiledScenario(object):
+    """
+    A compiled scenario schedule as stored in the cache, of which only the commands of a single peer are loaded.
+
+    The cache file consists of the pickled commands for (a subset of) all peers, followed by the pickled commands of
+    every single peer, an index with the offsets of these and the dependencies of the schedule, and finally the offset
+    of the index.
+    """
+
+    def __init__(self, cache_file, index):
+        self._cache_file = cache_file
+        self.index = index
+        self.directives = index["directives"]
+        self._cache_file.seek(index["common"])
+        self.common_commands = pickle.load(self._cache_file)
+        self._peer_commands = {}
+
+    @staticmethod
+    def read_index(cache_file):
+        cache_file.seek(-INDEX_OFFSET_STRUCT.size, 2)
+        index_offset, = INDEX_OFFSET_STRUCT.unpack(cache_file.read(INDEX_OFFSET_STRUCT.size))
+        cache_file.seek(index_offset)
+        return pickle.load(cache_file)
+
+    @staticmethod
+    def write(filename, compiler, dependencies):
+        """
+        Write a compiled schedule to a cache file, or mark the scenario as not compilable if no compiler is given.
+        """
+        index = {"version": SCENARIO_CACHE_VERSION, "dependencies": dependencies, "compilable": compiler is not None}
+        with open(filename, "wb") as cache_file:
+            if compiler:
+                index["directives"] = compiler.directives
+                index["common"] = cache_file.tell()
+                pickle.dump(compiler.common_commands, cache_file, pickle.HIGHEST_PROTOCOL)
+                index["peers"] = {}
+                for peer, commands in compiler.peer_commands.items():
+                    index["peers"][peer] = cache_file.tell()
+                    pickle.dump(commands, cache_file, pickle.HIGHEST_PROTOCOL)
+
+            index_offset = cache_file.tell()
+            pickle.dump(index, cache_file, pickle.HIGHEST_PROTOCOL)
+            cache_file.write(INDEX_OFFSET_STRUCT.pack(index_offset))
+
+    def commands_for(self, peernumber):
+        """
+        Returns the commands of a peer, in the same format and order as ScenarioParser._parse_scenario does.
+        """
+        if peernumber not in self._peer_commands:
+            self._peer_commands[peernumber] = []
+            if peernumber in self.index["peers"]:
+                self._cache_file.seek(self.index["peers"][peernumber])
+                self._peer_commands[peernumber] = pickle.load(self._cache_file)
+            self._cache_file.close()
+        peer_commands = self._peer_commands[peernumber]
+
+        common_commands = ((sequence_number, command)
+                           for sequence_number, yes_peers, no_peers, command in self.common_commands
+                           if (not yes_peers or peernumber in yes_peers) and
+                           (not no_peers or peernumber not in no_peers))
+        for _, command in merge(common_commands, peer_commands):
+            yield command
+
+
+def dependencies_unchanged(dependencies):
+    for filename, file_hash in dependencies["files"].items():
+        if not path.exists(filename):
+            return False
+        with open(filename, "rb") as scenario_file:
+            if sha1(scenario_file.read()).hexdigest() != file_hash:
+                return False
+    return all(environ.get(name) == value for name, value in dependencies["environment"].items())
+
+
+def load_compiled_scenario(filename, cache_dir, user_defined_vars=None):
+    """
+    Load the compiled schedule of a scenario from the cache in cache_dir. The scenario is compiled first if it isn't
+    cached yet or if its files, or the environment variables used in them, changed. The cache is shared by the
+    instances running on a host. The instances with the same values for the variables used in the scenario share a
+    compiled schedule, only one of them compiles it while the others wait for it.
+
+    :param filename: the scenario file
+    :param cache_dir: the directory of the cache
+    :param user_defined_vars: the scenario variables defined before loading the scenario
+    :return: a CompiledScenario, or None if the peers can't share a compiled schedule of the scenario
+    """
+    user_defined_vars = dict(user_defined_vars or {})
+    cache_prefix = path.join(cache_dir, "gumby_scenario_%d_%s" %
+                             (getuid(), sha1(path.abspath(filename).encode("utf-8")).hexdigest()))
+    names_filename = cache_prefix + ".names"
+
+    def get_cache_filename():
+        # The schedules are keyed on the values of the environment variables that the last compilation found in the
+        # scenario, so that instances with other values don't replace each other's schedule
+        try:
+            with open(names_filename, "rb") as names_file:
+                names = pickle.load(names_file)
+        except Exception:
+            names = []
+        key = repr((sorted(user_defined_vars.items()), [(name, environ.get(name)) for name in names]))
+        return "%s_%s.cache" % (cache_prefix, sha1(key.encode("utf-8")).hexdigest())
+
+    def load(cache_filename):
+        if not path.exists(cache_filename):
+            return False, None
+        cache_file = open(cache_filename, "rb")
+        try:
+            index = CompiledScenario.read_index(cache_file)
+        except Exception:
+            cache_file.close()
+            return False, None
+        if index["version"] != SCENARIO_CACHE_VERSION or index["dependencies"]["variables"] != user_defined_vars or \
+                not dependencies_unchanged(index["dependencies"]):
+            cache_file.close()
+            return False, None
+        if not index["compilable"]:
+            cache_file.close()
+            return True, None
+        return True, CompiledScenario(cache_file, index)
+
+    cache_filename = get_cache_filename()
+    while True:
+        with open(cache_filename + ".lock", "a") as lock_file:
+            flock(lock_file, LOCK_SH)
+            valid, compiled = load(cache_filename)
+            if valid:
+                return compiled
+
+            flock(lock_file, LOCK_EX)
+            # Another instance might have compiled it in the meantime, or found other variables in the scenario
+            valid, compiled = load(cache_filename)
+            if valid:
+                return compiled
+            if get_cache_filename() != cache_filename:
+                cache_filename = get_cache_filename()
+                continue
+
+            compiler = ScenarioCompiler(user_defined_vars)
+            compiler.add_scenario(filename)
+            try:
+                compiler.compile()
+                compilable = True
+            except ScenarioNotCompilable:
+                logging.getLogger(ScenarioCompiler.__name__).info(
+                    "Scenario %s sets variables for some of the peers only, it will be parsed by every instance",
+                    filename)
+                compilable = False
+
+            temporary_filename = "%s.%d" % (names_filename, getpid())
+            with open(temporary_filename, "wb") as names_file:
+                pickle.dump(sorted(compiler.environment_dependencies), names_file, pickle.HIGHEST_PROTOCOL)
+            rename(temporary_filename, names_filename)
+
+            cache_filename = get_cache_filename()
+            temporary_filename = "%s.%d" % (cache_filename, getpid())
+            CompiledScenario.write(temporary_filename, compiler if compilable else None, compiler.get_dependencies())
+            rename(temporary_filename, cache_filename)
+            return load(cache_filename)[1]
@@ -0,0 +1,108 @@
+"""
+Tracing of the execution of scenario events.
+
+For every call of a scheduled scenario event, the scenario runner records when it should have been called, how late it
+was actually called, how long it blocked the reactor and, if it returned a Deferred, how long it took until the
+Deferred fired. This shows whether the results of an experiment reflect the protocol or an overloaded process.
+
+The trace of a peer is a binary file with fixed size records:
+
+    name index (H), scheduled time (d), lateness (f), duration (f), completion (f)
+
+The lateness is the time between the scheduled time and the call, the duration the time until the call returned and the
+completion the time until its Deferred fired (or the duration if it didn't return one), all in seconds. Before the
+first record of a callable, a name record assigns the next index to its name: 0xFFFF (H), length of the name (H), the
+name (utf-8).
+"""
+from struct import Struct
+from time import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+TRACE_FILENAME = "scenario_trace.bin"
+
+TRACE_RECORD = Struct("!Hdfff")
+TRACE_NAME_HEADER = Struct("!HH")
+TRACE_NAME_MARKER = 0xFFFF
+
+
+class ScenarioTraceWriter(object):
+    """
+    Writes the trace of the scenario events of a peer.
+    """
+
+    def __init__(self, filename=TRACE_FILENAME):
+        self.filename = filename
+        self._trace_file = None
+        self._closed = False
+        self._name_indexes = {}
+
+    def record(self, name, scheduled, start, end, result=None):
+        """
+        Record a call of a scenario event. If the call returned a Deferred that did not fire yet, the call is recorded
+        once it does.
+
+        :param name: the name of the callable
+        :param scheduled: the time at which the event was scheduled
+        :param start: the time at which the callable was called
+        :param end: the time at which the callable returned
+        :param result: the return value of the callable
+        """
+        if isinstance(result, Deferred) and not result.called:
+            def on_completed(value):
+                self._write(name, scheduled, start, end, time() - start)
+                return value
+            result.addBoth(on_completed)
+        else:
+            self._write(name, scheduled, start, end, end - start)
+
+    def _write(self, name, scheduled, start, end, completion):
+        if self._closed:
+            # A Deferred that fired after the shutdown, reopening the trace would truncate it
+            return
+        if self._trace_file is None:
+            self._trace_file = open(self.filename, "wb")
+            reactor.addSystemEventTrigger("before", "shutdown", self.close)
+
+        if name not in self._name_indexes:
+            self._name_indexes[name] = len(self._name_indexes)
+            encoded_name = name.encode("utf-8")
+            self._trace_file.write(TRACE_NAME_HEADER.pack(TRACE_NAME_MARKER, len(encoded_name)) + encoded_name)
+
+        self._trace_file.write(TRACE_RECORD.pack(self._name_indexes[name], scheduled, start - scheduled, end - start,
+                                                 completion))
+
+    def close(self):
+        self._closed = True
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+
+
+def read_scenario_trace(filename):
+    """
+    Read the trace of the scenario events of a peer.
+
+    :param filename: the trace file
+    :return: a generator of (name, scheduled time, lateness, duration, completion) tuples
+    """
+    names = []
+    with open(filename, "rb") as trace_file:
+        data = trace_file.read()
+
+    offset = 0
+    while offset + TRACE_NAME_HEADER.size <= len(data):
+        index, length = TRACE_NAME_HEADER.unpack_from(data, offset)
+        if index == TRACE_NAME_MARKER:
+            offset += TRACE_NAME_HEADER.size
+            names.append(data[offset:offset + length].decode("utf-8"))
+            offset += length
+            continue
+
+        if offset + TRACE_RECORD.size > len(data):
+            # The experiment was killed while writing the record
+            break
+        index, scheduled, lateness, duration, completion = TRACE_RECORD.unpack_from(data, offset)
+        offset += TRACE_RECORD.size
+        yield names[index], scheduled, lateness, duration, completion
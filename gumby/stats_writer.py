@@ -0,0 +1,115 @@
+"""
+Buffered writing of the statistics of a peer.
+
+Experiment modules record statistics, like the changes in the state of a download, from the reactor thread and often
+many times per second. Instead of writing and flushing statistics.log for every record, the records are queued and a
+thread of their own formats and writes them in batches: once a batch is large enough, or once its oldest record waited
+long enough. Should the writer fall behind, records are dropped rather than letting the queue grow without bounds.
+
+Every line of statistics.log has the format:
+
+    TIMESTAMP PEER_ID NAME VALUE
+
+where the value is written as is if it is a string, and as JSON otherwise.
+"""
+import json
+import logging
+from collections import deque
+from threading import Condition, Thread
+from time import time
+
+import six
+
+STATS_FILENAME = "statistics.log"
+# Write a batch once it has this many records...
+STATS_MAX_BATCH_RECORDS = 1000
+# ... or once its first record was recorded this many seconds ago
+STATS_MAX_DELAY = 1.0
+# Drop records while this many are waiting to be written
+STATS_MAX_QUEUED_RECORDS = 100000
+
+
+class StatsWriter(object):
+    """
+    Writes the statistics records of a peer in batches, in a thread of its own.
+    """
+
+    def __init__(self, filename, peer_id, max_batch_records=STATS_MAX_BATCH_RECORDS, max_delay=STATS_MAX_DELAY,
+                 max_queued_records=STATS_MAX_QUEUED_RECORDS):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.filename = filename
+        self.peer_id = peer_id
+        self.max_batch_records = max_batch_records
+        self.max_delay = max_delay
+        self.max_queued_records = max_queued_records
+        self.records_written = 0
+        self.records_dropped = 0
+        self.bytes_written = 0
+        self._records = deque()
+        self._condition = Condition()
+        self._closing = False
+        self._stats_file = open(filename, "w")
+        self._thread = Thread(target=self._write_batches, name="StatsWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, name, value):
+        """
+        Record a statistic. Values other than strings are written as JSON by the writer thread, so they should not be
+        changed afterwards.
+
+        :param name: the name of the statistic
+        :param value: the value of the statistic
+        """
+        with self._condition:
+            if self._closing or len(self._records) >= self.max_queued_records:
+                self.records_dropped += 1
+                return
+            self._records.append((time(), name, value))
+            if len(self._records) == 1 or len(self._records) >= self.max_batch_records:
+                self._condition.notify()
+
+    def _format_record(self, timestamp, name, value):
+        if not isinstance(value, six.string_types):
+            value = json.dumps(value)
+        return '%.1f %s %s %s\n' % (timestamp, self.peer_id, name, value)
+
+    def _write_batches(self):
+        while True:
+            with self._condition:
+                while not self._records and not self._closing:
+                    self._condition.wait()
+                # Give the batch some time to fill up
+                deadline = self._records[0][0] + self.max_delay if self._records else 0
+                while len(self._records) < self.max_batch_records and not self._closing and time() < deadline:
+                    self._condition.wait(deadline - time())
+                records, self._records = self._records, deque()
+                closing = self._closing
+
+            if records:
+                try:
+                    data = "".join(self._format_record(*record) for record in records)
+                    self._stats_file.write(data)
+                    self._stats_file.flush()
+                    self.records_written += len(records)
+                    self.bytes_written += len(data)
+                except Exception:
+                    self._logger.exception("Could not write %d statistics records", len(records))
+                    with self._condition:
+                        self.records_dropped += len(records)
+            if closing:
+                return
+
+    def close(self):
+        """
+        Write the remaining records and close the statistics file.
+        """
+        with self._condition:
+            if self._closing:
+                return
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+        self._stats_file.close()
+        self._logger.info("Wrote %d statistics records (%d bytes), dropped %d", self.records_written,
+                          self.bytes_written, self.records_dropped)
@@ -1,6 +1,8 @@
 import os
 import re
 
+from gumby.metrics_store import METRICS_FILENAME, MetricsReader
+
 
 class StatisticsParser(object):
     """
@@ -42,5 +44,20 @@ class StatisticsParser(object):
                 if os.path.exists(filename) and os.stat(filename).st_size > 0:
                     yield peer_nr, filename, peerdir
 
+    def yield_metric(self, name, start=None, end=None):
+        """
+        Yield the records of a single metric of all peers, optionally only those between start and end. Only the
+        blocks of this metric are read from the metrics files.
+
+        :param name: the name of the metric
+        :param start: (optional) the earliest timestamp to yield
+        :param end: (optional) the latest timestamp to yield
+        :return: a generator of (peer_nr, timestamp, value) tuples
+        """
+        for peer_nr, filename, _ in self.yield_files(METRICS_FILENAME):
+            with MetricsReader(filename) as reader:
+                for timestamp, value in reader.read(name, start, end):
+                    yield peer_nr, timestamp, value
+
     def run(self):
         pass
@@ -19,14 +19,63 @@
 # * ready         -> Indicates that this specific instance has ending sending its info
 #                    and its ready to start.
 #
+# To estimate the clock offset more precisely, the subscribers can also exchange ping/pong lines with the server and
+# report the result with "offset:<offset>:<error>", which replaces the offset derived from the time:<float> command
+# (see gumby.clock). Both are included as "time_offset" and "time_offset_error" in the JSON document.
+#
 # When the all of the instances we are waiting for are all ready, all the information will
 # be sent back to them in the form of a JSON document. After this, a "go" command will
 # be sent to indicate that they should start running the experiment with the absolute time at which the experiment should start.
 #
+# To avoid having thousands of instances connecting to a single server, a relay can be run on every node. The relay
+# accepts the connections of the local instances, speaks the same protocol with them and reports upstream on behalf of
+# all of them over a single connection. A relay uses two additional commands:
+# * relay:<int>    -> Tells the service that this connection represents <int> subscribers. This has to be the first
+#                     line of the relay, so that it is counted as all of its subscribers at once.
+# * batch:<json>   -> Replaces "ready" for relays, it contains the vars of all the relayed subscribers indexed by id.
+# And the server replies to a relay with ids:<id1>,<id2>,...:<token> instead of a single id. The JSON document and the go
+# signal are sent once to the relay, which fans them out to its local subscribers.
+#
+# Subscribers can also send:
+# * framing:zlib  -> Requests the JSON document to be sent as a "blob:<length>" line followed by <length> bytes of
+#                    zlib compressed data, which is not subject to the maximum line length (see gumby.framing).
+#
+# Unless disabled, the connections are kept open after the go signal. The subscribers can then send requests, which
+# are answered with a response carrying the same request id, and one-way events. The server can send events too:
+# * req:<id>:lookup:<json list of subscriber ids>  -> res:<id>:<json dict with the full vars of those subscribers>
+# * evt:barrier:{"name": <name>, "id": <subscriber id>, "timeout": <float or null>, "quorum": <float or null>}
+#                                                   -> evt:barrier:{"name": <name>, "time": <release time>}
+#   The barrier is released once all subscribers (or the quorum, either a number of subscribers or a fraction if
+#   smaller than 1) arrived, or when the timeout since the first arrival expires. The release time is expressed in the
+#   clock of the server.
+# * evt:kv:{"updates": {<key>: <value>, ...}}       -> publishes values in the experiment wide key-value store
+# * req:<id>:kv_subscribe:{"prefix": <prefix>}     -> res:<id>:<json dict with the current values under the prefix>
+#   After subscribing, the updates of the keys starting with the prefix are sent to the subscriber in batches, as
+#   evt:kv:{"updates": {<key>: <value>, ...}}. Relays forward these batches to all their local subscribers, which
+#   filter them on their own subscriptions.
+#
+# Every subscriber receives a session token together with its id (id:<id>:<token>). When the connection of a
+# subscriber drops before the experiment started, the server keeps its id and vars around. Once reconnected, the
+# subscriber sends "resume:<token>:<state>" as its first line instead of registering again, where <state> is the
+# state of the client (all_vars or go). The server replies with "resumed:<state>", the state of the server for that
+# subscriber (init, vars_received or wait) or "unknown" if it doesn't know the token, so the subscriber can repeat
+# whatever got lost. The JSON document and go signal are sent again if the subscriber missed them. New subscribers are
+# registered (and get their id allocated) when their first line arrives. Relays resume their upstream session in the
+# same way, so their local subscribers keep the ids they got. A relay that cannot resume its session gives up.
+#
+# Besides the TCP port, the server and the relays can listen on a unix domain socket. The instances running on the same
+# host connect through it when it exists (see listen_for_subscribers and connect_to_experiment_server), which saves
+# the TCP connection setup and the ephemeral ports when hundreds of instances start at once. Their host in the JSON
+# document is the address at which the remote subscribers reached the server.
+#
+# When the server runs with a peer directory, the JSON document only contains the host, port and time offset of every
+# subscriber. The other vars can be looked up with the lookup request. The experiment modules that read the vars of
+# other subscribers from all_vars, instead of looking them up, do not work with a peer directory.
+#
 # Example of an expected exchange:
 # [connection is opened by the client]
-# <- id:0
 # -> time:1378479678.11
+# <- id:0:1f3870be274f6c49b3e31a0c6728957f
 # -> set:asdf:ooooo
 # -> ready
 # <- {"0": {"host": "127.0.0.1", "time_offset": -0.94, "port": 12000, "asdf": "ooooo"}, "1": {"host": "127.0.0.1", "time_offset": "-1378479680.61", "port": 12001, "asdf": "ooooo"}, "2": {"host": "127.0.0.1", "time_offset": "-1378479682.26", "port": 12002, "asdf": "ooooo"}}
@@ -34,6 +83,17 @@
 # <- go:1388665322.478153
 # [Connection is closed by the server]
 #
+# Example of an exchange with a relay for 2 local instances:
+# [connection is opened by the relay]
+# -> relay:2
+# -> time:1378479678.11
+# <- ids:1,2:0cc175b9c0f1b6a831c399e269772661
+# -> batch:{"1": {"time_offset": 0, "asdf": "ooooo"}, "2": {"time_offset": 0.01, "asdf": "ooooo"}}
+# <- {"0": {...}, "1": {...}, ...}
+# -> vars_received
+# <- go:1388665322.478153
+# [Connection is closed by the server]
+#
 
 # Change Log:
 #
@@ -60,18 +120,38 @@
 # Code:
 import json
 import logging
+from binascii import hexlify
+from collections import OrderedDict
+from math import ceil
+from os import path, urandom
 from random import randint
 from time import time
 
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall, deferLater, cooperate
-from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.defer import Deferred, DeferredSemaphore, maybeDeferred
 from twisted.internet.protocol import Factory, ReconnectingClientFactory, connectionDone
 from twisted.protocols.basic import LineReceiver
 
-from gumby.experiment import ExperimentClient
+from gumby.clock import ClockOffsetEstimator
+from gumby.experiment import KV_BATCH_DELAY, ExperimentClient
+from gumby.framing import FRAMING_ZLIB, DocumentDecoder, compress_document
 
 EXPERIMENT_SYNC_TIMEOUT = 30
+# Time between releasing a barrier and the moment at which the subscribers should continue, to let the release event
+# reach all of them
+BARRIER_RELEASE_DELAY = 1.0
+
+# The vars of every subscriber that are sent to everyone when running with a peer directory
+DIRECTORY_FIELDS = ('host', 'port', 'time_offset', 'time_offset_error')
+
+# The host of the subscribers connected over a unix domain socket, which run on the same host as the server, when no
+# subscriber reached the server over the network
+UNIX_SOCKET_HOST = '127.0.0.1'
+
+# The state that a connection takes over when a subscriber resumes its session
+SESSION_ATTRIBUTES = ('id', 'state', 'vars', 'ready', 'ready_d', 'framing', 'subscriber_count', 'relayed_ids',
+                      'relayed_vars', 'kv_prefixes')
 
 
 class ExperimentServiceProto(LineReceiver):
@@ -87,12 +167,48 @@ class ExperimentServiceProto(LineReceiver):
         self.state = 'init'
         self.vars = {}
         self.ready_d = None
+        self.framing = None
+        self.session_token = None
+        self.registered = False
+        # The key prefixes of the key-value store this connection is subscribed to
+        self.kv_prefixes = set()
+
+        # Relays represent several subscribers over a single connection
+        self.subscriber_count = 1
+        self.relayed_ids = []
+        self.relayed_vars = {}
 
     def connectionMade(self):
         self._logger.debug("New connection from: %s", str(self.transport.getPeer()))
-        self.factory.setConnectionMade(self)
 
     def lineReceived(self, line):
+        if not self.registered:
+            # The first line tells whether this is a new subscriber or one resuming its session
+            self.registered = True
+            if line.startswith('resume:'):
+                _, token, client_state = line.strip().split(':')
+                self.state = self.factory.resumeSession(self, token, client_state)
+                if self.state == 'done':
+                    self.transport.loseConnection()
+                return
+            if line.startswith('relay:'):
+                self.factory.setConnectionMade(self, int(line.strip().split(':')[1]))
+                self._logger.debug("This subscriber is a relay for %d subscribers", self.subscriber_count)
+                return
+            self.factory.setConnectionMade(self)
+
+        if line.startswith('ping:'):
+            self.sendLine(b"pong:%s:%f" % (line.strip().split(':', 1)[1], time()))
+            return
+        if line.startswith('req:'):
+            _, request_id, verb, payload = line.strip().split(':', 3)
+            self.factory.handleRequest(self, request_id, verb, payload)
+            return
+        if line.startswith('evt:'):
+            _, name, payload = line.strip().split(':', 2)
+            self.factory.handleEvent(self, name, payload)
+            return
+
         try:
             pto = 'proto_' + self.state
             statehandler = getattr(self, pto)
@@ -104,11 +220,38 @@ class ExperimentServiceProto(LineReceiver):
             if self.state == 'done':
                 self.transport.loseConnection()
 
+    @property
+    def is_relay(self):
+        return bool(self.relayed_ids)
+
     def sendAndWaitForReady(self):
         self.ready_d = Deferred()
-        self.sendLine(b"id:%s" % self.id)
+        self.session_token = hexlify(urandom(16))
+        self.factory.sessions[self.session_token] = self
+        if self.is_relay:
+            self.sendLine(b"ids:%s:%s" % (b",".join(b"%d" % relayed_id for relayed_id in self.relayed_ids),
+                                          self.session_token))
+        else:
+            self.sendLine(b"id:%s:%s" % (self.id, self.session_token))
         return self.ready_d
 
+    def getSubscriberVars(self):
+        """
+        Returns the vars of all the subscribers behind this connection, indexed by subscriber id.
+        """
+        if self.is_relay:
+            subscribers_vars = dict((relayed_id, self.relayed_vars[relayed_id].copy())
+                                    for relayed_id in self.relayed_ids)
+        else:
+            subscribers_vars = {self.id: self.vars.copy()}
+
+        for subscriber_id, subscriber_vars in subscribers_vars.items():
+            if "port" not in subscriber_vars:
+                subscriber_vars['port'] = subscriber_id + 12000
+            if "host" not in subscriber_vars:
+                subscriber_vars['host'] = get_address_host(self.transport.getPeer(), self.factory.local_host)
+        return subscribers_vars
+
     def connectionLost(self, reason=connectionDone):
         self._logger.debug("Lost connection with: %s with ID %s", str(self.transport.getPeer()), self.id)
         self.factory.unregisterConnection(self)
@@ -127,24 +270,53 @@ class ExperimentServiceProto(LineReceiver):
             self._logger.debug("Time offset is %s", self.vars["time_offset"])
             return 'init'
 
+        elif line.startswith('offset:'):
+            _, offset, error = line.strip().split(':')
+            self.vars['time_offset'] = float(offset)
+            self.vars['time_offset_error'] = float(error)
+            self._logger.debug("Estimated time offset is %s (+/- %s)", offset, error)
+            return 'init'
+
         elif line.startswith('set:'):
             _, key, value = line.strip().split(':', 2)
             self._logger.debug("This subscriber sets %s to %s", key, value)
             self.vars[key] = value
             return 'init'
 
+        elif line.startswith('framing:'):
+            framing = line.strip().split(':', 1)[1]
+            if framing == FRAMING_ZLIB:
+                self.framing = framing
+            else:
+                self._logger.warning("Unknown framing %s requested, sending the JSON document as a line", framing)
+            return 'init'
+
+        elif line.startswith('batch:') and self.is_relay:
+            self.relayed_vars = {}
+            for relayed_id, relayed_vars in json.loads(line.strip().split(':', 1)[1]).items():
+                # The relayed offsets are relative to the relay clock
+                relayed_vars['time_offset'] = relayed_vars.get('time_offset', 0) + self.vars.get('time_offset', 0)
+                relayed_vars['time_offset_error'] = (relayed_vars.get('time_offset_error', 0) +
+                                                     self.vars.get('time_offset_error', 0))
+                self.relayed_vars[int(relayed_id)] = relayed_vars
+            self._logger.debug("This relay is ready now.")
+            return self._setReady()
+
         elif line.strip() == 'ready':
             self._logger.debug("This subscriber is ready now.")
-            self.ready = True
-            self.factory.setConnectionReady(self)
-            self.ready_d.callback(self)
-            return 'vars_received'
+            return self._setReady()
 
         else:
             self._logger.error('Unexpected command received "%s"', line)
             self._logger.error('closing connection.')
             return 'done'
 
+    def _setReady(self):
+        self.ready = True
+        self.factory.setConnectionReady(self)
+        self.ready_d.callback(self)
+        return 'vars_received'
+
     def proto_vars_received(self, line):
         if line.strip() == 'vars_received':
             self.factory.setConnectionReceived(self)
@@ -161,16 +333,42 @@ class ExperimentServiceProto(LineReceiver):
 class ExperimentServiceFactory(Factory):
     protocol = ExperimentServiceProto
 
-    def __init__(self, expected_subscribers, experiment_start_delay):
+    def __init__(self, expected_subscribers, experiment_start_delay, peer_directory=False, persistent=True):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.expected_subscribers = expected_subscribers
         self.experiment_start_delay = experiment_start_delay
+        self.peer_directory = peer_directory
+        # The peer directory can only be used if we keep the connections open
+        self.persistent = persistent or peer_directory
+        self.experiment_started = False
+        self.directory = {}
+        self.barriers = {}
+        self.released_barriers = {}
+        self.kv_store = {}
+        self._kv_pending_updates = {}
+        self._kv_flush_call = None
+        self.request_handlers = {
+            'lookup': self.handleLookupRequest,
+            'kv_subscribe': self.handleKVSubscribeRequest
+        }
+        self.event_handlers = {
+            'barrier': self.handleBarrierEvent,
+            'kv': self.handleKVEvent
+        }
         self.parsing_semaphore = DeferredSemaphore(500)
         self.connection_counter = -1
-        self.connections_made = []
-        self.connections_ready = []
-        self.vars_received = []
+        self.sessions = {}
+        self.document = None
+        self.start_time = None
+        self.local_host = UNIX_SOCKET_HOST
+        # The connections in every phase, indexed by subscriber id, and the number of subscribers behind them
+        self.connections_made = OrderedDict()
+        self.connections_ready = OrderedDict()
+        self.vars_received = OrderedDict()
+        self.subscribers_made = 0
+        self.subscribers_ready = 0
+        self.subscribers_received = 0
 
         self._made_looping_call = None
         self._subscriber_looping_call = None
@@ -178,17 +376,35 @@ class ExperimentServiceFactory(Factory):
         self._timeout_delayed_call = None
 
     def buildProtocol(self, addr):
+        # The id is allocated once the connection registers, a resumed session keeps its id
+        return self.protocol(self, None)
+
+    def _allocateId(self):
         self.connection_counter += 1
-        return ExperimentServiceProto(self, self.connection_counter + 1)
+        return self.connection_counter + 1
 
-    def setConnectionMade(self, proto):
+    def setConnectionMade(self, proto, relayed_subscribers=None):
+        """
+        Register a new connection, once its first line arrived.
+
+        :param proto: the connection
+        :param relayed_subscribers: the number of subscribers if the connection is a relay, which get an id each
+        """
         if not self._timeout_delayed_call:
             self._timeout_delayed_call = reactor.callLater(EXPERIMENT_SYNC_TIMEOUT, self.onExperimentSetupTimeout)
         else:
             self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
 
-        self.connections_made.append(proto)
-        if len(self.connections_made) >= self.expected_subscribers:
+        proto.id = self._allocateId()
+        if relayed_subscribers is not None:
+            proto.subscriber_count = relayed_subscribers
+            proto.relayed_ids = [proto.id] + [self._allocateId() for _ in range(relayed_subscribers - 1)]
+        self.connections_made[proto.id] = proto
+        self.subscribers_made += proto.subscriber_count
+        self._checkConnectionsMade()
+
+    def _checkConnectionsMade(self):
+        if self.subscribers_made >= self.expected_subscribers:
             self._logger.info("All subscribers connected!")
             if self._made_looping_call and self._made_looping_call.running:
                 self._made_looping_call.stop()
@@ -200,18 +416,20 @@ class ExperimentServiceFactory(Factory):
                 self._made_looping_call.start(1.0)
 
     def _print_subscribers_made(self):
-        if len(self.connections_made) < self.expected_subscribers:
-            self._logger.info("%d of %d expected subscribers connected.", len(self.connections_made), self.expected_subscribers)
+        if self.subscribers_made < self.expected_subscribers:
+            self._logger.info("%d of %d expected subscribers connected.", self.subscribers_made,
+                              self.expected_subscribers)
 
     def pushIdToSubscribers(self):
-        for proto in self.connections_made:
+        for proto in self.connections_made.values():
             self.parsing_semaphore.run(proto.sendAndWaitForReady)
 
     def setConnectionReady(self, proto):
         self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
-        self.connections_ready.append(proto)
+        self.connections_ready[proto.id] = proto
+        self.subscribers_ready += proto.subscriber_count
 
-        if len(self.connections_ready) >= self.expected_subscribers:
+        if self.subscribers_ready >= self.expected_subscribers:
             self._logger.info("All subscribers are ready, pushing data!")
             if self._subscriber_looping_call and self._subscriber_looping_call.running:
                 self._subscriber_looping_call.stop()
@@ -223,24 +441,39 @@ class ExperimentServiceFactory(Factory):
                 self._subscriber_looping_call.start(1.0)
 
     def _print_subscribers_ready(self):
-        self._logger.info("%d of %d expected subscribers ready.", len(self.connections_ready),
-                          self.expected_subscribers)
+        self._logger.info("%d of %d expected subscribers ready.", self.subscribers_ready, self.expected_subscribers)
+
+    def getLocalHost(self):
+        """
+        Returns the address at which the remote subscribers reached this host, which is given to the subscribers that are
+        connected over a unix domain socket. Without remote subscribers, everyone runs on this host.
+        """
+        for subscriber in self.connections_ready.values():
+            host = getattr(subscriber.transport.getHost(), 'host', None)
+            if host and not is_loopback_host(host):
+                return host
+        return UNIX_SOCKET_HOST
 
     def pushInfoToSubscribers(self):
         # Generate the json doc
+        self.local_host = self.getLocalHost()
         vars = {}
-        for subscriber in self.connections_ready:
-            subscriber_vars = subscriber.vars.copy()
-            if "port" not in subscriber_vars:
-                subscriber_vars['port'] = subscriber.id + 12000
-            if "host" not in subscriber_vars:
-                subscriber_vars['host'] = subscriber.transport.getPeer().host
-            vars[subscriber.id] = subscriber_vars
+        for subscriber in self.connections_ready.values():
+            vars.update(subscriber.getSubscriberVars())
+
+        if self.peer_directory:
+            # Keep the full vars around and only send the fields everyone needs
+            self.directory = vars
+            vars = dict((subscriber_id, dict((key, value) for key, value in subscriber_vars.items()
+                                             if key in DIRECTORY_FIELDS))
+                        for subscriber_id, subscriber_vars in self.directory.items())
 
         vars = {
             b"server":
                 {
-                    b"global_random": randint(0, (2 ** 32) - 1)
+                    b"global_random": randint(0, (2 ** 32) - 1),
+                    b"directory": self.peer_directory,
+                    b"persistent": self.persistent
                 },
             b"clients": vars
         }
@@ -249,17 +482,35 @@ class ExperimentServiceFactory(Factory):
         self._logger.info("Pushing a %d bytes long json doc.", len(json_vars))
 
         # Send the json doc to the subscribers
-        cooperate(self._sendLineToAllGenerator(json_vars))
-
-    def _sendLineToAllGenerator(self, line):
-        for subscriber in self.connections_ready:
-            yield subscriber.sendLine(line)
+        cooperate(self._sendDocumentToAllGenerator(json_vars))
+
+    def _sendDocumentToAllGenerator(self, json_vars, compressed_chunks=None):
+        if compressed_chunks is None and any(subscriber.framing == FRAMING_ZLIB
+                                             for subscriber in self.connections_ready.values()):
+            compressed_chunks = compress_document(json_vars)
+            self._logger.info("Compressed the json doc to %d bytes.", sum(len(chunk) for chunk in compressed_chunks))
+
+        # Kept around for the subscribers that resume their session
+        self.document = (json_vars, compressed_chunks)
+        for subscriber in list(self.connections_ready.values()):
+            for result in self._sendDocumentGenerator(subscriber):
+                yield result
+
+    def _sendDocumentGenerator(self, subscriber):
+        json_vars, compressed_chunks = self.document
+        if subscriber.framing == FRAMING_ZLIB and compressed_chunks is not None:
+            subscriber.sendLine(b"blob:%d" % sum(len(chunk) for chunk in compressed_chunks))
+            for chunk in compressed_chunks:
+                yield subscriber.transport.write(chunk)
+        else:
+            yield subscriber.sendLine(json_vars)
 
     def setConnectionReceived(self, proto):
         self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
-        self.vars_received.append(proto)
+        self.vars_received[proto.id] = proto
+        self.subscribers_received += proto.subscriber_count
 
-        if len(self.vars_received) >= self.expected_subscribers:
+        if self.subscribers_received >= self.expected_subscribers:
             self._logger.info("Data sent to all subscribers, giving the go signal in %f secs.",
                               self.experiment_start_delay)
             reactor.callLater(0, self.startExperiment)
@@ -270,8 +521,8 @@ class ExperimentServiceFactory(Factory):
                 self._subscriber_received_looping_call.start(1.0)
 
     def _print_subscribers_received(self):
-        self._logger.info("%d of %d expected subscribers received the data.", len(self.vars_received),
-                          self.expected_subscribers)
+        self._logger.info("%d of %d expected subscribers received the data.",
+                          self.subscribers_received, self.expected_subscribers)
 
     def startExperiment(self):
         # Give the go signal and disconnect
@@ -280,37 +531,208 @@ class ExperimentServiceFactory(Factory):
         if self._subscriber_received_looping_call and self._subscriber_received_looping_call.running:
             self._subscriber_received_looping_call.stop()
 
-        start_time = time() + self.experiment_start_delay
-        for subscriber in self.connections_ready:
+        self.sendGoToSubscribers(time() + self.experiment_start_delay)
+
+    def sendGoToSubscribers(self, start_time):
+        """
+        Send the go signal to all the subscribers and, unless the connections are persistent, disconnect them shortly
+        after.
+
+        :param start_time: the experiment start time according to our own clock.
+        """
+        self.experiment_started = True
+        self.start_time = start_time
+        for subscriber in self.connections_ready.values():
             # Sync the experiment start time among instances
             subscriber.sendLine(b"go:%f" % (start_time + subscriber.vars['time_offset']))
 
-        d = deferLater(reactor, 5, lambda: self._logger.info("Done, disconnecting all clients."))
-        d.addCallback(lambda _: self.disconnectAll())
+        if self.persistent:
+            d = deferLater(reactor, 5, lambda: self._logger.info("Done, keeping the connections open."))
+        else:
+            d = deferLater(reactor, 5, lambda: self._logger.info("Done, disconnecting all clients."))
+            d.addCallback(lambda _: self.disconnectAll())
         d.addCallbacks(self.onExperimentStarted, self.onExperimentStartError)
 
     def disconnectAll(self):
         reactor.runUntilCurrent()
 
         def _disconnectAll():
-            for subscriber in self.connections_ready:
+            for subscriber in list(self.connections_ready.values()):
                 yield subscriber.transport.loseConnection()
         cooperate(_disconnectAll())
 
     def unregisterConnection(self, proto):
-        if proto in self.connections_ready:
-            self.connections_ready.remove(proto)
-        if proto in self.vars_received:
-            self.vars_received.remove(proto)
-        if proto.id in self.vars_received:
-            self.vars_received.remove(proto.id)
+        if self.sessions.get(proto.session_token) is proto:
+            if not self.experiment_started:
+                self._logger.warning("Lost the connection with subscriber %s, waiting for it to resume its session",
+                                     proto.id)
+                return
+            del self.sessions[proto.session_token]
+
+        if self.connections_made.get(proto.id) is proto:
+            del self.connections_made[proto.id]
+            self.subscribers_made -= proto.subscriber_count
+        if self.connections_ready.get(proto.id) is proto:
+            del self.connections_ready[proto.id]
+            self.subscribers_ready -= proto.subscriber_count
+        if self.vars_received.get(proto.id) is proto:
+            del self.vars_received[proto.id]
+            self.subscribers_received -= proto.subscriber_count
 
         self._logger.debug("Connection cleanly unregistered.")
 
+        if self.persistent and self.experiment_started and not self.connections_ready:
+            self.onAllConnectionsLost()
+
+    def resumeSession(self, proto, token, client_state):
+        """
+        Let a new connection take over the session of a subscriber that reconnected.
+
+        :param proto: the new connection of the subscriber
+        :param token: the session token of the subscriber
+        :param client_state: the protocol state of the subscriber
+        :return: the protocol state of the new connection
+        """
+        previous = self.sessions.get(token)
+        if previous is None:
+            self._logger.error("A subscriber tried to resume an unknown session")
+            proto.sendLine(b"resumed:unknown")
+            return 'done'
+
+        self._logger.info("Subscriber %s resumed its session", previous.id)
+        for attribute in SESSION_ATTRIBUTES:
+            setattr(proto, attribute, getattr(previous, attribute))
+        proto.session_token = token
+        self.sessions[token] = proto
+        for connections in (self.connections_made, self.connections_ready, self.vars_received):
+            if connections.get(proto.id) is previous:
+                connections[proto.id] = proto
+        if previous.transport.connected:
+            previous.transport.loseConnection()
+
+        proto.sendLine(b"resumed:%s" % proto.state)
+        if client_state == 'all_vars' and self.document is not None and proto.ready:
+            for _ in self._sendDocumentGenerator(proto):
+                pass
+        elif client_state == 'go' and self.start_time is not None:
+            proto.sendLine(b"go:%f" % (self.start_time + proto.vars['time_offset']))
+        return proto.state
+
+    def handleRequest(self, proto, request_id, verb, payload):
+        """
+        Handle a request sent by a subscriber and send back the response.
+
+        :param proto: the connection the request was received on
+        :param request_id: the id the subscriber assigned to the request
+        :param verb: the kind of request
+        :param payload: the JSON encoded request arguments
+        """
+        if verb not in self.request_handlers:
+            self._logger.error("Unknown request %s received", verb)
+            return
+
+        def send_response(result):
+            if proto.transport.connected:
+                proto.sendLine(b"res:%s:%s" % (request_id, json.dumps(result)))
+
+        d = maybeDeferred(self.request_handlers[verb], proto, json.loads(payload))
+        d.addCallback(send_response)
+        d.addErrback(lambda failure: self._logger.error("Request %s failed: %s", verb, failure.getErrorMessage()))
+
+    def handleEvent(self, proto, name, payload):
+        """
+        Handle an event sent by a subscriber.
+
+        :param proto: the connection the event was received on
+        :param name: the kind of event
+        :param payload: the JSON encoded event arguments
+        """
+        if name not in self.event_handlers:
+            self._logger.error("Unknown event %s received", name)
+            return
+        self.event_handlers[name](proto, json.loads(payload))
+
+    def sendEventToAll(self, name, payload):
+        line = b"evt:%s:%s" % (name, json.dumps(payload))
+        for subscriber in self.connections_ready.values():
+            subscriber.sendLine(line)
+
+    def handleBarrierEvent(self, proto, arrival):
+        name = arrival['name']
+        if name in self.released_barriers:
+            # A latecomer, let it continue straight away
+            self._logger.warning("Subscriber %s arrived at barrier %s after it was released", arrival['id'], name)
+            proto.sendLine(b"evt:barrier:%s" % json.dumps(self.released_barriers[name]))
+            return
+
+        if name not in self.barriers:
+            self.barriers[name] = {'arrived': set(), 'timeout': None}
+        barrier = self.barriers[name]
+        barrier['arrived'].add(arrival['id'])
+
+        if arrival.get('timeout') and not barrier['timeout']:
+            barrier['timeout'] = reactor.callLater(arrival['timeout'], self.releaseBarrier, name)
+
+        quorum = arrival.get('quorum') or self.expected_subscribers
+        if quorum < 1:
+            quorum = int(ceil(quorum * self.expected_subscribers))
+        if len(barrier['arrived']) >= quorum:
+            self.releaseBarrier(name)
+
+    def releaseBarrier(self, name):
+        barrier = self.barriers.pop(name)
+        if barrier['timeout'] and barrier['timeout'].active():
+            barrier['timeout'].cancel()
+
+        if len(barrier['arrived']) < self.expected_subscribers:
+            self._logger.warning("Releasing barrier %s with %d of %d subscribers arrived", name,
+                                 len(barrier['arrived']), self.expected_subscribers)
+        else:
+            self._logger.info("Releasing barrier %s", name)
+
+        self.released_barriers[name] = {'name': name, 'time': time() + BARRIER_RELEASE_DELAY}
+        self.sendEventToAll(b"barrier", self.released_barriers[name])
+
+    def handleLookupRequest(self, _, subscriber_ids):
+        return dict((subscriber_id, self.directory[int(subscriber_id)]) for subscriber_id in subscriber_ids
+                    if int(subscriber_id) in self.directory)
+
+    def handleKVSubscribeRequest(self, proto, subscription):
+        prefix = subscription['prefix']
+        proto.kv_prefixes.add(prefix)
+        return dict((key, value) for key, value in self.kv_store.items() if key.startswith(prefix))
+
+    def handleKVEvent(self, _, publication):
+        self.kv_store.update(publication['updates'])
+        self._kv_pending_updates.update(publication['updates'])
+        if not self._kv_flush_call:
+            self._kv_flush_call = reactor.callLater(KV_BATCH_DELAY, self.flushKVUpdates)
+
+    def flushKVUpdates(self):
+        """
+        Send the updates of the key-value store collected since the last flush to the connections subscribed to them.
+        """
+        self._kv_flush_call = None
+        updates, self._kv_pending_updates = self._kv_pending_updates, {}
+        for subscriber in self.connections_made.values():
+            if not subscriber.kv_prefixes:
+                continue
+            subscriber_updates = dict((key, value) for key, value in updates.items()
+                                      if any(key.startswith(prefix) for prefix in subscriber.kv_prefixes))
+            if subscriber_updates:
+                subscriber.sendLine(b"evt:kv:%s" % json.dumps({"updates": subscriber_updates}))
+
     def onExperimentStarted(self, _):
+        if self.persistent:
+            self._logger.info("Experiment started, waiting for the subscribers to disconnect.")
+            return
         self._logger.info("Experiment started, shutting down sync server.")
         reactor.callLater(0, stop_reactor)
 
+    def onAllConnectionsLost(self):
+        self._logger.info("All subscribers disconnected, shutting down sync server.")
+        reactor.callLater(0, stop_reactor)
+
     def onExperimentStartError(self, failure):
         self._logger.error("Failed to start experiment")
         reactor.exitCode = 1
@@ -332,6 +754,50 @@ def stop_reactor():
         reactor.stop()
 
 
+def get_address_host(address, local_host=UNIX_SOCKET_HOST):
+    """
+    Returns the host of a transport address, unix domain socket addresses are on local_host.
+    """
+    return getattr(address, 'host', local_host)
+
+
+def is_loopback_host(host):
+    return host.startswith('127.') or host == '::1'
+
+
+def listen_for_subscribers(factory, port, socket_path=None):
+    """
+    Listen for subscribers on a TCP port and, if a socket path is given, on a unix domain socket for the subscribers
+    running on this host.
+
+    :param factory: the experiment server or relay factory
+    :param port: the TCP port to listen on
+    :param socket_path: the path of the unix domain socket, or None
+    :return: a list with the listening ports
+    """
+    listening_ports = [reactor.listenTCP(port, factory)]
+    if socket_path:
+        # The lock file lets a stale socket from a previous run be replaced
+        listening_ports.append(reactor.listenUNIX(socket_path, factory, wantPID=True))
+    return listening_ports
+
+
+def connect_to_experiment_server(factory, host, port, socket_path=None):
+    """
+    Connect to the experiment server (or relay), through its unix domain socket if it exists on this host, otherwise
+    over TCP.
+
+    :param factory: the client factory
+    :param host: the host of the server
+    :param port: the TCP port of the server
+    :param socket_path: the path of the unix domain socket of the server, or None
+    :return: the connector
+    """
+    if socket_path and path.exists(socket_path):
+        return reactor.connectUNIX(socket_path, factory)
+    return reactor.connectTCP(host, port, factory)
+
+
 class ExperimentClientFactory(ReconnectingClientFactory):
     maxDelay = 10
 
@@ -340,17 +806,295 @@ class ExperimentClientFactory(ReconnectingClientFactory):
 
         self.vars = vars
         self.protocol = protocol
+        self.client = None
 
     def buildProtocol(self, address):
+        if self.client and self.client.session_token:
+            # Keep our id, vars and scenario when reconnecting
+            self._logger.debug("Attempting to resume the session with the experiment server.")
+            return self.client
+
         self._logger.debug("Attempting to connect to the experiment server.")
         p = self.protocol(self.vars)
         p.factory = self
+        self.client = p
+        return p
+
+    def clientConnectionFailed(self, connector, reason):
+        self._logger.error("Failed to connect to experiment server (will retry in a while), error was: %s",
+                           reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        self._logger.info("The connection with the experiment server was lost with reason: %s",
+                          reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+
+class ExperimentRelayUpstreamProto(LineReceiver):
+    """
+    The connection of a relay with the experiment server. It reports on behalf of all the subscribers of the relay.
+    """
+    # Allow for 4MB long lines (for the json stuff)
+    MAX_LENGTH = 2 ** 22
+
+    def __init__(self, relay_factory):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.relay_factory = relay_factory
+        self.state = "ids"
+        self.session_token = None
+        self._decoder = None
+        self._batch = None
+        self._vars_received_sent = False
+        self.clock_estimator = ClockOffsetEstimator(self.sendLine)
+
+    def connectionMade(self):
+        self.factory.resetDelay()
+        self.relay_factory.upstream = self
+        if self.session_token:
+            self._logger.info("Reconnected to the experiment server, resuming the session")
+            # Whatever was partially received over the previous connection will be sent again
+            self.clearLineBuffer()
+            self._decoder = None
+            self.setLineMode()
+            self.sendLine(b"resume:%s:%s" % (self.session_token, self.state))
+            return
+
+        self._logger.debug("Connected to the experiment server")
+        self.sendLine(b"relay:%d" % self.relay_factory.expected_subscribers)
+        self.sendLine(b"time:%f" % time())
+        self.sendLine(b"framing:%s" % FRAMING_ZLIB)
+        self.clock_estimator.start()
+        self.state = "ids"
+
+    def lineReceived(self, line):
+        if line.startswith(b'pong:'):
+            self.clock_estimator.on_pong(line)
+            return
+        if line.startswith(b'resumed:'):
+            self.on_session_resumed(line.strip().split(b':', 1)[1])
+            return
+        if line.startswith(b'res:'):
+            _, request_id, payload = line.strip().split(b':', 2)
+            self.relay_factory.forwardResponse(int(request_id), payload)
+            return
+        if line.startswith(b'evt:'):
+            self.relay_factory.forwardEvent(line.strip())
+            return
+
+        try:
+            pto = 'proto_' + self.state
+            state_handler = getattr(self, pto)
+        except AttributeError:
+            self._logger.error('Callback %s not found. Stopping reactor.', self.state)
+            stop_reactor()
+        else:
+            self.state = state_handler(line)
+            if self.state == 'done':
+                self.factory.stopTrying()
+                self.transport.loseConnection()
+
+    def connectionLost(self, reason=connectionDone):
+        if self.relay_factory.upstream is self:
+            self.relay_factory.upstream = None
+        LineReceiver.connectionLost(self, reason)
+
+    def rawDataReceived(self, data):
+        rest = self._decoder.feed(data)
+        if self._decoder.done:
+            self._logger.debug("Got compressed experiment variables, relaying them")
+            self.relay_factory.pushInfoToSubscribers(self._decoder.get_document(), self._decoder.compressed_chunks)
+            self._decoder = None
+            self.state = "go"
+            self.setLineMode(rest)
+
+    def sendBatch(self, subscribers_vars):
+        self._batch = subscribers_vars
+        self.sendLine(b"batch:%s" % json.dumps(subscribers_vars))
+
+    def sendVarsReceived(self):
+        self._vars_received_sent = True
+        self.sendLine(b"vars_received")
+
+    def on_session_resumed(self, server_state):
+        """
+        Repeat whatever the experiment server didn't receive before the connection dropped. Without our session, the
+        server would hand out new ids that clash with those of our local subscribers, so we give up instead.
+
+        :param server_state: the state of the server for this relay, or unknown if the session couldn't be resumed
+        """
+        if server_state == b"unknown":
+            self._logger.error("The experiment server could not resume our session, giving up")
+            self.factory.stopTrying()
+            self.transport.loseConnection()
+            reactor.exitCode = 1
+            reactor.callLater(0, stop_reactor)
+            return
+
+        self._logger.info("Resumed the session with the experiment server")
+        if server_state == b"init" and self._batch is not None:
+            self.sendBatch(self._batch)
+        elif server_state == b"vars_received" and self._vars_received_sent:
+            self.sendVarsReceived()
+
+    #
+    # Protocol state handlers
+    #
+
+    def proto_ids(self, line):
+        maybe_ids, ids, self.session_token = (line.strip().split(b':', 2) + [None])[:3]
+        if maybe_ids == b"ids":
+            self.relay_factory.setIdsReceived([int(relayed_id) for relayed_id in ids.split(b',')])
+            return "all_vars"
+        self._logger.error("Received an unexpected string from the server, closing connection")
+        return "done"
+
+    def proto_all_vars(self, line):
+        if line.startswith(b"blob:"):
+            self._decoder = DocumentDecoder(int(line.strip().split(b":")[1]), keep_compressed=True)
+            self.setRawMode()
+            return "all_vars"
+
+        self._logger.debug("Got experiment variables, relaying them")
+        self.relay_factory.pushInfoToSubscribers(line)
+        return "go"
+
+    def proto_go(self, line):
+        if line.strip().startswith(b"go:"):
+            self._logger.debug("Got GO signal, relaying it")
+            self.factory.stopTrying()
+            self.relay_factory.sendGoToSubscribers(float(line.strip().split(b":")[1]))
+            return "running" if self.relay_factory.persistent else "done"
+        self._logger.error("Received an unexpected string from the server, closing connection")
+        return "done"
+
+    def proto_running(self, line):
+        self._logger.error("Received an unexpected string from the server: %s", line)
+        return "running"
+
+
+class ExperimentRelayFactory(ExperimentServiceFactory):
+    """
+    Experiment server for the instances running on a single host. It gathers the local subscribers and reports them
+    upstream as a single connection. The JSON document and the go signal received from upstream are fanned out to the
+    local subscribers.
+    """
+
+    def __init__(self, expected_subscribers):
+        ExperimentServiceFactory.__init__(self, expected_subscribers, 0)
+        self.upstream = None
+        self.relayed_ids = None
+        self._all_connected = False
+        self._request_counter = 0
+        self._forwarded_requests = {}
+
+    def pushIdToSubscribers(self):
+        self._all_connected = True
+        self._pushRelayedIdsToSubscribers()
+
+    def setIdsReceived(self, relayed_ids):
+        self.relayed_ids = relayed_ids
+        self._pushRelayedIdsToSubscribers()
+
+    def _pushRelayedIdsToSubscribers(self):
+        if not (self._all_connected and self.relayed_ids):
+            return
+
+        # Index the local subscribers by the ids assigned upstream
+        connections_made = self.connections_made
+        self.connections_made = OrderedDict()
+        for proto, relayed_id in zip(connections_made.values(), self.relayed_ids):
+            proto.id = relayed_id
+            self.connections_made[relayed_id] = proto
+        ExperimentServiceFactory.pushIdToSubscribers(self)
+
+    def pushInfoToSubscribers(self, json_vars=None, compressed_chunks=None):
+        if json_vars is None:
+            # All local subscribers are ready, report them upstream. The upstream server would only see our own
+            # address, so we fill in the host as it is seen from there. Over a unix domain socket we run on the host
+            # of the server, which fills in the address at which the remote subscribers reach it.
+            upstream_host = getattr(self.upstream.transport.getHost(), 'host', None)
+            subscribers_vars = {}
+            for subscriber in self.connections_ready.values():
+                subscriber_vars = subscriber.vars.copy()
+                if "host" not in subscriber_vars and upstream_host:
+                    subscriber_vars['host'] = upstream_host
+                subscribers_vars[subscriber.id] = subscriber_vars
+            self._logger.info("Reporting %d subscribers upstream.", len(subscribers_vars))
+            # Our own offset has to be known upstream before the batch arrives
+            self.upstream.clock_estimator.done.addCallback(lambda _: self.upstream.sendBatch(subscribers_vars))
+        else:
+            self._logger.info("Relaying a %d bytes long json doc.", len(json_vars))
+            self.persistent = json.loads(json_vars)["server"].get("persistent", False)
+            cooperate(self._sendDocumentToAllGenerator(json_vars, compressed_chunks))
+
+    def startExperiment(self):
+        # All local subscribers received the data, the go signal will come from upstream
+        if self._subscriber_received_looping_call and self._subscriber_received_looping_call.running:
+            self._subscriber_received_looping_call.stop()
+        self.upstream.sendVarsReceived()
+
+    def handleRequest(self, proto, request_id, verb, payload):
+        # Requests are answered by the upstream server, keep track of where to send the response to
+        if not self.upstream:
+            self._logger.error("Not connected to the experiment server, dropping request %s", verb)
+            return
+
+        self._request_counter += 1
+        self._forwarded_requests[self._request_counter] = (proto, request_id)
+        self.upstream.sendLine(b"req:%d:%s:%s" % (self._request_counter, verb, payload))
+
+    def forwardResponse(self, relay_request_id, payload):
+        proto, request_id = self._forwarded_requests.pop(relay_request_id)
+        if proto.transport.connected:
+            proto.sendLine(b"res:%s:%s" % (request_id, payload))
+
+    def handleEvent(self, proto, name, payload):
+        if not self.upstream:
+            self._logger.error("Not connected to the experiment server, dropping event %s", name)
+            return
+        self.upstream.sendLine(b"evt:%s:%s" % (name, payload))
+
+    def forwardEvent(self, line):
+        for subscriber in self.connections_ready.values():
+            subscriber.sendLine(line)
+
+    def onExperimentSetupTimeout(self):
+        if self.upstream and self.subscribers_ready >= self.expected_subscribers:
+            # Our subscribers are all there, it's up to the upstream server to decide when to give up
+            self._logger.info("Still waiting for the experiment server.")
+            self._timeout_delayed_call = reactor.callLater(EXPERIMENT_SYNC_TIMEOUT, self.onExperimentSetupTimeout)
+        else:
+            ExperimentServiceFactory.onExperimentSetupTimeout(self)
+
+
+class ExperimentRelayClientFactory(ReconnectingClientFactory):
+    maxDelay = 10
+
+    def __init__(self, relay_factory):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.relay_factory = relay_factory
+        self.upstream = None
+
+    def buildProtocol(self, address):
+        if self.upstream and self.upstream.session_token:
+            # Keep the ids of our local subscribers when reconnecting
+            self._logger.debug("Attempting to resume the session with the experiment server.")
+            return self.upstream
+
+        self._logger.debug("Attempting to connect to the experiment server.")
+        p = ExperimentRelayUpstreamProto(self.relay_factory)
+        p.factory = self
+        self.upstream = p
         return p
 
     def clientConnectionFailed(self, connector, reason):
         self._logger.error("Failed to connect to experiment server (will retry in a while), error was: %s",
                            reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
 
     def clientConnectionLost(self, connector, reason):
         self._logger.info("The connection with the experiment server was lost with reason: %s",
                           reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from base64 import b64encode
+
+from twisted.internet.defer import Deferred
+from twisted.test.proto_helpers import StringTransport
+
+from ipv8.keyvault.crypto import default_eccrypto
+
+from gumby.experiment import ExperimentClient
+from gumby.modules.community_experiment_module import IPv8OverlayExperimentModule
+from gumby.modules.experiment_module import ExperimentModule
+from gumby.tests.mocking import MockOverlay
+
+
+class MockIPv8Provider(ExperimentModule):
+
+    def __init__(self, experiment):
+        super(MockIPv8Provider, self).__init__(experiment)
+        self.has_ipv8 = True
+        self.ipv8_available = Deferred()
+
+
+class TestIPv8OverlayExperimentModule(unittest.TestCase):
+
+    def setUp(self):
+        super(TestIPv8OverlayExperimentModule, self).setUp()
+        self.client = ExperimentClient({})
+        self.client.transport = StringTransport()
+        self.client.my_id = 1
+        # The all_vars document is written to the working directory
+        self.addCleanup(os.chdir, os.getcwd())
+        temporary_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temporary_dir)
+        os.chdir(temporary_dir)
+
+        MockIPv8Provider(self.client)
+        self.module = IPv8OverlayExperimentModule(self.client, MockOverlay)
+        self.key = default_eccrypto.generate_key(u"curve25519")
+
+    def test_get_peer_directory(self):
+        """
+        Test that with a peer directory, a peer can be used once its public key was prefetched.
+        """
+        self.client.on_all_vars_document(json.dumps({
+            "clients": {"1": {"host": "10.0.0.1", "port": 12001, "time_offset": 0},
+                        "2": {"host": "10.0.0.2", "port": 12002, "time_offset": 0}},
+            "server": {"directory": True}
+        }).encode("utf-8"))
+        self.assertRaises(KeyError, self.module.get_peer, "2")
+
+        prefetched = []
+        self.module.prefetch_peers(["2"]).addCallback(prefetched.append)
+        self.client._lookup_flush_call.cancel()
+        self.client._flush_lookups()
+        public_key = b64encode(self.key.pub().key_to_bin()).decode('utf-8')
+        self.client.lineReceived(b"res:1:%s" % json.dumps({"2": {"host": "10.0.0.2", "port": 12002,
+                                                                "public_key": public_key}}).encode("utf-8"))
+        self.assertTrue(prefetched)
+
+        peer = self.module.get_peer("2")
+        self.assertEqual(peer.public_key.key_to_bin(), self.key.pub().key_to_bin())
+        self.assertEqual(peer.address, ("10.0.0.2", 12002))
+        self.assertIsNot(self.module.get_peer("2"), peer)
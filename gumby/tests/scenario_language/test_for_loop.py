@@ -125,6 +125,15 @@ class TestForLoop(unittest.TestCase):
 
         self.assertFalse(self.local_storage, "The local storage should be empty.")
 
+    def test_for_loop_peerspec_large_range(self):
+        """
+        Test that only the iteration of the current node is expanded when the peerspec is the control variable, without
+        walking the whole range of the loop.
+        """
+        commands = self.scenario_parser._parse_scenario_line("test.file", 1, "@! for i in 1000000000 to 1 call store "
+                                                             "some_key $i", "$i")
+        self.assertEqual(list(commands), [(-1, "test.file", 1, "store", ["some_key", "1"], {})])
+
     def test_for_loop_peerspec_static_included(self):
         """
         Test that a peerspec is able to correctly identify if the current node should execute an iteration when it's
@@ -144,6 +153,16 @@ class TestForLoop(unittest.TestCase):
 
         self.assertFalse(self.local_storage, "The local storage should be empty")
 
+    def test_for_loop_peerspec_list(self):
+        """
+        Test that a for loop with an explicit list or range of peers is not executed, not even by the peers in it. Only
+        an empty peerspec, the control variable or a single peer number select the iterations of a peer.
+        """
+        self.execution_wrapper("@! for i in 1 to 5 call store $i some_value", peerspec="1,2")
+        self.execution_wrapper("@! for i in 1 to 5 call store $i some_value", peerspec="1-3")
+
+        self.assertFalse(self.local_storage, "The local storage should be empty")
+
     def test_for_loop_with_variables(self):
         """
         Test that a for loop which uses variables, that conflict in name with the control variable, the still works
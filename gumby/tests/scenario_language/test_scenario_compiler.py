@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from gumby.scenario import ScenarioRunner, load_compiled_scenario
+
+SCENARIO = """
+&include included.scenario
+@! set greeting hello
+@0:1 echo $greeting $COMPILER_TEST_VAR
+@0:2 echo only_one_two {1,2}
+@0:2 echo not_three {!3}
+@0:3 echo range {2-4}
+@0:4 for i in 1 to 5 call echo loop $i {$i}
+@0:5 for i in 3 to 1 call echo everyone $i
+@0:6 for i in 1 to 3 call echo peer_two $i {2}
+@0:7 for i in 1 to 3 call echo nobody $i {1-2}
+@0:8 echo invalid {$i}
+@0:9-0:20 every 2 jitter=1 echo recurring {2-5}
+@0:10 echo labeled as=done {1-3}
+after:done+0:02 echo dependent {!2}
+after:done for i in 1 to 6 call echo dependent_loop $i {$i}
+@! set greeting bye
+1:0:0 echo $greeting named=$greeting
+"""
+
+INCLUDED_SCENARIO = """
+@0:0 echo included
+"""
+
+
+class TestScenarioCompiler(unittest.TestCase):
+    """
+    Tests that the compiled scenario schedules match the scenario as parsed by every peer.
+    """
+
+    def setUp(self):
+        super(TestScenarioCompiler, self).setUp()
+        self.temporary_dir = tempfile.mkdtemp()
+        self.scenario_file = os.path.join(self.temporary_dir, "test.scenario")
+        self.write_scenario(SCENARIO)
+        with open(os.path.join(self.temporary_dir, "included.scenario"), "w") as included_file:
+            included_file.write(INCLUDED_SCENARIO)
+        os.environ["COMPILER_TEST_VAR"] = "world"
+
+    def tearDown(self):
+        super(TestScenarioCompiler, self).tearDown()
+        shutil.rmtree(self.temporary_dir)
+        del os.environ["COMPILER_TEST_VAR"]
+
+    def write_scenario(self, scenario):
+        with open(self.scenario_file, "w") as scenario_file:
+            scenario_file.write(scenario)
+
+    def get_commands(self, peernumber, cache_dir):
+        """
+        Parse the scenario for a peer, applying the immediate set commands as ScenarioRunner.run would.
+        """
+        scenario_runner = ScenarioRunner()
+        scenario_runner.cache_dir = cache_dir
+        scenario_runner.set_peernumber(peernumber)
+        scenario_runner.add_scenario(self.scenario_file)
+
+        commands = []
+        for command in scenario_runner._parse_scenario():
+            if command[0] < 0 and command[3] == "set":
+                scenario_runner.user_defined_vars[command[4][0]] = command[4][1]
+            commands.append(command)
+        return commands
+
+    def test_compiled_commands(self):
+        """
+        Test that every peer gets the same commands from the compiled scenario as when parsing it itself.
+        """
+        for peernumber in range(1, 7):
+            self.assertEqual(self.get_commands(peernumber, self.temporary_dir), self.get_commands(peernumber, None))
+
+    def test_recompile_on_change(self):
+        """
+        Test that the compiled scenario is replaced when the scenario or the environment variables it uses change.
+        """
+        self.assertEqual(self.get_commands(1, self.temporary_dir)[2][4], ["hello", "world"])
+
+        os.environ["COMPILER_TEST_VAR"] = "universe"
+        self.assertEqual(self.get_commands(1, self.temporary_dir)[2][4], ["hello", "universe"])
+
+        self.write_scenario("@0:1 echo changed\n")
+        self.assertEqual(self.get_commands(1, self.temporary_dir), [(1, self.scenario_file, 1, "echo", ["changed"],
+                                                                    {})])
+
+    def test_peer_specific_set(self):
+        """
+        Test that a scenario which sets variables for some peers only is parsed by every peer itself.
+        """
+        self.write_scenario("@! set greeting hi {1}\n@0:1 echo $greeting\n")
+        self.assertIsNone(load_compiled_scenario(self.scenario_file, self.temporary_dir))
+        self.assertEqual(self.get_commands(1, self.temporary_dir), self.get_commands(1, None))
+        self.assertEqual(self.get_commands(2, self.temporary_dir), self.get_commands(2, None))
+
+    def test_environment_keeps_schedules(self):
+        """
+        Test that instances with other values for the environment variables used in the scenario don't replace each
+        other's compiled scenario.
+        """
+        self.get_commands(1, self.temporary_dir)
+        os.environ["COMPILER_TEST_VAR"] = "universe"
+        self.get_commands(1, self.temporary_dir)
+        cache_files = dict((name, os.stat(os.path.join(self.temporary_dir, name)).st_ino)
+                           for name in os.listdir(self.temporary_dir) if name.endswith(".cache"))
+        self.assertEqual(len(cache_files), 2)
+
+        os.environ["COMPILER_TEST_VAR"] = "world"
+        self.assertEqual(self.get_commands(1, self.temporary_dir)[2][4], ["hello", "world"])
+        self.assertEqual(dict((name, os.stat(os.path.join(self.temporary_dir, name)).st_ino)
+                              for name in os.listdir(self.temporary_dir) if name.endswith(".cache")), cache_files)
@@ -0,0 +1,264 @@
+import os
+import unittest
+from time import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+from gumby.scenario import ArrivalProcess, ScenarioRunner
+
+
+class TestScenarioRunner(unittest.TestCase):
+    """
+    Tests the scheduling of scenario events.
+    """
+
+    def setUp(self):
+        super(TestScenarioRunner, self).setUp()
+        self.scenario_runner = ScenarioRunner()
+        self.scenario_runner.set_peernumber(1)
+        self.scenario_runner.register(self.store)
+        self.local_storage = []
+
+    def tearDown(self):
+        super(TestScenarioRunner, self).tearDown()
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+
+    def store(self, value):
+        self.local_storage.append(value)
+
+    def scheduled_times(self):
+        return sorted(call.getTime() for call in reactor.getDelayedCalls())
+
+    def test_single_delayed_call(self):
+        """
+        Test that only the first scenario event is scheduled on the reactor, and that due events run in time order.
+        """
+        self.scenario_runner.line_buffer = [("test.scenario", 1, "@0:20 store c"), ("test.scenario", 2, "@0:10 store a"),
+                                            ("test.scenario", 3, "@0:10 store b"), ("test.scenario", 4, "@0:30 store d")]
+        self.scenario_runner.run()
+        scheduled_times = self.scheduled_times()
+        self.assertEqual(len(scheduled_times), 1)
+        self.assertAlmostEqual(scheduled_times[0], self.scenario_runner.exp_start_time + 10, delta=1)
+
+        self.scenario_runner.exp_start_time -= 25
+        self.scenario_runner._run_due_events()
+        self.assertEqual(self.local_storage, ["a", "b", "c"])
+        self.assertEqual(len(reactor.getDelayedCalls()), 1)
+
+    def test_pause_resume(self):
+        """
+        Test that pausing holds the pending events and resuming reschedules them relative to the resume time.
+        """
+        self.scenario_runner.line_buffer = [("test.scenario", 1, "@0:10 store a"), ("test.scenario", 2, "@0:20 store b")]
+        self.scenario_runner.run()
+        self.assertEqual(len(reactor.getDelayedCalls()), 1)
+
+        self.scenario_runner.pause()
+        self.assertTrue(self.scenario_runner.paused)
+        self.assertFalse(reactor.getDelayedCalls())
+
+        resume_time = time() + 100
+        self.scenario_runner.resume(resume_time)
+        self.assertFalse(self.scenario_runner.paused)
+        scheduled_times = self.scheduled_times()
+        self.assertEqual(len(scheduled_times), 1)
+        self.assertAlmostEqual(scheduled_times[0], resume_time + 10, delta=1)
+
+        self.scenario_runner.exp_start_time = time() - 15
+        self.scenario_runner._run_due_events()
+        self.assertEqual(self.local_storage, ["a"])
+        self.assertAlmostEqual(self.scheduled_times()[0], time() + 5, delta=1)
+
+    def test_pause_from_event(self):
+        """
+        Test that the events due at the same time as an event that pauses the scenario are held as well.
+        """
+        self.scenario_runner.register(self.scenario_runner.pause, "pause")
+        self.scenario_runner.line_buffer = [("test.scenario", 1, "@0:1 store a"), ("test.scenario", 2, "@0:1 pause"),
+                                            ("test.scenario", 3, "@0:1 store b")]
+        self.scenario_runner.run()
+        self.scenario_runner.exp_start_time -= 2
+        self.scenario_runner._run_due_events()
+
+        self.assertEqual(self.local_storage, ["a"])
+        self.assertFalse(reactor.getDelayedCalls())
+
+    def test_resume_in_step(self):
+        """
+        Test that peers which were paused by the same event at different times continue in step after resuming.
+        """
+        start_time = time()
+        resume_time = start_time + 100
+        next_calls = []
+        for lateness in (0, 3):
+            scenario_runner = ScenarioRunner(start_time)
+            scenario_runner.set_peernumber(1)
+            scenario_runner.register(scenario_runner.pause, "pause")
+            scenario_runner.register(self.store)
+            scenario_runner.line_buffer = [("test.scenario", 1, "@0:10 pause"), ("test.scenario", 2, "@0:20 store a")]
+            scenario_runner.run()
+            # This peer runs the pause event late
+            scenario_runner.exp_start_time -= 10 + lateness
+            scenario_runner._run_due_events()
+            self.assertTrue(scenario_runner.paused)
+
+            scenario_runner.resume(resume_time)
+            next_calls.append(scenario_runner._next_call.getTime())
+
+        self.assertAlmostEqual(next_calls[0], resume_time + 10, delta=0.1)
+        self.assertAlmostEqual(next_calls[1], next_calls[0], delta=0.01)
+
+    def test_recurring_event(self):
+        """
+        Test that a recurring event is called every interval until its end, with a single event on the heap.
+        """
+        self.scenario_runner.line_buffer = [("test.scenario", 1, "@0:10-0:12 every 1 jitter=0.5 store a")]
+        self.scenario_runner.run()
+        self.assertEqual(len(self.scenario_runner._events), 1)
+        self.assertTrue(10 <= self.scenario_runner._events[0][0] <= 10.5)
+
+        for expected_calls in range(1, 4):
+            self.scenario_runner.exp_start_time = time() - self.scenario_runner._events[0][0] - 0.01
+            self.scenario_runner._run_due_events()
+            self.assertEqual(self.local_storage, ["a"] * expected_calls)
+        self.assertFalse(self.scenario_runner._events)
+
+    def test_recurring_event_syntax(self):
+        """
+        Test the parsing of recurring events, and that invalid ones are rejected.
+        """
+        self.assertEqual(self.scenario_runner._parse_scenario_line("test.scenario", 1, "@1:00 every 2 store a b=c", ""),
+                         [(60, "test.scenario", 1, "every", [2.0, None, 0.0, "store", "a"], {"b": "c"})])
+        for line in ["@! every 2 store a", "@1:00 every 0 store a", "@1:00 every 2 jitter=1", "@1:00 every store a"]:
+            self.assertIsNone(self.scenario_runner._parse_scenario_line("test.scenario", 1, line, ""))
+
+    def test_expand_line(self):
+        """
+        Test that lines are expanded with the current variables, and expanded again once a variable they use is set.
+        """
+        os.environ["RUNNER_TEST_VAR"] = "env"
+        self.addCleanup(os.environ.pop, "RUNNER_TEST_VAR")
+        variables = self.scenario_runner.user_defined_vars
+        variables["a"] = "1"
+        line = "@0:1 store $a $ab $RUNNER_TEST_VAR $unknown"
+        self.assertEqual(self.scenario_runner._expand_line(line), "@0:1 store 1 $ab env $unknown")
+
+        variables["ab"] = "2"
+        self.assertEqual(self.scenario_runner._expand_line(line), "@0:1 store 1 2 env $unknown")
+        variables["RUNNER_TEST_VAR"] = "user"
+        self.assertEqual(self.scenario_runner._expand_line(line), "@0:1 store 1 2 user $unknown")
+        self.assertEqual(self.scenario_runner._expand_line("@0:1 store a"), "@0:1 store a")
+
+    def test_expand_line_env_changed(self):
+        """
+        Test that lines are expanded again once a config option they use changes in the env.
+        """
+        os.environ["RUNNER_TEST_VAR"] = "env"
+        self.addCleanup(os.environ.pop, "RUNNER_TEST_VAR")
+        line = "@0:1 store $RUNNER_TEST_VAR"
+        self.assertEqual(self.scenario_runner._expand_line(line), "@0:1 store env")
+
+        os.environ["RUNNER_TEST_VAR"] = "changed"
+        self.assertEqual(self.scenario_runner._expand_line(line), "@0:1 store changed")
+        del os.environ["RUNNER_TEST_VAR"]
+        self.assertEqual(self.scenario_runner._expand_line(line), "@0:1 store $RUNNER_TEST_VAR")
+        os.environ["RUNNER_TEST_VAR"] = "env"
+
+    def test_peerspec_ranges(self):
+        """
+        Test that peer specifications are parsed into merged ranges of peers.
+        """
+        yes_peers, no_peers = self.scenario_runner._parse_peerspec("1-50000, 7, 50001, 60000-60002")
+        self.assertEqual(list(zip(yes_peers.starts, yes_peers.ends)), [(1, 50001), (60000, 60002)])
+        self.assertFalse(no_peers)
+        self.assertIn(50001, yes_peers)
+        self.assertNotIn(50002, yes_peers)
+        self.assertNotIn(0, yes_peers)
+        self.assertIs(self.scenario_runner._parse_peerspec("1-50000, 7, 50001, 60000-60002")[0], yes_peers)
+
+        self.assertTrue(self.scenario_runner._parse_for_this_peer("!2-4"))
+        self.assertFalse(self.scenario_runner._parse_for_this_peer("!1-4"))
+
+    def test_workload_rate(self):
+        """
+        Test that a workload calls at the given rate, shared by the peers of the peerspec when its scope is global.
+        """
+        self.scenario_runner.peer_count = 20
+        self.scenario_runner.random_seed = 42
+        for distribution in ArrivalProcess.DISTRIBUTIONS:
+            self.scenario_runner._events = []
+            self.scenario_runner.line_buffer = [("test.scenario", 1, "@0:00-1:40 rate 100 distribution=%s scope=global "
+                                                                     "store a {1-10}" % distribution)]
+            self.scenario_runner.run()
+
+            occurrences = self.scenario_runner._events[0][2].occurrences
+            times = [self.scenario_runner._events[0][0]] + list(occurrences)
+            self.assertTrue(all(0 <= t <= 100 for t in times))
+            self.assertAlmostEqual(len(times), 1000, delta=250)
+            self.assertEqual(times, sorted(times))
+
+    def test_workload_seeded(self):
+        """
+        Test that the workload of a peer is the same in every run of an experiment.
+        """
+        times = []
+        for _ in range(2):
+            self.scenario_runner.random_seed = 42
+            self.scenario_runner._events = []
+            self.scenario_runner.line_buffer = [("test.scenario", 1, "@0:00-0:10 rate 10 store a")]
+            self.scenario_runner.run()
+            times.append([self.scenario_runner._events[0][0]] + list(self.scenario_runner._events[0][2].occurrences))
+        self.assertEqual(times[0], times[1])
+
+    def start_operation(self, value):
+        self.local_storage.append(value)
+        self.deferreds.append(Deferred())
+        return self.deferreds[-1]
+
+    def run_due_events(self):
+        self.scenario_runner.exp_start_time = time() - self.scenario_runner._events[0][0] - 0.01
+        self.scenario_runner._run_due_events()
+
+    def test_after_label(self):
+        """
+        Test that an event that depends on a label runs once all the events with that label completed.
+        """
+        self.deferreds = []
+        self.scenario_runner.register(self.start_operation)
+        self.scenario_runner.line_buffer = [("test.scenario", 1, "@0:10 start_operation a as=op"),
+                                            ("test.scenario", 2, "@0:10 start_operation b as=op"),
+                                            ("test.scenario", 3, "after:op+1 store c")]
+        self.scenario_runner.run()
+        self.run_due_events()
+        self.assertEqual(self.local_storage, ["a", "b"])
+
+        self.deferreds[0].callback(None)
+        self.assertEqual(len(self.scenario_runner._events), 0)
+        self.deferreds[1].errback(RuntimeError("operation failed"))
+        self.assertEqual(len(self.scenario_runner._events), 1)
+        self.assertAlmostEqual(self.scenario_runner._events[0][0], time() - self.scenario_runner.exp_start_time + 1,
+                               delta=0.5)
+
+        self.run_due_events()
+        self.assertEqual(self.local_storage, ["a", "b", "c"])
+
+    def test_max_in_flight(self):
+        """
+        Test that the calls beyond the maximum number of calls in flight are queued until an earlier call completes.
+        """
+        self.deferreds = []
+        self.scenario_runner.register(self.start_operation)
+        self.scenario_runner._run_preprocessor_directive("test.scenario", 1, "&max_in_flight start_operation 2")
+        self.scenario_runner.line_buffer = [("test.scenario", 2, "@0:10 for i in 1 to 4 call start_operation $i")]
+        self.scenario_runner.run()
+        self.run_due_events()
+        self.assertEqual(self.local_storage, ["1", "2"])
+
+        self.deferreds[1].callback(None)
+        self.assertEqual(self.local_storage, ["1", "2", "3"])
+        self.deferreds[0].callback(None)
+        self.deferreds[2].callback(None)
+        self.assertEqual(self.local_storage, ["1", "2", "3", "4"])
+        self.assertEqual(self.scenario_runner._in_flight["start_operation"], 1)
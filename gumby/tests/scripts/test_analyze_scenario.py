@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from scripts.analyze_scenario import ScenarioAnalyzer, analyze_peer, format_peers
+
+SCENARIO = """
+@! set greeting hello
+@0:1 echo $greeting
+@0:2 introduce_peers
+@0:2 introduce_peers 2 {1-2}
+@0:10-0:20 every 2 echo tick {1}
+@0:10-0:20 rate 10 scope=global unknown_call {1-2}
+@0:3 echo labeled as=done {1-3}
+after:done+0:02 echo dependent
+after:missing echo never
+@0:30 stop {!4}
+"""
+
+
+class TestAnalyzeScenario(unittest.TestCase):
+
+    def setUp(self):
+        super(TestAnalyzeScenario, self).setUp()
+        self.test_dir = tempfile.mkdtemp()
+        self.scenario_file = os.path.join(self.test_dir, "test.scenario")
+        with open(self.scenario_file, "w") as scenario_file:
+            scenario_file.write(SCENARIO)
+        os.environ["SCENARIO_CACHE_DIR"] = self.test_dir
+
+    def tearDown(self):
+        super(TestAnalyzeScenario, self).tearDown()
+        shutil.rmtree(self.test_dir)
+        del os.environ["SCENARIO_CACHE_DIR"]
+
+    def test_analyze_peer(self):
+        """
+        Test counting the events of a peer per second, including the recurring and the dependent events.
+        """
+        result = analyze_peer((self.scenario_file, 1, 5, 1))
+        self.assertEqual(result['calls'], {'set': 1, 'echo': 8.0, 'introduce_peers': 2, 'unknown_call': 50.0,
+                                           'stop': 1})
+        self.assertEqual(result['fan_out'], {'introduce_peers': 4 + 2})
+        self.assertEqual(result['histogram'][5], 1)
+        self.assertEqual(result['histogram'][10], 5.5)
+        self.assertTrue(result['stops'])
+        self.assertEqual(result['unscheduled_labels'], {'missing'})
+
+    def test_analyze(self):
+        """
+        Test combining the results of all the peers.
+        """
+        results = ScenarioAnalyzer(self.scenario_file, 5, jobs=2).analyze()
+        self.assertEqual([peer_result['peer'] for peer_result in results['peers']], [1, 2, 3, 4, 5])
+        self.assertEqual(results['calls']['unknown_call'], 100.0)
+        self.assertEqual(results['fan_out']['introduce_peers'], 5 * 4 + 2 * 2)
+        self.assertEqual(results['no_stop'], [4])
+
+    def test_format_peers(self):
+        self.assertEqual(format_peers([1, 2, 3, 5, 7, 8]), "1-3,5,7-8")
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet.defer import Deferred
+
+from gumby.scenario_trace import TRACE_FILENAME, ScenarioTraceWriter, read_scenario_trace
+from scripts.parse_scenario_trace import ScenarioTraceParser
+
+
+class TestScenarioTraceParser(unittest.TestCase):
+
+    def setUp(self):
+        super(TestScenarioTraceParser, self).setUp()
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestScenarioTraceParser, self).tearDown()
+        shutil.rmtree(self.test_dir)
+
+    def write_trace(self, peer_nr, lateness_values):
+        os.mkdir(os.path.join(self.test_dir, str(peer_nr)))
+        writer = ScenarioTraceWriter(os.path.join(self.test_dir, str(peer_nr), TRACE_FILENAME))
+        for lateness in lateness_values:
+            writer.record("echo", 100, 100 + lateness, 100 + lateness + 0.5)
+        return writer
+
+    def test_read_trace(self):
+        """
+        Test that the calls are read back from a trace, including those recorded when their Deferred fired.
+        """
+        writer = self.write_trace(1, [0.25])
+        deferred = Deferred()
+        writer.record("request", 100, 101, 101.5, deferred)
+        writer.record("echo", 100, 100, 100.5)
+        deferred.callback(None)
+        writer.close()
+
+        records = list(read_scenario_trace(os.path.join(self.test_dir, "1", TRACE_FILENAME)))
+        self.assertEqual([record[:4] for record in records], [("echo", 100, 0.25, 0.5), ("echo", 100, 0, 0.5),
+                                                              ("request", 100, 1, 0.5)])
+        self.assertEqual(records[0][4], 0.5)
+        self.assertGreater(records[2][4], 0.5)
+
+    def test_record_after_close(self):
+        """
+        Test that calls which complete after the trace was closed are dropped, rather than truncating the trace.
+        """
+        writer = self.write_trace(1, [0.25])
+        deferred = Deferred()
+        writer.record("request", 100, 101, 101.5, deferred)
+        writer.close()
+        deferred.callback(None)
+        writer.record("echo", 100, 100, 100.5)
+
+        records = list(read_scenario_trace(os.path.join(self.test_dir, "1", TRACE_FILENAME)))
+        self.assertEqual([record[:4] for record in records], [("echo", 100, 0.25, 0.5)])
+
+    def test_aggregate_trace(self):
+        """
+        Test aggregating the lateness percentiles of all the peers per callable.
+        """
+        self.write_trace(1, [0.25 * i for i in range(50)]).close()
+        self.write_trace(2, [0.25 * i for i in range(50, 100)]).close()
+
+        ScenarioTraceParser(self.test_dir).aggregate_trace()
+        with open(os.path.join(self.test_dir, "scenario_trace.csv")) as csv_file:
+            header, row = csv_file.read().splitlines()
+        columns = dict(zip(header.split(","), row.split(",")))
+
+        self.assertEqual(columns["calls"], "100")
+        self.assertEqual(float(columns["lateness_p50"]), 12.25)
+        self.assertEqual(float(columns["lateness_p100"]), 24.75)
+        self.assertEqual(float(columns["duration_p99"]), 0.5)
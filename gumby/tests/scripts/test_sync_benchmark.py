@@ -0,0 +1,36 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "..", "scripts"))
+
+
+class TestSyncBenchmark(unittest.TestCase):
+
+    def run_benchmark(self, *args):
+        # The reactor can't be restarted, so every run gets a process of its own
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(SCRIPTS_DIR), env.get("PYTHONPATH", "")])
+        # The benchmark clients neither write output nor run a scenario, even if other tests left these set
+        for name in ("OUTPUT_DIR", "SCENARIO_FILE"):
+            env.pop(name, None)
+        output = subprocess.check_output([sys.executable, os.path.join(SCRIPTS_DIR, "sync_benchmark.py"), "--json",
+                                          "-t", "20"] + list(args), env=env)
+        return json.loads(output.splitlines()[-1])
+
+    def test_direct(self):
+        """
+        Test that a few clients connected straight to the server all get the go signal.
+        """
+        results = self.run_benchmark("-n", "4")
+        self.assertIn("all_go", results)
+        self.assertGreater(results["bytes_sent"], 0)
+
+    def test_uneven_relays(self):
+        """
+        Test that the clients get the go signal when they are spread unevenly over the relays.
+        """
+        results = self.run_benchmark("-n", "3", "-r", "2")
+        self.assertIn("all_go", results)
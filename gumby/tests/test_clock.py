@@ -0,0 +1,43 @@
+import unittest
+
+from gumby.clock import ClockOffsetEstimator
+
+
+class TestClockOffsetEstimator(unittest.TestCase):
+    """
+    Tests the estimation of the clock offset with the experiment server.
+    """
+
+    def setUp(self):
+        super(TestClockOffsetEstimator, self).setUp()
+        self.sent_lines = []
+        self.estimator = ClockOffsetEstimator(self.sent_lines.append, samples=3)
+
+    def answer_pings(self, server_clock_delta):
+        """
+        Answer the last sent ping as a server with a clock that differs server_clock_delta seconds from ours.
+        """
+        _, sequence_number, send_time = self.sent_lines[-1].split(b":")
+        self.estimator.on_pong(b"pong:%s:%s:%f" % (sequence_number, send_time, float(send_time) + server_clock_delta))
+
+    def test_estimate_offset(self):
+        """
+        Test that the offset is reported after the configured number of samples.
+        """
+        self.estimator.start()
+        for _ in range(3):
+            self.assertFalse(self.estimator.done.called)
+            self.answer_pings(-5)
+
+        self.assertTrue(self.estimator.done.called)
+        self.assertAlmostEqual(self.estimator.offset, 5, places=1)
+        self.assertTrue(self.sent_lines[-1].startswith(b"offset:"))
+        self.assertGreaterEqual(self.estimator.error, 0)
+
+    def test_ignore_stale_pong(self):
+        """
+        Test that a pong that doesn't match the outstanding ping is ignored.
+        """
+        self.estimator.start()
+        self.estimator.on_pong(b"pong:5:0.000000:0.000000")
+        self.assertFalse(self.estimator.samples)
@@ -0,0 +1,59 @@
+import unittest
+
+from gumby.experiment import ExperimentClient, experiment_callback, get_experiment_callbacks
+
+
+class CallbacksModule(object):
+
+    def __init__(self):
+        self.calls = []
+
+    @experiment_callback
+    def first(self, value):
+        self.calls.append(("first", value))
+
+    @experiment_callback("renamed")
+    def second(self):
+        self.calls.append(("second",))
+
+    @property
+    def broken_property(self):
+        raise AssertionError("properties should not be evaluated")
+
+    def not_a_callback(self):
+        pass
+
+
+class InheritingCallbacksModule(CallbacksModule):
+
+    @experiment_callback
+    def third(self):
+        self.calls.append(("third",))
+
+
+class TestExperimentCallbacks(unittest.TestCase):
+
+    def test_class_callbacks(self):
+        """
+        Test that the experiment callbacks of a class, including the inherited ones, are collected once.
+        """
+        self.assertEqual(get_experiment_callbacks(CallbacksModule), [("first", "first"), ("renamed", "second")])
+        self.assertEqual(get_experiment_callbacks(InheritingCallbacksModule),
+                         [("first", "first"), ("renamed", "second"), ("third", "third")])
+        self.assertIs(get_experiment_callbacks(CallbacksModule), get_experiment_callbacks(CallbacksModule))
+
+    def test_register(self):
+        """
+        Test that the experiment callbacks of every registered instance are bound to that instance.
+        """
+        client = ExperimentClient({})
+        modules = [InheritingCallbacksModule(), InheritingCallbacksModule()]
+        for module in modules:
+            client.register(module)
+
+        for callback in client.scenario_runner._callables["renamed"]:
+            callback()
+        client.scenario_runner._callables["first"][1]("a")
+        self.assertEqual(modules[0].calls, [("second",)])
+        self.assertEqual(modules[1].calls, [("second",), ("first", "a")])
+        self.assertIn("echo", client.scenario_runner._callables)
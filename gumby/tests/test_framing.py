@@ -0,0 +1,42 @@
+import json
+import unittest
+
+from gumby.framing import DocumentDecoder, compress_document
+
+
+class TestFraming(unittest.TestCase):
+    """
+    Tests the compressed framing of the experiment variables document.
+    """
+
+    def setUp(self):
+        super(TestFraming, self).setUp()
+        self.document = json.dumps(dict((str(i), {"host": "10.0.0.%d" % (i % 256), "port": 12000 + i})
+                                        for i in range(5000))).encode('utf-8')
+
+    def test_decode_in_small_pieces(self):
+        """
+        Test that a document fed byte ranges at a time is decoded, and that the trailing data is returned.
+        """
+        chunks = compress_document(self.document, chunk_size=1024)
+        data = b"".join(chunks) + b"go:1\r\n"
+        decoder = DocumentDecoder(sum(len(chunk) for chunk in chunks))
+
+        rest = b""
+        for offset in range(0, len(data), 1000):
+            self.assertFalse(decoder.done)
+            rest = decoder.feed(data[offset:offset + 1000])
+
+        self.assertTrue(decoder.done)
+        self.assertEqual(rest, b"go:1\r\n")
+        self.assertEqual(decoder.get_document(), self.document)
+
+    def test_keep_compressed(self):
+        """
+        Test that the compressed chunks can be kept to forward them.
+        """
+        chunks = compress_document(self.document)
+        decoder = DocumentDecoder(sum(len(chunk) for chunk in chunks), keep_compressed=True)
+        decoder.feed(b"".join(chunks))
+
+        self.assertEqual(b"".join(decoder.compressed_chunks), b"".join(chunks))
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from gumby.metrics_store import MetricsReader, MetricsWriter, TRAILER
+
+
+class TestMetricsStore(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMetricsStore, self).setUp()
+        self.test_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.test_dir, "metrics.bin")
+
+    def tearDown(self):
+        super(TestMetricsStore, self).tearDown()
+        shutil.rmtree(self.test_dir)
+
+    def write_metrics(self, close=True):
+        writer = MetricsWriter(self.filename, block_records=3)
+        for timestamp in range(10):
+            writer.record("numeric", timestamp * 2, timestamp)
+            writer.record(u"json \u00e9", {"step": timestamp}, timestamp)
+        writer.record("mixed", 1, 0)
+        writer.record("mixed", "one", 1)
+        writer.record("mixed", 2.5, 2)
+        if close:
+            writer.close()
+        else:
+            writer.flush()
+        return writer
+
+    def test_read(self):
+        """
+        Test reading numeric, JSON and mixed metrics from the file.
+        """
+        self.write_metrics()
+        with MetricsReader(self.filename) as reader:
+            self.assertEqual(reader.names, ["numeric", u"json \u00e9", "mixed"])
+            self.assertEqual(list(reader.read("numeric")), [(float(t), t * 2.0) for t in range(10)])
+            self.assertEqual(list(reader.read(u"json \u00e9"))[4], (4.0, {"step": 4}))
+            self.assertEqual(list(reader.read("mixed")), [(0.0, 1.0), (1.0, "one"), (2.0, 2.5)])
+            self.assertEqual(list(reader.read("unknown")), [])
+
+    def test_read_period(self):
+        """
+        Test reading only the records of a metric between two timestamps.
+        """
+        self.write_metrics()
+        with MetricsReader(self.filename) as reader:
+            self.assertEqual([t for t, _ in reader.read("numeric", start=4, end=7)], [4.0, 5.0, 6.0, 7.0])
+            self.assertEqual([t for t, _ in reader.read("numeric", start=9.5)], [])
+
+    def test_read_without_index(self):
+        """
+        Test reading a file of which the writer was never closed, with a block that was cut short.
+        """
+        writer = self.write_metrics(close=False)
+        writer._metrics_file.close()
+        size = os.path.getsize(self.filename)
+        with open(self.filename, "rb+") as metrics_file:
+            metrics_file.truncate(size - TRAILER.size)
+
+        with MetricsReader(self.filename) as reader:
+            self.assertEqual(reader.names, ["numeric", u"json \u00e9", "mixed"])
+            self.assertEqual(len(list(reader.read("numeric"))), 10)
+            self.assertEqual(len(list(reader.read(u"json \u00e9"))), 9)
+
+    def test_not_a_metrics_file(self):
+        with open(self.filename, "wb") as metrics_file:
+            metrics_file.write(b"1.0 1 annotate start\n")
+        self.assertRaises(ValueError, MetricsReader, self.filename)
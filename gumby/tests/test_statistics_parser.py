@@ -3,6 +3,7 @@ import shutil
 import tempfile
 import unittest
 
+from gumby.metrics_store import METRICS_FILENAME, MetricsWriter
 from gumby.statsparser import StatisticsParser
 
 
@@ -51,3 +52,21 @@ class TestStatisticsParser(unittest.TestCase):
 
         items = stats_parser.yield_files('stats.txt')
         self.assertEqual(len(list(items)), 2)
+
+    def test_yield_metric(self):
+        """
+        Test the yield_metric method, which reads a single metric of all peers
+        """
+        stats_parser = StatisticsParser(self.test_dir)
+
+        for peer_nr in (1, 2):
+            os.mkdir(os.path.join(self.test_dir, str(peer_nr)))
+            writer = MetricsWriter(os.path.join(self.test_dir, str(peer_nr), METRICS_FILENAME))
+            writer.record("latency", 0.5 * peer_nr, 10)
+            writer.record("other", "ignored", 10)
+            writer.record("latency", 1.5 * peer_nr, 20)
+            writer.close()
+
+        items = sorted(stats_parser.yield_metric('latency'))
+        self.assertEqual(items, [(1, 10, 0.5), (1, 20, 1.5), (2, 10, 1.0), (2, 20, 3.0)])
+        self.assertEqual(sorted(stats_parser.yield_metric('latency', start=15)), [(1, 20, 1.5), (2, 20, 3.0)])
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+from time import sleep, time
+
+from gumby.stats_writer import StatsWriter
+
+
+class TestStatsWriter(unittest.TestCase):
+
+    def setUp(self):
+        super(TestStatsWriter, self).setUp()
+        self.test_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.test_dir, "statistics.log")
+
+    def tearDown(self):
+        super(TestStatsWriter, self).tearDown()
+        shutil.rmtree(self.test_dir)
+
+    def read_lines(self):
+        with open(self.filename) as stats_file:
+            return [line.split(" ", 3)[1:] for line in stats_file.read().splitlines()]
+
+    def test_records_written_on_close(self):
+        """
+        Test that the records waiting for their batch to fill up are written when closing the writer.
+        """
+        writer = StatsWriter(self.filename, 3, max_delay=60)
+        writer.record("annotate", "start-experiment")
+        writer.record("download-stats", {"progress": 50})
+        writer.close()
+
+        self.assertEqual(self.read_lines(), [["3", "annotate", "start-experiment"],
+                                             ["3", "download-stats", '{"progress": 50}']])
+        self.assertEqual(writer.records_written, 2)
+        self.assertEqual(writer.bytes_written, os.path.getsize(self.filename))
+
+    def test_full_batch_written(self):
+        """
+        Test that a batch is written as soon as it is full.
+        """
+        writer = StatsWriter(self.filename, 1, max_batch_records=2, max_delay=60)
+        writer.record("annotate", "a")
+        writer.record("annotate", "b")
+        deadline = time() + 5
+        while writer.records_written < 2 and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(len(self.read_lines()), 2)
+        writer.close()
+
+    def test_records_dropped(self):
+        """
+        Test that records are dropped while too many of them are waiting to be written, or after closing.
+        """
+        writer = StatsWriter(self.filename, 1, max_delay=60, max_queued_records=2)
+        for value in range(3):
+            writer.record("value", value)
+        writer.close()
+        writer.record("value", 4)
+
+        self.assertEqual(self.read_lines(), [["1", "value", "0"], ["1", "value", "1"]])
+        self.assertEqual(writer.records_dropped, 2)
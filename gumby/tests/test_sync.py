@@ -0,0 +1,467 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.address import IPv4Address, UNIXAddress
+from twisted.internet.protocol import connectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+from gumby import sync
+from gumby.experiment import ExperimentClient
+from gumby.sync import (ExperimentRelayClientFactory, ExperimentRelayFactory, ExperimentServiceFactory,
+                        UNIX_SOCKET_HOST)
+
+
+class TestExperimentServiceFactory(unittest.TestCase):
+    """
+    Tests the bookkeeping of the experiment synchronization server.
+    """
+
+    def setUp(self):
+        super(TestExperimentServiceFactory, self).setUp()
+        self.factory = ExperimentServiceFactory(3, 0)
+
+    def tearDown(self):
+        super(TestExperimentServiceFactory, self).tearDown()
+        for looping_call in [self.factory._made_looping_call, self.factory._subscriber_looping_call,
+                             self.factory._subscriber_received_looping_call]:
+            if looping_call and looping_call.running:
+                looping_call.stop()
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+
+    def connect(self, host="1.2.3.4", relayed_subscribers=None):
+        """
+        Connect a new subscriber to the factory.
+
+        :param host: the host the subscriber connects from
+        :param relayed_subscribers: the number of subscribers if the subscriber is a relay
+        :return: a tuple of the subscriber protocol and its transport
+        """
+        proto = self.factory.buildProtocol(None)
+        transport = StringTransport(peerAddress=IPv4Address("TCP", host, 1234))
+        proto.makeConnection(transport)
+        if relayed_subscribers is not None:
+            proto.dataReceived(b"relay:%d\r\n" % relayed_subscribers)
+        proto.dataReceived(b"time:0\r\n")
+        return proto, transport
+
+    def test_relay_counts_as_subscribers(self):
+        """
+        Test that a relay connection is counted as the number of subscribers it relays for.
+        """
+        proto, transport = self.connect(relayed_subscribers=3)
+
+        self.assertEqual(proto.subscriber_count, 3)
+        self.assertEqual(len(set(proto.relayed_ids)), 3)
+        ids, token = transport.value().strip().split(b":")[1:]
+        self.assertEqual(ids, b",".join(b"%d" % i for i in proto.relayed_ids))
+        self.assertIs(self.factory.sessions[token], proto)
+
+    def test_relay_batch(self):
+        """
+        Test that the vars reported by a relay end up in the JSON document with the relay time offset applied.
+        """
+        proto, _ = self.connect(relayed_subscribers=3)
+        batch = dict((relayed_id, {"time_offset": 1}) for relayed_id in proto.relayed_ids)
+        proto.dataReceived(b"batch:%s\r\n" % json.dumps(batch).encode('utf-8'))
+
+        self.assertEqual(proto.state, "vars_received")
+        subscribers_vars = proto.getSubscriberVars()
+        self.assertEqual(sorted(subscribers_vars.keys()), sorted(proto.relayed_ids))
+        for relayed_id, relayed_vars in subscribers_vars.items():
+            self.assertEqual(relayed_vars["host"], "1.2.3.4")
+            self.assertEqual(relayed_vars["port"], relayed_id + 12000)
+            self.assertAlmostEqual(relayed_vars["time_offset"], 1 + proto.vars["time_offset"])
+
+    def test_uneven_relays(self):
+        """
+        Test that the ids are pushed once when the last relay to connect completes the expected subscribers by itself.
+        """
+        first_relay, first_transport = self.connect(relayed_subscribers=2)
+        self.assertFalse(first_transport.value())
+        last_relay, last_transport = self.connect(relayed_subscribers=1)
+
+        self.assertEqual(self.factory.subscribers_made, 3)
+        for relay, transport in [(first_relay, first_transport), (last_relay, last_transport)]:
+            lines = transport.value().splitlines()
+            self.assertEqual(len(lines), 1)
+            ids, _ = lines[0].split(b":")[1:]
+            self.assertEqual(ids, b",".join(b"%d" % i for i in relay.relayed_ids))
+        self.assertEqual(sorted(first_relay.relayed_ids + last_relay.relayed_ids), [1, 2, 3])
+
+    def test_plain_subscribers(self):
+        """
+        Test that subscribers connecting directly are each counted once.
+        """
+        protos = [self.connect()[0] for _ in range(2)]
+        self.assertEqual(self.factory.subscribers_made, 2)
+
+        protos.append(self.connect()[0])
+        for proto in protos:
+            self.assertIsNotNone(proto.ready_d)
+
+    def test_unregister_connection(self):
+        """
+        Test that a subscriber that disconnects before everyone connected is no longer counted.
+        """
+        proto, _ = self.connect()
+        relay, _ = self.connect(relayed_subscribers=1)
+        self.assertEqual(self.factory.subscribers_made, 2)
+
+        proto.connectionLost()
+        self.assertNotIn(proto.id, self.factory.connections_made)
+        self.assertEqual(self.factory.subscribers_made, 1)
+
+        relay.connectionLost()
+        self.assertFalse(self.factory.connections_made)
+        self.assertEqual(self.factory.subscribers_made, 0)
+
+    def test_resume_session(self):
+        """
+        Test that a subscriber that reconnects keeps its id and gets the JSON document it missed.
+        """
+        protos = [self.connect()[0] for _ in range(3)]
+        proto = protos[0]
+        _, token = proto.transport.value().strip().split(b":", 2)[1:]
+        proto.dataReceived(b"ready\r\n")
+        proto.connectionLost()
+        self.assertIs(self.factory.connections_ready[proto.id], proto)
+
+        self.factory.document = (b'{"clients": {}}', None)
+        resumed = self.factory.buildProtocol(None)
+        resumed.makeConnection(StringTransport(peerAddress=IPv4Address("TCP", "1.2.3.4", 1234)))
+        resumed.dataReceived(b"resume:%s:all_vars\r\n" % token)
+
+        self.assertEqual(resumed.id, proto.id)
+        self.assertEqual(resumed.state, "vars_received")
+        self.assertIs(self.factory.connections_ready[proto.id], resumed)
+        self.assertEqual(self.factory.subscribers_made, 3)
+        self.assertEqual(resumed.transport.value(), b'resumed:vars_received\r\n{"clients": {}}\r\n')
+
+    def test_resume_unknown_session(self):
+        """
+        Test that resuming an unknown session closes the connection.
+        """
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        proto.dataReceived(b"resume:abc:all_vars\r\n")
+
+        self.assertEqual(proto.transport.value(), b"resumed:unknown\r\n")
+        self.assertTrue(proto.transport.disconnecting)
+        self.assertFalse(self.factory.connections_made)
+
+    def test_unix_socket_subscriber_host(self):
+        """
+        Test that subscribers connected over a unix domain socket get the host of the server.
+        """
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(StringTransport(peerAddress=UNIXAddress("/tmp/sync.sock")))
+        proto.dataReceived(b"time:0\r\n")
+
+        self.assertEqual(proto.getSubscriberVars()[proto.id]["host"], UNIX_SOCKET_HOST)
+
+    def test_unix_socket_subscriber_remote_host(self):
+        """
+        Test that remote subscribers see the address of the server as the host of a unix domain socket subscriber.
+        """
+        self.addCleanup(setattr, sync, "cooperate", sync.cooperate)
+        sync.cooperate = list
+        remote, transport = self.connect()
+        other, _ = self.connect(host="5.6.7.8")
+        local = self.factory.buildProtocol(None)
+        local.makeConnection(StringTransport(peerAddress=UNIXAddress("/tmp/sync.sock")))
+        local.dataReceived(b"time:0\r\n")
+        for proto in (remote, other, local):
+            proto.dataReceived(b"ready\r\n")
+        self.factory.pushInfoToSubscribers()
+
+        clients = json.loads(transport.value().strip().split(b"\r\n")[-1])["clients"]
+        self.assertEqual(clients[str(remote.id)]["host"], "1.2.3.4")
+        self.assertEqual(clients[str(local.id)]["host"], transport.getHost().host)
+        self.assertNotEqual(clients[str(local.id)]["host"], UNIX_SOCKET_HOST)
+
+    def test_lookup_request(self):
+        """
+        Test that the peer directory answers lookups for known subscribers only.
+        """
+        self.factory.directory = {1: {"host": "1.2.3.4", "port": 12001, "public_key": "abc"}}
+        proto, transport = self.connect()
+        proto.dataReceived(b"req:7:lookup:[1, 2]\r\n")
+
+        verb, request_id, payload = transport.value().strip().split(b":", 2)
+        self.assertEqual((verb, request_id), (b"res", b"7"))
+        self.assertEqual(json.loads(payload), {"1": {"host": "1.2.3.4", "port": 12001, "public_key": "abc"}})
+
+    def test_kv_subscription(self):
+        """
+        Test that the key-value store updates are only sent to the connections subscribed to them.
+        """
+        (publisher, publisher_transport), (subscriber, subscriber_transport) = self.connect(), self.connect()
+        publisher.dataReceived(b'evt:kv:{"updates": {"pk/1": "abc"}}\r\n')
+        self.factory.flushKVUpdates()
+        subscriber.dataReceived(b'req:1:kv_subscribe:{"prefix": "pk/"}\r\n')
+        self.assertEqual(subscriber_transport.value(), b'res:1:{"pk/1": "abc"}\r\n')
+
+        subscriber_transport.clear()
+        publisher.dataReceived(b'evt:kv:{"updates": {"pk/2": "def", "converged": true}}\r\n')
+        self.factory.flushKVUpdates()
+
+        self.assertEqual(json.loads(subscriber_transport.value().strip().split(b":", 2)[2]),
+                         {"updates": {"pk/2": "def"}})
+        self.assertFalse(publisher_transport.value())
+        self.assertEqual(self.factory.kv_store, {"pk/1": "abc", "pk/2": "def", "converged": True})
+
+    def test_barrier_quorum(self):
+        """
+        Test that a barrier is released to everyone once the quorum of subscribers arrived.
+        """
+        connections = [self.connect() for _ in range(3)]
+        self.factory.connections_ready = OrderedDict((proto.id, proto) for proto, _ in connections)
+        for _, transport in connections:
+            transport.clear()
+
+        connections[0][0].dataReceived(b'evt:barrier:{"name": "b", "id": 1, "timeout": null, "quorum": 2}\r\n')
+        self.assertIn("b", self.factory.barriers)
+        self.assertFalse(connections[0][1].value())
+
+        connections[1][0].dataReceived(b'evt:barrier:{"name": "b", "id": 2, "timeout": null, "quorum": 2}\r\n')
+        self.assertNotIn("b", self.factory.barriers)
+        for _, transport in connections:
+            self.assertTrue(transport.value().startswith(b"evt:barrier:"))
+
+        # A latecomer is released straight away
+        connections[2][1].clear()
+        connections[2][0].dataReceived(b'evt:barrier:{"name": "b", "id": 3, "timeout": null, "quorum": 2}\r\n')
+        self.assertTrue(connections[2][1].value().startswith(b"evt:barrier:"))
+
+
+class FakeConnector(object):
+
+    def __init__(self):
+        self.connected = False
+
+    def connect(self):
+        self.connected = True
+
+
+class TestExperimentRelayFactory(unittest.TestCase):
+    """
+    Tests the relay between the local subscribers and the experiment server.
+    """
+
+    def setUp(self):
+        super(TestExperimentRelayFactory, self).setUp()
+        self.factory = ExperimentRelayFactory(2)
+        self.client_factory = ExperimentRelayClientFactory(self.factory)
+        self.addCleanup(setattr, reactor, "exitCode", getattr(reactor, "exitCode", 0))
+
+    def tearDown(self):
+        super(TestExperimentRelayFactory, self).tearDown()
+        for looping_call in [self.factory._made_looping_call, self.factory._subscriber_looping_call,
+                             self.factory._subscriber_received_looping_call]:
+            if looping_call and looping_call.running:
+                looping_call.stop()
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+
+    def connect_upstream(self):
+        upstream = self.client_factory.buildProtocol(None)
+        upstream.makeConnection(StringTransport(hostAddress=IPv4Address("TCP", "10.0.0.1", 1234)))
+        return upstream
+
+    def connect_subscribers(self):
+        subscribers = []
+        for _ in range(self.factory.expected_subscribers):
+            proto = self.factory.buildProtocol(None)
+            proto.makeConnection(StringTransport(peerAddress=IPv4Address("TCP", "127.0.0.1", 1234)))
+            proto.dataReceived(b"time:0\r\n")
+            subscribers.append(proto)
+        return subscribers
+
+    def test_relayed_ids(self):
+        """
+        Test that the local subscribers get the ids that the experiment server assigned to the relay.
+        """
+        upstream = self.connect_upstream()
+        self.assertIn(b"relay:2\r\n", upstream.transport.value())
+        subscribers = self.connect_subscribers()
+        upstream.dataReceived(b"ids:5,6:abc\r\n")
+
+        self.assertEqual(upstream.session_token, b"abc")
+        self.assertEqual(list(self.factory.connections_made.keys()), [5, 6])
+        for subscriber in subscribers:
+            self.assertTrue(subscriber.transport.value().startswith(b"id:%d:" % subscriber.id))
+
+    def test_resume_upstream_session(self):
+        """
+        Test that the relay resumes its session after the connection with the experiment server dropped, and sends
+        the batch that the server did not receive again.
+        """
+        upstream = self.connect_upstream()
+        subscribers = self.connect_subscribers()
+        upstream.dataReceived(b"ids:5,6:abc\r\n")
+        for subscriber in subscribers:
+            subscriber.dataReceived(b"ready\r\n")
+        upstream.clock_estimator.done.callback(0)
+        self.assertIn(b"batch:", upstream.transport.value())
+
+        upstream.connectionLost()
+        connector = FakeConnector()
+        self.client_factory.clientConnectionLost(connector, Failure(connectionDone))
+        self.assertIsNone(self.factory.upstream)
+        self.assertIsNotNone(self.client_factory._callID)
+        self.client_factory._callID.func()
+        self.assertTrue(connector.connected)
+
+        resumed = self.connect_upstream()
+        self.assertIs(resumed, upstream)
+        self.assertIs(self.factory.upstream, upstream)
+        self.assertEqual(upstream.transport.value(), b"resume:abc:all_vars\r\n")
+
+        upstream.dataReceived(b"resumed:init\r\n")
+        batch = json.loads(upstream.transport.value().splitlines()[-1].split(b":", 1)[1])
+        self.assertEqual(sorted(batch.keys()), ["5", "6"])
+
+    def test_resume_unknown_upstream_session(self):
+        """
+        Test that the relay gives up when the experiment server does not know its session anymore.
+        """
+        upstream = self.connect_upstream()
+        upstream.dataReceived(b"ids:5,6:abc\r\n")
+        upstream.connectionLost()
+        upstream = self.connect_upstream()
+
+        upstream.dataReceived(b"resumed:unknown\r\n")
+        self.assertFalse(self.client_factory.continueTrying)
+        self.assertTrue(upstream.transport.disconnecting)
+        self.assertEqual(reactor.exitCode, 1)
+
+
+class TestExperimentClientKeyValueStore(unittest.TestCase):
+    """
+    Tests the key-value store subscriptions of the experiment client.
+    """
+
+    def setUp(self):
+        super(TestExperimentClientKeyValueStore, self).setUp()
+        self.client = ExperimentClient({})
+        self.client.transport = StringTransport()
+
+    def test_relayed_updates_filtered(self):
+        """
+        Test that only the updates of the subscribed prefixes are stored and passed to the callbacks.
+        """
+        updates = []
+        self.client.kv_subscribe("pk/", lambda key, value: updates.append((key, value)))
+        self.client.lineReceived(b'evt:kv:{"updates": {"pk/1": "abc", "converged": true}}')
+
+        self.assertEqual(updates, [("pk/1", "abc")])
+        self.assertEqual(self.client.kv_get("pk/1"), "abc")
+        self.assertIsNone(self.client.kv_get("converged"))
+
+
+class TestExperimentClientPeers(unittest.TestCase):
+    """
+    Tests the lookups of the peers in the all_vars document.
+    """
+
+    def setUp(self):
+        super(TestExperimentClientPeers, self).setUp()
+        self.client = ExperimentClient({})
+        self.client.transport = StringTransport()
+        self.client.my_id = 1
+        # The all_vars document is written to the working directory
+        self.addCleanup(os.chdir, os.getcwd())
+        temporary_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temporary_dir)
+        os.chdir(temporary_dir)
+
+    def test_peer_lookups(self):
+        """
+        Test that peers are looked up by id and by address.
+        """
+        self.client.on_all_vars_document(json.dumps({
+            "clients": {"1": {"host": "10.0.0.1", "port": 12001, "time_offset": 0},
+                        "2": {"host": "10.0.0.2", "port": 12002, "time_offset": 0}},
+            "server": {}
+        }).encode("utf-8"))
+
+        self.assertEqual(self.client.get_peer_id("10.0.0.2", "12002"), "2")
+        self.assertIsNone(self.client.get_peer_id("10.0.0.2", 12001))
+        self.assertEqual(self.client.get_peer_ip_port_by_id(1), ("10.0.0.1", 12001))
+        self.assertIsNone(self.client.get_peer_ip_port_by_id(3))
+
+    def test_known_peer_vars_directory(self):
+        """
+        Test that with a peer directory, the full vars of a peer are only known once they were looked up.
+        """
+        self.client.on_all_vars_document(json.dumps({
+            "clients": {"1": {"host": "10.0.0.1", "port": 12001, "time_offset": 0},
+                        "2": {"host": "10.0.0.2", "port": 12002, "time_offset": 0}},
+            "server": {"directory": True}
+        }).encode("utf-8"))
+        self.assertRaises(KeyError, self.client.get_known_peer_vars, 2)
+
+        looked_up = []
+        self.client.lookup_peer_vars(2).addCallback(looked_up.append)
+        self.client._lookup_flush_call.cancel()
+        self.client._flush_lookups()
+        self.assertIn(b'lookup:["2"]', self.client.transport.value())
+        self.client.lineReceived(b'res:1:{"2": {"host": "10.0.0.2", "port": 12002, "public_key": "abc"}}')
+
+        self.assertEqual(looked_up[0]["public_key"], "abc")
+        self.assertEqual(self.client.get_known_peer_vars(2)["public_key"], "abc")
+
+
+class TestExperimentClientOutput(unittest.TestCase):
+    """
+    Tests the output files of the experiment client.
+    """
+
+    def setUp(self):
+        super(TestExperimentClientOutput, self).setUp()
+        self.client = ExperimentClient({})
+        self.client.transport = StringTransport()
+        # The modules are notified in a thread, which is never started as the reactor doesn't run
+        self.client.on_id_received = lambda: None
+        self.addCleanup(os.chdir, os.getcwd())
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        os.environ["OUTPUT_DIR"] = self.output_dir
+        self.addCleanup(os.environ.pop, "OUTPUT_DIR")
+
+    def test_open_output_dir(self):
+        """
+        Test that the output files are opened on the reactor thread as soon as the id is received.
+        """
+        self.assertEqual(self.client.proto_id(b"id:3:abc"), "all_vars")
+        self.addCleanup(self.client.stats_writer.close)
+        self.addCleanup(self.client.metrics.close)
+
+        self.assertEqual(os.getcwd(), os.path.realpath(os.path.join(self.output_dir, "3")))
+        self.assertEqual(self.client.stats_writer.filename, os.path.join(self.output_dir, "3", "statistics.log"))
+        self.assertEqual(self.client.metrics.filename, os.path.join(self.output_dir, "3", "metrics.bin"))
+
+    def test_start_experiment_without_id(self):
+        """
+        Test that starting the experiment doesn't fail when no metrics file was opened.
+        """
+        self.client.start_experiment()
+        self.assertIsNone(self.client.metrics)
+
+    def test_no_output_dir(self):
+        """
+        Test that the id handshake continues without output when no output directory is set.
+        """
+        os.environ.pop("OUTPUT_DIR")
+        self.addCleanup(os.environ.__setitem__, "OUTPUT_DIR", self.output_dir)
+
+        self.assertEqual(self.client.proto_id(b"id:3:abc"), "all_vars")
+        self.assertIsNone(self.client.stats_writer)
+        self.assertIsNone(self.client.metrics)
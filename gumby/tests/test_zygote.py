@@ -0,0 +1,59 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from gumby import zygote
+
+
+class TestZygote(unittest.TestCase):
+
+    def setUp(self):
+        super(TestZygote, self).setUp()
+        self.test_dir = tempfile.mkdtemp()
+        # The reactor of the test process is not the zygote reactor, so the instances must leave it alone
+        reset_reactor_waker = zygote._reset_reactor_waker
+        zygote._reset_reactor_waker = lambda: None
+        self.addCleanup(setattr, zygote, "_reset_reactor_waker", reset_reactor_waker)
+
+    def tearDown(self):
+        super(TestZygote, self).tearDown()
+        shutil.rmtree(self.test_dir)
+
+    def run_instances(self, instances, exit_codes):
+        os.environ[zygote.ZYGOTE_INSTANCES] = str(instances)
+        self.assertEqual(zygote.get_zygote_instances(), instances)
+        exit_code = zygote.fork_instances(instances)
+        if exit_code is None:
+            # This is a forked instance
+            with open(os.path.join(self.test_dir, str(os.getpid())), "w") as instance_file:
+                instance_file.write("%s %f" % (os.environ.get(zygote.ZYGOTE_INSTANCES), random.random()))
+            os._exit(exit_codes.pop() if exit_codes else 0)
+        del os.environ[zygote.ZYGOTE_INSTANCES]
+        return exit_code
+
+    def test_fork_instances(self):
+        """
+        Test that the instances are forked with their own random numbers, and that the zygote waits for them.
+        """
+        self.assertEqual(self.run_instances(3, []), 0)
+
+        instance_files = os.listdir(self.test_dir)
+        self.assertEqual(len(instance_files), 3)
+        outputs = []
+        for instance_file in instance_files:
+            with open(os.path.join(self.test_dir, instance_file)) as output_file:
+                outputs.append(output_file.read().split())
+        self.assertEqual([output[0] for output in outputs], ["None"] * 3)
+        self.assertEqual(len(set(output[1] for output in outputs)), 3)
+
+    def test_failed_instance(self):
+        """
+        Test that the zygote exits with the exit code of a failed instance.
+        """
+        self.assertEqual(self.run_instances(2, [3]), 3)
+
+    def test_disabled(self):
+        os.environ.pop(zygote.ZYGOTE_INSTANCES, None)
+        self.assertEqual(zygote.get_zygote_instances(), 0)
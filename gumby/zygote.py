@@ -0,0 +1,107 @@
+"""
+Starting several experiment instances from a single zygote process.
+
+Rather than having every instance on a node import Twisted, the experiment modules and their dependencies from scratch,
+the zygote imports them and compiles the scenario once, and then forks the instances. The instances start in a fraction
+of the time and share the pages of the imported modules with the zygote, until they write to them.
+
+The zygote is forked before the reactor runs, but after it has been installed, so the forked instances inherit its
+state. That is why the zygote uses the poll reactor, which keeps the registered file descriptors in the process itself,
+unlike the epoll reactor of which the instances would share the epoll instance in the kernel. Every instance does get a
+waker of its own.
+"""
+import errno
+import gc
+import logging
+import random
+import sys
+from os import WEXITSTATUS, WIFEXITED, WTERMSIG, environ, fork, wait
+
+# @CONF_OPTION ZYGOTE_INSTANCES: Fork this number of instances from a single launch_scenario.py process, which imports the experiment modules once for all of them. (default: 0, every process runs a single instance)
+ZYGOTE_INSTANCES = "ZYGOTE_INSTANCES"
+
+
+def get_zygote_instances():
+    """
+    Returns the number of instances to fork, or 0 if the zygote is disabled.
+    """
+    instances = int(environ.get(ZYGOTE_INSTANCES, 0) or 0)
+    return instances if instances > 1 else 0
+
+
+def install_zygote_reactor():
+    """
+    Install the reactor that can be shared with the forked instances. This should be done before anything imports the
+    reactor.
+    """
+    from twisted.internet import pollreactor
+    pollreactor.install()
+
+
+def preload_scenario(scenario_file):
+    """
+    Import the experiment modules of a scenario and compile the scenario, so that the forked instances don't have to.
+    """
+    from gumby.experiment import ExperimentClient
+    from gumby.scenario import ScenarioRunner
+
+    logger = logging.getLogger("Zygote")
+    scenario_runner = ScenarioRunner()
+    scenario_runner.preprocessor_callbacks["module"] = \
+        lambda _, line_number, line: ExperimentClient.perform_class_import(logger, line_number, line)
+    scenario_runner.add_scenario(scenario_file)
+
+
+def _reset_reactor_waker():
+    """
+    Replace the waker pipe inherited from the zygote, which all instances would otherwise read and write.
+    """
+    from twisted.internet import reactor
+
+    waker = reactor.waker
+    if waker is not None:
+        reactor.removeReader(waker)
+        reactor._internalReaders.discard(waker)
+        waker.connectionLost(None)
+        reactor.waker = None
+        reactor.installWaker()
+
+
+def fork_instances(instances):
+    """
+    Fork the instances and wait for all of them to exit.
+
+    :param instances: the number of instances to fork
+    :return: None in the forked instances, which should continue to run the experiment, and the exit code for the
+             zygote once all instances exited: the first non-zero exit code of an instance, or 0.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if hasattr(gc, "freeze"):
+        # Keep the garbage collector from touching, and thus copying, the objects of the zygote in the instances
+        gc.freeze()
+
+    pids = []
+    for _ in range(instances):
+        pid = fork()
+        if pid == 0:
+            environ.pop(ZYGOTE_INSTANCES, None)
+            # Otherwise all instances would draw the same random numbers
+            random.seed()
+            _reset_reactor_waker()
+            return None
+        pids.append(pid)
+
+    exit_code = 0
+    while pids:
+        try:
+            pid, status = wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid in pids:
+            pids.remove(pid)
+            instance_exit_code = WEXITSTATUS(status) if WIFEXITED(status) else 128 + WTERMSIG(status)
+            exit_code = exit_code or instance_exit_code
+    return exit_code
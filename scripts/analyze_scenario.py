@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# analyze_scenario.py ---
+#
+# Filename: analyze_scenario.py
+# Description:
+# Author:
+# Maintainer:
+# Created:
+
+# Commentary:
+#
+# Dry run of a scenario, to catch overloaded or broken scenarios before running them on a cluster.
+#
+# Expands the scenario for every peer of the experiment, in parallel, without running any of its events, and reports:
+#  - the number of events per second of all the peers together, and the busiest seconds of the busiest peers,
+#  - the callables that are not registered by the experiment client nor by any of the modules of the scenario,
+#  - the peers that never call stop, and thus keep the experiment running until it times out,
+#  - an estimate of the number of messages sent by the callables that contact many peers, like introduce_peers.
+#
+# Recurring events and workloads are counted by their average rate, until their end or else until the peer stops.
+# Dependent events are assumed to run right after the last event with their label, as if it completed immediately.
+# The exit status is 1 if any callable is unknown or any peer never stops.
+#
+# Usage example:
+#     analyze_scenario.py -n 100 experiments/dht/dht_experiment.das4.scenario
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from __future__ import division, print_function
+
+import logging
+import sys
+from inspect import isclass
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+from os import getcwd, path
+
+from gumby.experiment import ExperimentClient, get_experiment_callbacks
+from gumby.scenario import ScenarioRunner
+
+
+def _walk_to_all_peers(peernumber, peer_count):
+    return peer_count - 1
+
+
+def _introduce_peers(peernumber, peer_count, max_peers=None, excluded_peers=None):
+    excluded_peers = set(int(peer) for peer in excluded_peers.split(",")) if excluded_peers else set()
+    if peernumber in excluded_peers:
+        return 0
+    eligible_peers = peer_count - 1 - len([peer for peer in excluded_peers if 1 <= peer <= peer_count])
+    return min(int(max_peers), eligible_peers) if max_peers else eligible_peers
+
+
+# The number of messages a call sends, given the peer, the number of peers and the arguments of the call
+FAN_OUT_ESTIMATORS = {
+    "introduce_one_peer": lambda peernumber, peer_count, peer_id: 1,
+    "introduce_peers": _introduce_peers,
+    "introduce_peers_dht": _walk_to_all_peers,
+    "introduce_peers_gigachannels": _walk_to_all_peers,
+    "introduce_peers_popularity": _walk_to_all_peers,
+}
+
+
+class ScenarioExpander(ScenarioRunner):
+    """
+    Expands the scenario of a peer into the times of its events, without registering or calling any callable.
+    """
+
+    def __init__(self, peernumber, peer_count):
+        super(ScenarioExpander, self).__init__(0)
+        self.set_peernumber(peernumber)
+        self.peer_count = peer_count
+        self.modules = []
+        self.preprocessor_callbacks["module"] = self._preproc_module
+
+    def _preproc_module(self, filename, line_number, line):
+        self.modules.append((filename, line_number, line))
+
+    def expand(self):
+        """
+        Returns the time, callable, arguments and named arguments of every event of this peer, and the labels of the
+        dependent events that would never run.
+        """
+        events = []
+        recurring_events = []
+        dependent_events = []
+        labels = {}
+        for tstmp, _, _, clb, args, kwargs in self._parse_scenario():
+            if clb == 'after':
+                dependent_events.append((tstmp, args[0], args[1], args[2:], kwargs))
+                continue
+            elif clb == 'every':
+                recurring_events.append((tstmp, args[1], 1 / args[0], args[3], args[4:], kwargs))
+                continue
+            elif clb == 'rate':
+                (rate, end, _, peerspec), clb, args = args[:4], args[4], args[5:]
+                if peerspec is not None:
+                    rate /= max(1, self._count_peers(peerspec))
+                recurring_events.append((tstmp, end, rate, clb, args, kwargs))
+                continue
+
+            if tstmp < 0 and clb == 'set':
+                # Later lines may use the variable, as the experiment client sets it while parsing
+                self.user_defined_vars[args[0]] = args[1]
+            self._add_event(events, labels, max(tstmp, 0), clb, args, kwargs)
+
+        # A dependent event may be labeled itself, so keep scheduling them until none of them can run anymore
+        while dependent_events:
+            remaining_events = [event for event in dependent_events if event[1] not in labels]
+            if len(remaining_events) == len(dependent_events):
+                break
+            for delay, label, clb, args, kwargs in dependent_events:
+                if label in labels:
+                    self._add_event(events, labels, labels[label] + delay, clb, args, kwargs)
+            dependent_events = remaining_events
+
+        stop_times = [tstmp for tstmp, clb, _, _ in events if clb == 'stop']
+        horizon = min(stop_times) if stop_times else max([tstmp for tstmp, _, _, _ in events] + [0])
+        for begin, end, rate, clb, args, kwargs in recurring_events:
+            kwargs.pop('as', None)
+            end = horizon if end is None else min(end, horizon)
+            if end > begin:
+                events.append((begin, clb, args, kwargs, rate, end))
+            elif end == begin:
+                events.append((begin, clb, args, kwargs))
+
+        return events, set(label for _, label, _, _, _ in dependent_events)
+
+    @staticmethod
+    def _add_event(events, labels, tstmp, clb, args, kwargs):
+        label = kwargs.pop('as', None)
+        if label is not None:
+            labels[label] = max(labels.get(label, tstmp), tstmp)
+        events.append((tstmp, clb, args, kwargs))
+
+
+def analyze_peer(task):
+    """
+    Expand the scenario of a peer, and count its events per bucket of time and its calls and messages per callable.
+
+    :param task: a tuple with the scenario file, the peer number, the number of peers and the size of the buckets
+    :return: a dictionary with the results of the peer
+    """
+    scenario_file, peernumber, peer_count, bucket_size = task
+    expander = ScenarioExpander(peernumber, peer_count)
+    expander.add_scenario(scenario_file)
+    events, unscheduled_labels = expander.expand()
+
+    histogram = {}
+    calls = {}
+    fan_out = {}
+    for event in events:
+        tstmp, clb, args, kwargs = event[:4]
+        if len(event) == 4:
+            bucket = int(tstmp // bucket_size)
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+            count = 1
+        else:
+            # A recurring event occurs rate times per second between tstmp and its end, spread over the buckets
+            rate, end = event[4:]
+            bucket = int(tstmp // bucket_size)
+            while bucket * bucket_size < end:
+                overlap = min(end, (bucket + 1) * bucket_size) - max(tstmp, bucket * bucket_size)
+                histogram[bucket] = histogram.get(bucket, 0) + rate * overlap
+                bucket += 1
+            count = rate * (end - tstmp)
+        calls[clb] = calls.get(clb, 0) + count
+
+        if clb in FAN_OUT_ESTIMATORS:
+            try:
+                messages = FAN_OUT_ESTIMATORS[clb](peernumber, peer_count, *args, **kwargs)
+            except (TypeError, ValueError):
+                messages = 0
+            fan_out[clb] = fan_out.get(clb, 0) + count * messages
+
+    return {
+        'peer': peernumber,
+        'histogram': histogram,
+        'calls': calls,
+        'fan_out': fan_out,
+        'stops': 'stop' in calls,
+        'unscheduled_labels': unscheduled_labels,
+    }
+
+
+def get_callback_names(stuff):
+    """
+    Returns the names of the experiment callbacks of a class, or of all the classes in a module.
+    """
+    classes = [stuff] if isclass(stuff) else [member for member in vars(stuff).values() if isclass(member)]
+    return set(name for cls in classes for name, _ in get_experiment_callbacks(cls))
+
+
+class ScenarioAnalyzer(object):
+
+    def __init__(self, scenario_file, peer_count, jobs=None, bucket_size=1):
+        self.scenario_file = path.abspath(scenario_file)
+        self.peer_count = peer_count
+        self.jobs = jobs or cpu_count()
+        self.bucket_size = bucket_size
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def get_registered_callables(self):
+        """
+        Import the modules of the scenario to find the callables they register.
+
+        :return: a tuple with the names of the registered callables and the modules that could not be imported
+        """
+        expander = ScenarioExpander(1, self.peer_count)
+        expander.add_scenario(self.scenario_file)
+
+        registered = get_callback_names(ExperimentClient)
+        failed_modules = []
+        for _, line_number, line in expander.modules:
+            stuff = ExperimentClient.perform_class_import(self._logger, line_number, line)
+            if stuff is None:
+                failed_modules.append(line)
+            else:
+                registered |= get_callback_names(stuff)
+        return registered, failed_modules
+
+    def analyze(self):
+        """
+        Expand the scenario of every peer in a pool of processes, and combine the results.
+        """
+        tasks = [(self.scenario_file, peernumber, self.peer_count, self.bucket_size)
+                 for peernumber in range(1, self.peer_count + 1)]
+        pool = Pool(self.jobs)
+        try:
+            peer_results = sorted(pool.imap_unordered(analyze_peer, tasks,
+                                                      max(1, self.peer_count // (self.jobs * 4))),
+                                  key=lambda result: result['peer'])
+        finally:
+            pool.close()
+            pool.join()
+
+        results = {'histogram': {}, 'calls': {}, 'fan_out': {}, 'unscheduled_labels': set(), 'peers': peer_results}
+        for peer_result in peer_results:
+            for key in ('histogram', 'calls', 'fan_out'):
+                for item, value in peer_result[key].items():
+                    results[key][item] = results[key].get(item, 0) + value
+            results['unscheduled_labels'] |= peer_result['unscheduled_labels']
+        results['no_stop'] = [peer_result['peer'] for peer_result in peer_results if not peer_result['stops']]
+        return results
+
+
+def format_peers(peers):
+    """
+    Format a sorted list of peer numbers as ranges, like a peerspec.
+    """
+    ranges = []
+    for peer in peers:
+        if ranges and ranges[-1][1] == peer - 1:
+            ranges[-1][1] = peer
+        else:
+            ranges.append([peer, peer])
+    return ",".join(str(low) if low == high else "%d-%d" % (low, high) for low, high in ranges)
+
+
+def print_report(analyzer, results, registered, failed_modules, top):
+    bucket_size = analyzer.bucket_size
+    print("Scenario %s expanded for %d peers" % (analyzer.scenario_file, analyzer.peer_count))
+
+    print("\nEvents per %g seconds of all peers:" % bucket_size)
+    histogram = results['histogram']
+    peak = max(histogram.values()) if histogram else 0
+    for bucket in sorted(histogram):
+        print("%10g %12.1f %s" % (bucket * bucket_size, histogram[bucket],
+                                  "#" * int(round(50 * histogram[bucket] / peak))))
+
+    print("\nBusiest peers:")
+    print("%10s %12s %12s %12s" % ("peer", "events", "peak", "peak_time"))
+    peer_peaks = []
+    for peer_result in results['peers']:
+        peer_histogram = peer_result['histogram']
+        if peer_histogram:
+            peak_bucket = max(peer_histogram, key=lambda bucket: (peer_histogram[bucket], -bucket))
+            peer_peaks.append((peer_histogram[peak_bucket], sum(peer_histogram.values()), peer_result['peer'],
+                               peak_bucket * bucket_size))
+    for peak, events, peer, peak_time in sorted(peer_peaks, key=lambda item: (-item[0], item[2]))[:top]:
+        print("%10d %12.1f %12.1f %12g" % (peer, events, peak, peak_time))
+
+    print("\nCalls per callable:")
+    print("%-40s %14s %14s" % ("callable", "calls", "messages"))
+    for clb in sorted(results['calls']):
+        messages = "%14.0f" % results['fan_out'][clb] if clb in results['fan_out'] else "%14s" % "-"
+        print("%-40s %14.1f %s" % (clb, results['calls'][clb], messages))
+
+    if results['fan_out']:
+        print("\nEstimated messages sent by introductions: %.0f" % sum(results['fan_out'].values()))
+
+    problems = False
+    for module in failed_modules:
+        print("\nWarning: could not import module %s, its callables are reported as unknown" % module)
+    unknown = sorted(clb for clb in results['calls'] if clb not in registered)
+    if unknown:
+        problems = True
+        print("\nCallables without a registered module: %s" % ", ".join(unknown))
+    if results['no_stop']:
+        problems = True
+        print("\nPeers that never stop: %s" % format_peers(results['no_stop']))
+    if results['unscheduled_labels']:
+        print("\nEvents after these labels never run, as no event has the label: %s" %
+              ", ".join(sorted(results['unscheduled_labels'])))
+    return problems
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] SCENARIO_FILE")
+    parser.add_option("-n", "--peers",
+                      metavar='N',
+                      type=int,
+                      dest="peers",
+                      help="Expand the scenario for N peers"
+                      )
+    parser.add_option("-j", "--jobs",
+                      metavar='J',
+                      type=int,
+                      help="Expand the scenarios in J processes (defaults to the number of CPUs)"
+                      )
+    parser.add_option("-b", "--bucket",
+                      metavar='SECONDS',
+                      default=1.0,
+                      type=float,
+                      help="Count the events per SECONDS seconds"
+                      )
+    parser.add_option("-t", "--top",
+                      metavar='K',
+                      default=10,
+                      type=int,
+                      help="Show the K busiest peers"
+                      )
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or not options.peers:
+        parser.error("Please specify a scenario file and the number of peers with --peers.")
+
+    logging.basicConfig(level=logging.ERROR)
+    # Modules are imported relative to the root of the gumby checkout, like launch_scenario does
+    for directory in (getcwd(), path.dirname(path.dirname(path.abspath(__file__)))):
+        if directory not in sys.path:
+            sys.path.append(directory)
+
+    analyzer = ScenarioAnalyzer(args[0], options.peers, options.jobs, options.bucket)
+    registered, failed_modules = analyzer.get_registered_callables()
+    results = analyzer.analyze()
+    sys.exit(1 if print_report(analyzer, results, registered, failed_modules, options.top) else 0)
+
+if __name__ == "__main__":
+    main()
+
+#
+# analyze_scenario.py ends here
@@ -62,16 +62,40 @@ cd "$OUTPUT_DIR"
 
 CMDFILE=$(mktemp --tmpdir=/local/$USER/ process_guard_XXXXXXXXXXXXX_$USER)
 
+# @CONF_OPTION SYNC_RELAY: Run a sync relay on every node so only one connection per node reaches the experiment server. (default False)
+RELAY_PID=
+if [ "$(echo $SYNC_RELAY | tr '[:upper:]' '[:lower:]')" == 'true' ]; then
+    export SYNC_RELAY_PORT=${SYNC_RELAY_PORT:-$(($SYNC_PORT + 1))}
+    # Outside of the output dir so it isn't synced back to the head node
+    export SYNC_RELAY_SOCKET=${SYNC_RELAY_SOCKET:-/local/$USER/sync_relay_$$.sock}
+    experiment_relay.py > "$OUTPUT_DIR/experiment_relay.log" 2>&1 &
+    RELAY_PID=$!
+    # The local instances connect to the relay instead of to the experiment server
+    export SYNC_HOST=localhost
+    export SYNC_PORT=$SYNC_RELAY_PORT
+    export SYNC_SOCKET=$SYNC_RELAY_SOCKET
+fi
+
 # @CONF_OPTION DAS4_NODE_COMMAND: The command that will be repeatedly launched in the worker nodes of the cluster. (required)
-for INSTANCE in $(seq 1 1 $PROCESSES_IN_THIS_NODE); do
-    echo "$DAS4_NODE_COMMAND" >> $CMDFILE
-done
+# @CONF_OPTION DAS4_NODE_ZYGOTE: Launch the command once per node, and let it fork the instances after importing the experiment modules. Only for commands that run launch_scenario.py. (default False)
+if [ "$(echo $DAS4_NODE_ZYGOTE | tr '[:upper:]' '[:lower:]')" == 'true' ]; then
+    echo "ZYGOTE_INSTANCES=$PROCESSES_IN_THIS_NODE $DAS4_NODE_COMMAND" >> $CMDFILE
+else
+    for INSTANCE in $(seq 1 1 $PROCESSES_IN_THIS_NODE); do
+        echo "$DAS4_NODE_COMMAND" >> $CMDFILE
+    done
+fi
 
 # @CONF_OPTION DAS4_NODE_TIMEOUT: Time in seconds to wait for the sub-processes to run before killing them. (required)
 (process_guard.py -f $CMDFILE -t $DAS4_NODE_TIMEOUT -o $OUTPUT_DIR -m $OUTPUT_DIR  -i 5 2>&1 | tee process_guard.log) ||:
 
 rm $CMDFILE
 
+if [ -n "$RELAY_PID" ]; then
+    kill $RELAY_PID 2>/dev/null ||:
+    rm -f "$SYNC_SOCKET" "$SYNC_SOCKET.lock"
+fi
+
 # Now, lets send the generated data back to the head node
 rsync -a --delete-before "$OUTPUT_DIR/" "$OUTPUT_DIR_URI/$(hostname)/" 2>&1
 
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# experiment_relay.py ---
+#
+# Filename: experiment_relay.py
+# Description:
+# Author:
+# Maintainer:
+# Created:
+
+# Commentary:
+#
+# Per host relay for the experiment synchronization server.
+#
+# The local instances connect to the relay instead of to the experiment server, the relay speaks the same protocol
+# with them and reports them to the experiment server over a single connection. The JSON document and the go signal
+# are received once from the experiment server and fanned out to the local instances.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from os import environ
+
+from gumby.sync import (ExperimentRelayClientFactory, ExperimentRelayFactory, connect_to_experiment_server,
+                        listen_for_subscribers)
+from gumby.log import setupLogging
+
+from twisted.internet import reactor
+
+# @CONF_OPTION SYNC_RELAY_SUBSCRIBERS: Number of local sync clients the relay should wait for. (default is PROCESSES_IN_THIS_NODE)
+# @CONF_OPTION SYNC_RELAY_PORT: Port where the relay should listen on for local clients. (default is SYNC_PORT + 1)
+# @CONF_OPTION SYNC_RELAY_SOCKET: Unix domain socket where the relay should listen on for local clients. (default None)
+
+if __name__ == '__main__':
+    setupLogging()
+    if 'SYNC_RELAY_SUBSCRIBERS' in environ:
+        expected_subscribers = int(environ['SYNC_RELAY_SUBSCRIBERS'])
+    else:
+        expected_subscribers = int(environ['PROCESSES_IN_THIS_NODE'])
+
+    server_host = environ['SYNC_HOST']
+    server_port = int(environ['SYNC_PORT'])
+    relay_port = int(environ.get('SYNC_RELAY_PORT', server_port + 1))
+
+    relay_factory = ExperimentRelayFactory(expected_subscribers)
+
+    reactor.exitCode = 0
+    listen_for_subscribers(relay_factory, relay_port, environ.get('SYNC_RELAY_SOCKET'))
+    connect_to_experiment_server(ExperimentRelayClientFactory(relay_factory), server_host, server_port,
+                                 environ.get('SYNC_SOCKET'))
+    reactor.run()
+    exit(reactor.exitCode)
+
+#
+# experiment_relay.py ends here
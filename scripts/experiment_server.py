@@ -61,7 +61,7 @@
 
 from os import environ
 
-from gumby.sync import ExperimentServiceFactory
+from gumby.sync import ExperimentServiceFactory, listen_for_subscribers
 from gumby.log import setupLogging
 
 from twisted.internet import reactor
@@ -70,6 +70,10 @@ from twisted.internet import reactor
 # @CONF_OPTION SYNC_EXPERIMENT_START_DELAY: Delay the synchronized start of the experiment by this amount of seconds when giving the start signal.
 # @CONF_OPTION SYNC_EXPERIMENT_START_DELAY: The default value should be OK for a few thousand instances. (float, default 5)
 # @CONF_OPTION SYNC_PORT: Port where we should listen on. (required)
+# @CONF_OPTION SYNC_PERSISTENT: Keep the connections with the instances open after starting the experiment, required for barriers. (default True)
+# @CONF_OPTION SYNC_SOCKET: Also listen on this unix domain socket, the instances running on the same host will connect through it. (default None)
+# @CONF_OPTION SYNC_PEER_DIRECTORY: Only send the host and port of every instance to everyone, the other vars are looked up on demand. (default False)
+# @CONF_OPTION SYNC_PEER_DIRECTORY: Only for experiments whose modules get the vars of other peers with lookup_peer_vars. The IPv8 based modules look up the public keys of the peers they introduce (see prefetch_peers), modules that read the vars from all_vars do not work with it.
 
 if __name__ == '__main__':
     setupLogging()
@@ -79,10 +83,14 @@ if __name__ == '__main__':
         expected_subscribers = int(environ['DAS4_INSTANCES_TO_RUN'])
 
     experiment_start_delay = float(environ.get('SYNC_EXPERIMENT_START_DELAY', 5))
+    peer_directory = environ.get('SYNC_PEER_DIRECTORY', 'False').lower() == 'true'
+    persistent = environ.get('SYNC_PERSISTENT', 'True').lower() == 'true'
     server_port = int(environ['SYNC_PORT'])
 
     reactor.exitCode = 0
-    reactor.listenTCP(server_port, ExperimentServiceFactory(expected_subscribers, experiment_start_delay))
+    listen_for_subscribers(ExperimentServiceFactory(expected_subscribers, experiment_start_delay,
+                                                    peer_directory=peer_directory, persistent=persistent),
+                           server_port, environ.get('SYNC_SOCKET'))
     reactor.run()
     exit(reactor.exitCode)
 
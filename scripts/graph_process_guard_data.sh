@@ -53,6 +53,7 @@ rm $TEMPFILE
 
 reduce_statistics.py . 300
 collect_profile_logs.py .
+parse_scenario_trace.py .
 
 modify_annotations.py . $XSTART
 modify_autoplot.py . $XSTART
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Aggregates the scenario traces of all the peers into percentiles of the lateness, duration and completion time of the
+scenario events, per callable. A large lateness means that the peers were too busy to run the scenario on time.
+"""
+from __future__ import print_function
+
+import os
+import sys
+from array import array
+
+from gumby.scenario_trace import TRACE_FILENAME, read_scenario_trace
+from gumby.statsparser import StatisticsParser
+
+PERCENTILES = (50, 90, 99, 100)
+METRICS = ("lateness", "duration", "completion")
+
+
+def percentile(sorted_values, percent):
+    """
+    Returns the percentile of a sorted list of values, using the nearest-rank method.
+    """
+    rank = max(1, int(round(percent / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+class ScenarioTraceParser(StatisticsParser):
+    """
+    This class is responsible for aggregating the scenario traces of the peers.
+    """
+
+    def aggregate_trace(self):
+        values = {}
+        for _, filename, _ in self.yield_files(TRACE_FILENAME):
+            for name, _, lateness, duration, completion in read_scenario_trace(filename):
+                if name not in values:
+                    values[name] = tuple(array('f') for _ in METRICS)
+                for metric_values, value in zip(values[name], (lateness, duration, completion)):
+                    metric_values.append(value)
+
+        with open(os.path.join(self.node_directory, "scenario_trace.csv"), "w") as output_file:
+            output_file.write("callable,calls,%s\n" % ",".join("%s_p%d" % (metric, percent) for metric in METRICS
+                                                              for percent in PERCENTILES))
+            for name in sorted(values):
+                metrics_values = [sorted(metric_values) for metric_values in values[name]]
+                output_file.write("%s,%d,%s\n" % (name, len(metrics_values[0]),
+                                                  ",".join("%f" % percentile(metric_values, percent)
+                                                           for metric_values in metrics_values
+                                                           for percent in PERCENTILES)))
+
+    def run(self):
+        self.aggregate_trace()
+
+
+if __name__ == "__main__":
+    # cd to the output directory
+    os.chdir(os.environ['OUTPUT_DIR'])
+
+    parser = ScenarioTraceParser(sys.argv[1])
+    parser.run()
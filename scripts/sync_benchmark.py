@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# sync_benchmark.py ---
+#
+# Filename: sync_benchmark.py
+# Description:
+# Author:
+# Maintainer:
+# Created:
+
+# Commentary:
+#
+# Load test for the experiment synchronization server.
+#
+# Runs the experiment server (optionally behind a number of relays) and a number of lightweight experiment clients in
+# a single process, connected over loopback TCP or unix domain sockets, and reports how long it took until all clients
+# were connected, ready and received the go signal, together with the peak memory usage and the number of bytes sent
+# by the server. Every number of clients is benchmarked in a process of its own, as the reactor can't be restarted.
+#
+# Usage example:
+#     sync_benchmark.py -n 100 -n 1000 -n 10000 -r 10
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from __future__ import print_function
+
+import json
+import logging
+import resource
+import subprocess
+import sys
+from optparse import OptionParser
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from twisted.internet import reactor
+from twisted.internet.task import cooperate
+
+from gumby.experiment import ExperimentClient
+from gumby.sync import (ExperimentClientFactory, ExperimentRelayClientFactory, ExperimentRelayFactory,
+                        ExperimentServiceFactory, ExperimentServiceProto, connect_to_experiment_server)
+
+
+class BenchmarkServiceProto(ExperimentServiceProto):
+
+    def connectionMade(self):
+        write = self.transport.write
+
+        def counting_write(data):
+            self.factory.bytes_sent += len(data)
+            write(data)
+        self.transport.write = counting_write
+
+        ExperimentServiceProto.connectionMade(self)
+
+
+class BenchmarkServiceFactory(ExperimentServiceFactory):
+    protocol = BenchmarkServiceProto
+
+    def __init__(self, benchmark, expected_subscribers):
+        ExperimentServiceFactory.__init__(self, expected_subscribers, 0)
+        self.benchmark = benchmark
+        self.bytes_sent = 0
+
+    def pushIdToSubscribers(self):
+        self.benchmark.mark('all_connected')
+        ExperimentServiceFactory.pushIdToSubscribers(self)
+
+    def pushInfoToSubscribers(self):
+        self.benchmark.mark('all_ready')
+        ExperimentServiceFactory.pushInfoToSubscribers(self)
+
+    def onExperimentStarted(self, _):
+        pass
+
+
+class BenchmarkClient(ExperimentClient):
+    """
+    An experiment client that does not create an output directory nor run a scenario.
+    """
+
+    def __init__(self, benchmark):
+        ExperimentClient.__init__(self, {})
+        self.benchmark = benchmark
+
+    def open_output_dir(self):
+        pass
+
+    def on_id_received(self):
+        self.scenario_runner.set_peernumber(self.my_id)
+
+    def on_all_vars_document(self, document):
+        all_vars = json.loads(document)
+        self.all_vars = all_vars["clients"]
+        self.server_vars = all_vars["server"]
+        self.peer_directory = self.server_vars.get("directory", False)
+        self.time_offset = self.all_vars[str(self.my_id)]["time_offset"]
+        self.time_offset_error = self.all_vars[str(self.my_id)].get("time_offset_error")
+        self.send_vars_received()
+        return "go"
+
+    def start_experiment(self):
+        self.benchmark.on_client_started()
+
+
+class BenchmarkClientFactory(ExperimentClientFactory):
+
+    def __init__(self, benchmark):
+        ExperimentClientFactory.__init__(self)
+        self.benchmark = benchmark
+
+    def buildProtocol(self, address):
+        p = BenchmarkClient(self.benchmark)
+        p.factory = self
+        return p
+
+
+class SyncBenchmark(object):
+
+    def __init__(self, num_clients, num_relays=0, unix=False):
+        self.num_clients = num_clients
+        self.num_relays = num_relays
+        self.socket_dir = mkdtemp() if unix else None
+        self.start_time = None
+        self.clients_started = 0
+        self.results = {'clients': num_clients, 'relays': num_relays, 'unix': unix}
+        self.server_factory = BenchmarkServiceFactory(self, num_clients)
+
+    def mark(self, name):
+        if name not in self.results:
+            self.results[name] = time() - self.start_time
+
+    def on_client_started(self):
+        self.clients_started += 1
+        if self.clients_started == self.num_clients:
+            self.mark('all_go')
+            self.results['bytes_sent'] = self.server_factory.bytes_sent
+            reactor.callLater(0, reactor.stop)
+
+    def _listen(self, factory):
+        port = reactor.listenTCP(0, factory, backlog=1024).getHost().port
+        socket_path = None
+        if self.socket_dir:
+            socket_path = path.join(self.socket_dir, "%d.sock" % port)
+            reactor.listenUNIX(socket_path, factory, backlog=1024)
+        return port, socket_path
+
+    def _connect_clients(self, endpoints):
+        client_factory = BenchmarkClientFactory(self)
+        for client_index in range(self.num_clients):
+            port, socket_path = endpoints[client_index % len(endpoints)]
+            yield connect_to_experiment_server(client_factory, '127.0.0.1', port, socket_path)
+
+    def run(self, timeout=600):
+        server_endpoint = self._listen(self.server_factory)
+
+        endpoints = []
+        for relay_index in range(self.num_relays):
+            relay_factory = ExperimentRelayFactory(self.num_clients // self.num_relays +
+                                                   (1 if relay_index < self.num_clients % self.num_relays else 0))
+            relay_factory.onExperimentStarted = lambda _: None
+            endpoints.append(self._listen(relay_factory))
+            connect_to_experiment_server(ExperimentRelayClientFactory(relay_factory), '127.0.0.1', *server_endpoint)
+
+        self.start_time = time()
+        cooperate(self._connect_clients(endpoints or [server_endpoint]))
+        reactor.callLater(timeout, reactor.stop)
+        reactor.run()
+
+        if self.socket_dir:
+            rmtree(self.socket_dir)
+
+        # ru_maxrss is expressed in kilobytes on Linux
+        self.results['peak_memory'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return self.results
+
+
+def raise_file_limit(num_clients):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # Every client needs a socket on both sides of the connection
+    needed = 2 * num_clients + 100
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+        if hard < needed:
+            print("Warning: the open file limit (%d) is too low for %d clients" % (hard, num_clients), file=sys.stderr)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--clients",
+                      metavar='N',
+                      action="append",
+                      type=int,
+                      dest="clients",
+                      help="Run the benchmark with N clients (can be specified multiple times)"
+                      )
+    parser.add_option("-r", "--relays",
+                      metavar='R',
+                      default=0,
+                      type=int,
+                      help="Spread the clients over R relays"
+                      )
+    parser.add_option("-u", "--unix",
+                      action="store_true",
+                      default=False,
+                      help="Connect through unix domain sockets instead of TCP"
+                      )
+    parser.add_option("-t", "--timeout",
+                      metavar='TIMEOUT',
+                      default=600,
+                      type=int,
+                      help="Give up on a run after TIMEOUT seconds"
+                      )
+    parser.add_option("-j", "--json",
+                      action="store_true",
+                      default=False,
+                      help="Only print the results of a run as a JSON document"
+                      )
+    (options, _) = parser.parse_args()
+    if not options.clients:
+        parser.error("Please specify the number of clients with --clients.")
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    if options.json:
+        raise_file_limit(options.clients[0])
+        print(json.dumps(SyncBenchmark(options.clients[0], options.relays, options.unix).run(options.timeout)))
+        return
+
+    print("%10s %8s %15s %11s %8s %14s %14s" % ("clients", "relays", "all_connected", "all_ready", "all_go",
+                                                  "peak_memory", "bytes_sent"))
+    for num_clients in options.clients:
+        output = subprocess.check_output([sys.executable, __file__, "--json", "-n", str(num_clients),
+                                          "-r", str(options.relays), "-t", str(options.timeout)] +
+                                         (["--unix"] if options.unix else []))
+        results = json.loads(output.splitlines()[-1])
+        timings = tuple("%.3f" % results[key] if key in results else "timeout"
+                        for key in ("all_connected", "all_ready", "all_go"))
+        print("%10d %8d %15s %11s %8s %14d %14d" % ((num_clients, options.relays) + timings +
+                                                    (results['peak_memory'], results.get('bytes_sent', 0))))
+
+if __name__ == "__main__":
+    main()
+
+#
+# sync_benchmark.py ends here